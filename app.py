@@ -15,7 +15,7 @@ from backend.routes.converse import converse_bp
 # from backend.routes.files import files_bp
 from backend.routes.entries import entries_bp
 from backend.routes.monthly_summaries import monthly_summaries_bp
-from backend.commands import vectorize_pages_command, generate_monthly_summary_command, generate_all_monthly_summaries_command
+from backend.commands import vectorize_pages_command, generate_monthly_summary_command, generate_all_monthly_summaries_command, benchmark_index_command, reconcile_index_command
 from datetime import datetime
 import pytz
 # from backend.models.users import users
@@ -153,6 +153,8 @@ def create_app():
     app.cli.add_command(vectorize_pages_command)
     app.cli.add_command(generate_monthly_summary_command)
     app.cli.add_command(generate_all_monthly_summaries_command)
+    app.cli.add_command(benchmark_index_command)
+    app.cli.add_command(reconcile_index_command)
     
     # Schedule monthly summary generation
     # Run on the 1st of each month at 2 AM
@@ -169,6 +171,32 @@ def create_app():
             name='Generate monthly summaries for all users',
             replace_existing=True
         )
+        
+        # Patch the vector indexes with anything their incremental updates missed,
+        # once at startup and then periodically (one worker per host does the work)
+        from backend.services.index_reconcile import reconcile_index
+        scheduler.add_job(
+            func=reconcile_index,
+            trigger='interval',
+            seconds=int(os.environ.get('INDEX_RECONCILE_INTERVAL', 600)),
+            next_run_time=datetime.now(),
+            id='reconcile_index',
+            name='Reconcile vector indexes with the database',
+            replace_existing=True
+        )
+        
+        # Resume post-processing jobs lost with a previous worker and queue entries
+        # that never got vectors, at startup and then periodically
+        from backend.services.entry_processing import entry_processor
+        scheduler.add_job(
+            func=entry_processor.recover,
+            trigger='interval',
+            seconds=int(os.environ.get('ENTRY_RECOVERY_INTERVAL', 60)),
+            next_run_time=datetime.now(),
+            id='recover_entry_jobs',
+            name='Resume entry processing jobs',
+            replace_existing=True
+        )
         scheduler.start()
         logger = logging.getLogger(__name__)
         logger.info("Monthly summary scheduler started (runs on 1st of each month at 2 AM)")
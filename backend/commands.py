@@ -4,13 +4,15 @@ from backend.services.embedding import vectorize_all_entries
 from backend.routes.monthly_summaries import generate_summary_for_user, generate_summaries_for_previous_month
 from supabase import create_client
 import os
+import orjson
 
 @click.command('vectorize-entries')
+@click.option('--restart', is_flag=True, help='Ignore the checkpoint of an interrupted run and scan every entry again')
 @with_appcontext
-def vectorize_pages_command():  # Keep this name since app.py is importing it
+def vectorize_pages_command(restart):  # Keep this name since app.py is importing it
     """Vectorize all entries."""
     click.echo('Vectorizing entries...')
-    result = vectorize_all_entries()
+    result = vectorize_all_entries(restart=restart)
     if result:
         click.echo('Vectorization complete!')
     else:
@@ -116,4 +118,88 @@ def generate_all_monthly_summaries_command():
         click.echo('✓ Monthly summary generation complete!')
     except Exception as e:
         click.echo(f'✗ Error: {str(e)}')
-        raise click.Abort() 
\ No newline at end of file
+        raise click.Abort() 
+
+def _parse_int_list(value):
+    return [int(item) for item in value.split(',') if item.strip()]
+
+def _parse_exact_configs(value):
+    # 'none,int8:4,float16' -> [(None, 4), ('int8', 4), ('float16', 4)]
+    configs = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        quantization, _, rerank_factor = item.partition(':')
+        configs.append((None if quantization == 'none' else quantization, int(rerank_factor or 4)))
+    return configs
+
+def _parse_coarse_configs(value):
+    # '0,256,128:8' -> [(None, 4), (256, 4), (128, 8)]
+    configs = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        coarse_dim, _, rerank_factor = item.partition(':')
+        configs.append((int(coarse_dim) or None, int(rerank_factor or 4)))
+    return configs
+
+@click.command('benchmark-index')
+@click.option('--sizes', default='10000,100000', help='Comma-separated corpus sizes (e.g. 10000,100000,1000000)')
+@click.option('--dim', type=int, default=1536, help='Vector dimensionality')
+@click.option('--queries', 'num_queries', type=int, default=200, help='Held-out queries per corpus size')
+@click.option('--k', type=int, default=5, help='Neighbors per query (recall@k is reported)')
+@click.option('--m', 'm_values', default='16', help='Comma-separated HNSW M values')
+@click.option('--ef-construction', default='200', help='Comma-separated HNSW ef_construction values')
+@click.option('--ef-search', default='50', help='Comma-separated HNSW search ef values')
+@click.option('--coarse-dim', 'coarse_configs', default='0,256', help='Comma-separated HNSW graph dimensions: 0 for full vectors, or coarse_dim[:rerank_factor] to re-rank a truncated graph')
+@click.option('--exact', 'exact_configs', default='none', help="Comma-separated exact index configs: none, int8[:rerank_factor], float16[:rerank_factor] (empty to skip)")
+@click.option('--embeddings', type=click.Path(exists=True), help='Exported embeddings (.npy, JSON or JSON Lines) instead of synthetic vectors')
+@click.option('--output', default='index_benchmark.json', help='Where to write the JSON results')
+@click.option('--baseline', type=click.Path(exists=True), help='Earlier results to check for recall or latency regressions')
+@with_appcontext
+def benchmark_index_command(sizes, dim, num_queries, k, m_values, ef_construction, ef_search, coarse_configs, exact_configs, embeddings, output, baseline):
+    """Benchmark vector index recall, latency, memory and build time offline."""
+    from backend.services.index_benchmark import run_benchmark, load_exported_embeddings, compare_results, coarse_tradeoffs
+    
+    vectors = load_exported_embeddings(embeddings, dim=dim) if embeddings else None
+    report = run_benchmark(
+        _parse_int_list(sizes),
+        dim=dim,
+        num_queries=num_queries,
+        k=k,
+        M_values=_parse_int_list(m_values),
+        ef_construction_values=_parse_int_list(ef_construction),
+        ef_search_values=_parse_int_list(ef_search),
+        coarse_configs=_parse_coarse_configs(coarse_configs),
+        exact_configs=_parse_exact_configs(exact_configs),
+        embeddings=vectors,
+        output_path=output
+    )
+    click.echo(f'✓ Wrote {len(report["results"])} results to {output}')
+    for tradeoff in coarse_tradeoffs(report):
+        click.echo(f'  {tradeoff}')
+    
+    if baseline:
+        with open(baseline, 'rb') as f:
+            regressions = compare_results(orjson.loads(f.read()), report)
+        if regressions:
+            for regression in regressions:
+                click.echo(f'✗ {regression}')
+            raise click.Abort()
+        click.echo('✓ No regressions against baseline')
+
+@click.command('reconcile-index')
+@click.option('--user-id', default=None, help='Only reconcile this user (default: every indexed user)')
+@with_appcontext
+def reconcile_index_command(user_id):
+    """Patch the vector indexes to match the database without a full rebuild."""
+    from backend.services.index_reconcile import reconcile_index
+    
+    click.echo('Reconciling vector indexes...')
+    result = reconcile_index(user_id=user_id)
+    if result is None:
+        click.echo('✗ Reconciliation skipped or failed (see log above).')
+        raise click.Abort()
+    click.echo(f'✓ {result["added"]} entries added, {result["removed"]} removed')
@@ -6,8 +6,11 @@ Handles all OpenAI calls, message formatting, and business logic.
 from flask import Blueprint, request, jsonify, Response, g
 import json
 import logging
-from backend.services.context_retrieval import search_by_text
+from backend.services.context_retrieval import search_by_text, search_by_texts, extract_date_range
+from backend.services.lexical_index import reciprocal_rank_fusion
 from backend.routes.entries import supabase_auth_required
+from backend.services.entry_processing import entry_processor, ProcessingQueueFull
+from backend.services.entry_ids import entry_id_allocator
 from openai import OpenAI
 import os
 
@@ -100,6 +103,41 @@ def get_user_context(user_id, user_supabase, limit=15):
         logger.error(f"Error getting user context: {e}")
         return ""
 
+def expand_query(user_input, yap_messages, max_queries=4):
+    """
+    Split a user turn into sub-queries for journal retrieval.
+    Multi-part messages are searched sentence by sentence, and the previous user
+    message is added so short follow-ups ("what about her?") keep their subject.
+    """
+    import re
+    sub_queries = [user_input]
+    
+    sentences = [s.strip() for s in re.split(r'(?<=[.!?])\s+', user_input) if len(s.split()) >= 3]
+    if len(sentences) > 1:
+        sub_queries.extend(sentences)
+    
+    previous_user_messages = [msg.get('content', '').strip() for msg in yap_messages if msg.get('type') == 'user']
+    if previous_user_messages and previous_user_messages[-1]:
+        sub_queries.append(f"{previous_user_messages[-1]} {user_input}")
+    
+    # Drop duplicates but keep the full user input first
+    return list(dict.fromkeys(sub_queries))[:max_queries]
+
+def merge_search_results(result_lists, limit=3):
+    """
+    Merge per-sub-query results into one ranking with reciprocal-rank fusion.
+    """
+    entries = {}
+    for results in result_lists:
+        for entry in results:
+            entry_id = entry.get('user_and_entry_id')
+            best = entries.get(entry_id)
+            if best is None or (entry.get('similarity') or 0) > (best.get('similarity') or 0):
+                entries[entry_id] = entry
+    
+    fused = reciprocal_rank_fusion(*[[entry.get('user_and_entry_id') for entry in results] for results in result_lists])
+    return [entries[entry_id] for entry_id, _ in fused[:limit]]
+
 @converse_bp.route('/converse/stream', methods=['POST', 'OPTIONS'])
 @supabase_auth_required
 def converse_stream():
@@ -134,47 +172,56 @@ def converse_stream():
         # Use RAG pipeline to find relevant entries (only if use_rag is True)
         if use_rag:
             logger.info(f"[converse_stream] Starting RAG search for user_id={g.current_user.id}, query={user_input[:50]}")
-            from backend.services.context_retrieval import search_by_text
-            logger.info(f"[converse_stream] Calling search_by_text for user_id={g.current_user.id}, query={user_input[:50]}...")
+            sub_queries = expand_query(user_input, yap_messages)
+            # "What was I worried about last March" only searches entries from that March
+            date_range = extract_date_range(user_input)
+            logger.info(f"[converse_stream] Searching {len(sub_queries)} sub-queries for user_id={g.current_user.id}, date_range={date_range}")
             
             try:
-                relevant_entries = search_by_text(user_input, limit=3, user_id=g.current_user.id, user_client=g.user_supabase)
-                logger.info(f"[converse_stream] search_by_text returned {len(relevant_entries)} entries")
-            
-            if relevant_entries:
-                for entry in relevant_entries:
-                    content = entry.get('content', '').strip()
-                    if content:
-                        # Truncate very long entries
-                        if len(content) > 300:
-                            content = content[:300] + "..."
-                        context_parts.append(f"Entry {entry.get('user_entry_id', 'N/A')}: {content}")
-                        # Add to sources for frontend
-                        sources.append({
-                            'entry_id': entry.get('entry_id'),
-                            'user_entry_id': entry.get('user_entry_id'),
-                            'content': content,
-                            'similarity': entry.get('similarity', 0)
-                        })
+                # One embeddings request, index pass and database query for all sub-queries
+                result_lists = search_by_texts(sub_queries, limit=3, user_id=g.current_user.id, user_client=g.user_supabase, date_range=date_range)
+                relevant_entries = merge_search_results(result_lists, limit=3)
+                if not relevant_entries and date_range is not None:
+                    # Nothing from that period, so the question may not have been about it
+                    logger.info(f"[converse_stream] No entries in {date_range}, searching all entries")
+                    result_lists = search_by_texts(sub_queries, limit=3, user_id=g.current_user.id, user_client=g.user_supabase)
+                    relevant_entries = merge_search_results(result_lists, limit=3)
+                logger.info(f"[converse_stream] search_by_texts returned {len(relevant_entries)} entries")
+                
+                if relevant_entries:
+                    for entry in relevant_entries:
+                        content = entry.get('content', '').strip()
+                        if content:
+                            # Truncate very long entries
+                            if len(content) > 300:
+                                content = content[:300] + "..."
+                            context_parts.append(f"Entry {entry.get('user_entry_id', 'N/A')}: {content}")
+                            # Add to sources for frontend
+                            sources.append({
+                                'entry_id': entry.get('entry_id'),
+                                'user_entry_id': entry.get('user_entry_id'),
+                                'content': content,
+                                'similarity': entry.get('similarity', 0)
+                            })
                 
-                context = "\n\n".join(context_parts)
-                logger.info(f"[converse_stream] Built context with {len(context_parts)} entries")
-            else:
-                # No results found - check if user has vectorized entries
-                try:
-                    response = g.user_supabase.table('entries').select('user_and_entry_id').eq('user_id', g.current_user.id).not_.is_('vectors', 'null').limit(1).execute()
-                    has_vectorized_entries = response.data and len(response.data) > 0
+                    context = "\n\n".join(context_parts)
+                    logger.info(f"[converse_stream] Built context with {len(context_parts)} entries")
+                else:
+                    # No results found - check if user has vectorized entries
+                    try:
+                        response = g.user_supabase.table('entries').select('user_and_entry_id').eq('user_id', g.current_user.id).not_.is_('vectors', 'null').limit(1).execute()
+                        has_vectorized_entries = response.data and len(response.data) > 0
                     
-                    if has_vectorized_entries:
-                        # User has vectorized entries but search returned nothing
-                        # This could mean the index needs to be rebuilt, or the query didn't match anything
-                        logger.warning(f"[converse_stream] HNSW search returned no results but user has {len(response.data)} vectorized entries - index may need rebuilding")
-                        # Proceed without context rather than injecting error message
-                    else:
-                        logger.info(f"[converse_stream] No vectorized entries found for user - proceeding without context")
-                except Exception as e:
-                    logger.error(f"[converse_stream] Error checking for user vectorized entries: {e}", exc_info=True)
-                    # Proceed without context on error
+                        if has_vectorized_entries:
+                            # User has vectorized entries but search returned nothing
+                            # This could mean the index needs to be rebuilt, or the query didn't match anything
+                            logger.warning(f"[converse_stream] HNSW search returned no results but user has {len(response.data)} vectorized entries - index may need rebuilding")
+                            # Proceed without context rather than injecting error message
+                        else:
+                            logger.info(f"[converse_stream] No vectorized entries found for user - proceeding without context")
+                    except Exception as e:
+                        logger.error(f"[converse_stream] Error checking for user vectorized entries: {e}", exc_info=True)
+                        # Proceed without context on error
             except Exception as e:
                 logger.error(f"[converse_stream] Exception in RAG search: {e}", exc_info=True)
                 # Proceed without context on error - don't inject error messages into AI prompt
@@ -255,6 +302,7 @@ def save_conversation():
     Frontend sends: { conversation: "formatted conversation text" }
     Backend handles: Database save, validation
     """
+    slot = None
     try:
         data = request.get_json()
         
@@ -266,22 +314,19 @@ def save_conversation():
         if not conversation_text:
             return jsonify({'error': 'Conversation cannot be empty'}), 400
         
-        # Get the next user entry ID
-        user_entries_response = g.user_supabase.table('entries').select('user_entry_id').eq('user_id', g.current_user.id).execute()
-        user_entry_count = len(user_entries_response.data) if user_entries_response.data else 0
-        next_user_entry_id = user_entry_count + 1
+        # Reserve room in the processing queue before saving anything
+        try:
+            slot = entry_processor.slot()
+        except ProcessingQueueFull:
+            logger.warning("Entry processing queue is full, conversation not saved")
+            return jsonify({'error': 'Too many entries are being processed, please try again shortly'}), 503, {'Retry-After': '5'}
         
-        # Save to database (same structure as entries.py)
-        entry_data = {
-            'user_id': g.current_user.id,
-            'user_entry_id': next_user_entry_id,
-            'user_and_entry_id': f"{g.current_user.id}_{next_user_entry_id}",
+        # Save to database under the user's next entry ID (same structure as entries.py)
+        response = entry_id_allocator.insert_entry(g.user_supabase, g.current_user.id, {
             'content': conversation_text,
             'processed': None,  # Will be processed in background
             'vectors': None     # Will be generated in background
-        }
-        
-        response = g.user_supabase.table('entries').insert(entry_data).execute()
+        })
         
         if response.data:
             new_entry = response.data[0]
@@ -289,64 +334,7 @@ def save_conversation():
             
             if entry_id:
                 # Process and embed in background (same flow as entries.py)
-                def process_entry_background(entry_id_value, content_to_process):
-                    try:
-                        from supabase import create_client
-                        from backend.services.initial_processing import process_text
-                        from backend.services.embedding import generate_embedding
-                        from backend.services.hnsw_index import add_entry_to_index
-                        
-                        logger.info(f"Starting background processing for conversation entry {entry_id_value}")
-                        
-                        bg_supabase = create_client(
-                            os.environ.get('SUPABASE_URL'),
-                            os.environ.get('SUPABASE_SECRET_KEY')
-                        )
-                        
-                        # Step 1: Process content through OpenAI
-                        logger.info(f"Step 1: Processing content for entry {entry_id_value}")
-                        processed_content = process_text(content_to_process)
-                        
-                        if not processed_content:
-                            logger.warning(f"Processing failed for entry {entry_id_value}, skipping vectorization")
-                            return
-                        
-                        # Step 2: Generate embedding from processed content
-                        logger.info(f"Step 2: Generating embedding for entry {entry_id_value}")
-                        embedding = generate_embedding(processed_content)
-                        
-                        if not embedding:
-                            logger.warning(f"Embedding generation failed for entry {entry_id_value}")
-                            # Still save processed content even if embedding fails
-                            bg_supabase.table('entries').update({
-                                'processed': processed_content
-                            }).eq('user_and_entry_id', entry_id_value).execute()
-                            return
-                        
-                        # Step 3: Update entry with processed content and embedding
-                        logger.info(f"Step 3: Updating entry {entry_id_value} with processed content and embedding")
-                        bg_supabase.table('entries').update({
-                            'processed': processed_content,
-                            'vectors': embedding
-                        }).eq('user_and_entry_id', entry_id_value).execute()
-                        
-                        logger.info(f"Conversation entry processed and embedded: {entry_id_value}")
-                        
-                        # Step 4: Add entry to HNSW index
-                        logger.info(f"Step 4: Adding entry {entry_id_value} to HNSW index")
-                        try:
-                            add_entry_to_index(entry_id_value, embedding)
-                            logger.info(f"Conversation entry added to HNSW index: {entry_id_value}")
-                        except Exception as e:
-                            logger.warning(f"Failed to add conversation entry to HNSW index: {str(e)}")
-                    except Exception as e:
-                        logger.exception(f"Error processing conversation entry in background: {entry_id_value}")
-                
-                # Start background processing
-                import threading
-                thread = threading.Thread(target=process_entry_background, args=(entry_id, conversation_text))
-                thread.daemon = True
-                thread.start()
+                slot.submit(entry_id, conversation_text, g.current_user.id, new_entry.get('created_at'))
             
             logger.info(f"Saved conversation as entry {entry_id}")
             return jsonify({
@@ -360,6 +348,10 @@ def save_conversation():
     except Exception as e:
         logger.exception("Error saving conversation")
         return jsonify({'error': 'Failed to save conversation'}), 500
+    finally:
+        # Frees the slot if the conversation never reached the queue
+        if slot is not None:
+            slot.release()
 
 @converse_bp.route('/converse/intro', methods=['GET', 'OPTIONS'])
 @supabase_auth_required
@@ -3,6 +3,8 @@ from werkzeug.exceptions import InternalServerError
 # SQLAlchemy references removed - using Supabase
 from backend.services.initial_processing import process_text
 from backend.services.embedding import generate_embedding
+from backend.services.entry_processing import entry_processor, ProcessingQueueFull
+from backend.services.entry_ids import entry_id_allocator
 import os
 from supabase import create_client, Client
 from functools import wraps
@@ -27,6 +29,9 @@ def validate_env():
 
 entries_bp = Blueprint('entries', __name__)
 
+# Most queries one batch search request may carry
+MAX_BATCH_QUERIES = 20
+
 # Validate environment variables
 validate_env()
 
@@ -82,6 +87,19 @@ def supabase_auth_required(f):
     
     return decorated
 
+# Users allowed to read host-wide operational stats (comma-separated user ids, nobody by default)
+ADMIN_USER_IDS = frozenset(user_id.strip() for user_id in os.environ.get('ADMIN_USER_IDS', '').split(',') if user_id.strip())
+
+def admin_required(f):
+    """Restrict a route to ADMIN_USER_IDS (goes below @supabase_auth_required)"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if request.method != 'OPTIONS' and str(g.current_user.id) not in ADMIN_USER_IDS:
+            return jsonify({'message': 'Admin access required!'}), 403
+        return f(*args, **kwargs)
+    
+    return decorated
+
 # Update all your route decorators from @token_required to @supabase_auth_required
 @entries_bp.route('', methods=['GET'])
 @supabase_auth_required
@@ -107,26 +125,22 @@ def create_entry():
         logger.warning("Create entry request missing content", extra={"route": "/entries", "method": "POST", "user_id": g.current_user.id})
         return jsonify({'message': 'Content is required'}), 400
     
+    # Reserve room in the processing queue before saving anything
+    try:
+        slot = entry_processor.slot()
+    except ProcessingQueueFull:
+        logger.warning("Entry processing queue is full", extra={"route": "/entries", "method": "POST", "user_id": g.current_user.id})
+        return jsonify({'message': 'Too many entries are being processed, please try again shortly'}), 503, {'Retry-After': '5'}
+    
     try:
         logger.info("Creating entry", extra={"route": "/entries", "method": "POST", "user_id": g.current_user.id, "content_length": len(data['content'])})
         
-        # Get the next user entry ID using user context
-        user_entries_response = g.user_supabase.table('entries').select('user_entry_id').execute()
-        user_entry_count = len(user_entries_response.data)
-        next_user_entry_id = user_entry_count + 1
-        
-        # Save entry immediately with raw content (fast response)
-        entry_data = {
-            'user_id': g.current_user.id,
-            'user_entry_id': next_user_entry_id,
-            'user_and_entry_id': f"{g.current_user.id}_{next_user_entry_id}",
+        # Save entry immediately with raw content (fast response), under the user's next entry ID
+        response = entry_id_allocator.insert_entry(g.user_supabase, g.current_user.id, {
             'content': data['content'],
             'processed': None,  # Will be processed in background
             'vectors': None     # Will be generated in background
-        }
-        
-        # Create new entry in Supabase immediately
-        response = g.user_supabase.table('entries').insert(entry_data).execute()
+        })
         new_entry = response.data[0] if response.data else None
         
         if not new_entry:
@@ -140,71 +154,29 @@ def create_entry():
             # Still return the entry, but background processing will skip
             return jsonify(new_entry), 201
         
+        # The raw content is searchable by keyword straight away
+        from backend.services.lexical_index import lexical_index
+        lexical_index.upsert_entry(g.current_user.id, entry_id, content=data['content'])
+        
         # Process and embed in background (don't block response)
         # Flow: 1. Process content → 2. Vectorize processed content → 3. Add to index
-        def process_entry_background(entry_id_value, content_to_process):
-            try:
-                logger.info(f"Starting background processing for entry {entry_id_value}")
-                
-                # Create new Supabase client for background thread (g is thread-local)
-                bg_supabase = create_client(
-                    os.environ.get('SUPABASE_URL'),
-                    os.environ.get('SUPABASE_SECRET_KEY')
-                )
-                
-                # Step 1: Process content through OpenAI
-                logger.info(f"Step 1: Processing content for entry {entry_id_value}")
-                processed_content = process_text(content_to_process)
-                
-                if not processed_content:
-                    logger.warning(f"Processing failed for entry {entry_id_value}, skipping vectorization")
-                    return
-                
-                # Step 2: Generate embedding from processed content
-                logger.info(f"Step 2: Generating embedding for entry {entry_id_value}")
-                embedding = generate_embedding(processed_content)
-                
-                if not embedding:
-                    logger.warning(f"Embedding generation failed for entry {entry_id_value}")
-                    # Still save processed content even if embedding fails
-                    bg_supabase.table('entries').update({
-                        'processed': processed_content
-                    }).eq('user_and_entry_id', entry_id_value).execute()
-                    return
-                
-                # Step 3: Update entry with processed content and embedding
-                logger.info(f"Step 3: Updating entry {entry_id_value} with processed content and embedding")
-                bg_supabase.table('entries').update({
-                    'processed': processed_content,
-                    'vectors': embedding
-                }).eq('user_and_entry_id', entry_id_value).execute()
-                
-                logger.info("Entry processed and embedded", extra={"route": "/entries", "method": "POST", "entry_id": entry_id_value})
-                
-                # Step 4: Add entry to HNSW index for fast search
-                logger.info(f"Step 4: Adding entry {entry_id_value} to HNSW index")
-                try:
-                    from backend.services.hnsw_index import add_entry_to_index
-                    add_entry_to_index(entry_id_value, embedding)
-                    logger.info("Entry added to HNSW index", extra={"route": "/entries", "method": "POST", "entry_id": entry_id_value})
-                except Exception as e:
-                    logger.warning(f"Failed to add entry to HNSW index: {str(e)}", extra={"route": "/entries", "method": "POST", "entry_id": entry_id_value})
-                    # Index will be rebuilt on next search if needed
-                    
-            except Exception as e:
-                logger.exception("Error processing entry in background", extra={"route": "/entries", "method": "POST", "entry_id": entry_id_value})
-        
-        # Start background processing (non-blocking)
-        import threading
-        thread = threading.Thread(target=process_entry_background, args=(entry_id, data['content']))
-        thread.daemon = True
-        thread.start()
+        slot.submit(entry_id, data['content'], g.current_user.id, new_entry.get('created_at'))
         
-        logger.info("Entry created successfully (processing in background)", extra={"route": "/entries", "method": "POST", "user_id": g.current_user.id, "user_entry_id": next_user_entry_id})
+        logger.info("Entry created successfully (processing in background)", extra={"route": "/entries", "method": "POST", "user_id": g.current_user.id, "user_entry_id": new_entry.get('user_entry_id')})
         return jsonify(new_entry), 201
     except Exception as e:
         logger.exception("Error creating entry", extra={"route": "/entries", "method": "POST", "user_id": g.current_user.id})
         return jsonify({'message': f'Error creating entry: {str(e)}'}), 500
+    finally:
+        # Frees the slot if the entry never reached the queue
+        slot.release()
+
+@entries_bp.route('/processing', methods=['GET'])
+@supabase_auth_required
+@admin_required
+def get_processing_stats():
+    """Queue depth and per-stage latency of background entry processing (admins only, covers every user)"""
+    return jsonify(entry_processor.stats()), 200
 
 @entries_bp.route('/<int:entry_id>', methods=['GET'])
 @supabase_auth_required
@@ -243,10 +215,17 @@ def update_entry(entry_id):
         update_data = {'content': data['content']}
         
         # Re-process the content if requested
+        embedding = None
         if data.get('reprocess', False):
             processed_content = process_text(data['content'])
             update_data['processed'] = processed_content
             
+            # Re-embed so the stored vector matches the new processed content
+            if processed_content:
+                embedding = generate_embedding(processed_content)
+                if embedding:
+                    update_data['vectors'] = embedding
+            
         # Update entry in Supabase
         response = g.user_supabase.table('entries').update(update_data).eq('user_entry_id', entry_id).execute()
         updated_entry = response.data[0] if response.data else None
@@ -254,6 +233,21 @@ def update_entry(entry_id):
         if not updated_entry:
             return jsonify({'message': 'Failed to update entry'}), 500
         
+        from backend.services.lexical_index import lexical_index
+        lexical_index.upsert_entry(g.current_user.id, entry['user_and_entry_id'], content=updated_entry.get('content'), processed=updated_entry.get('processed'))
+        
+        # Edits that keep the old vector never reach the index log, so evict the cached row here
+        from backend.services.entry_cache import entry_cache
+        entry_cache.invalidate(entry['user_and_entry_id'])
+        
+        if embedding:
+            # Replace the stale vector in the index
+            try:
+                from backend.services.hnsw_index import update_entry_in_index
+                update_entry_in_index(entry['user_and_entry_id'], embedding, user_id=g.current_user.id, created_at=entry.get('created_at'))
+            except Exception as e:
+                logger.warning(f"Failed to update entry in HNSW index: {str(e)}", extra={"route": "/entries/<int:entry_id>", "method": "PUT", "entry_id": entry_id})
+        
         return jsonify(updated_entry), 200
     except Exception as e:
         logger.exception("Error updating entry", extra={"route": "/entries/<int:entry_id>", "method": "PUT", "entry_id": entry_id})
@@ -274,30 +268,97 @@ def delete_entry(entry_id):
         # Delete entry from Supabase
         response = g.user_supabase.table('entries').delete().eq('user_entry_id', entry_id).execute()
         
+        # Tombstone the entry so searches stop returning it
+        try:
+            from backend.services.lexical_index import lexical_index
+            lexical_index.remove_entry(g.current_user.id, entry['user_and_entry_id'])
+            
+            from backend.services.entry_cache import entry_cache
+            entry_cache.invalidate(entry['user_and_entry_id'])
+            
+            from backend.services.hnsw_index import remove_entry_from_index
+            remove_entry_from_index(entry['user_and_entry_id'], user_id=g.current_user.id)
+        except Exception as e:
+            logger.warning(f"Failed to remove entry from HNSW index: {str(e)}", extra={"route": "/entries/<int:entry_id>", "method": "DELETE", "entry_id": entry_id})
+        
         return jsonify({'message': 'Entry deleted successfully'}), 200
     except Exception as e:
         logger.exception("Error deleting entry", extra={"route": "/entries/<int:entry_id>", "method": "DELETE", "entry_id": entry_id})
         return jsonify({'message': f'Error deleting entry: {str(e)}'}), 500
 
+def get_date_range(data):
+    """Read a search request's optional 'created_after' and 'created_before' ISO dates
+    
+    Returns:
+        (start, end) pair for search_by_text(), or None if neither is given
+    
+    Raises:
+        ValueError: If a date cannot be parsed
+    """
+    from backend.services.hnsw_index import to_epoch_seconds
+    
+    date_range = (data.get('created_after'), data.get('created_before'))
+    if all(bound is None for bound in date_range):
+        return None
+    for bound in date_range:
+        if bound is not None and to_epoch_seconds(bound) is None:
+            raise ValueError(f"Invalid date: {bound}")
+    return date_range
+
 @entries_bp.route('/search', methods=['POST'])
 @supabase_auth_required
 def search_entries():
-    """Search for similar entries using vector embeddings"""
+    """Search entries by meaning and keywords (optional 'mode': hybrid, vector or lexical,
+    optional 'created_after'/'created_before' ISO dates)"""
     data = request.get_json()
     
     if not data or 'query' not in data:
         return jsonify({'error': 'Query is required'}), 400
+    try:
+        date_range = get_date_range(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
     try:
         from backend.services.context_retrieval import search_by_text
         
         limit = data.get('limit', 5)
         # Only search the current user's entries
-        similar_entries = search_by_text(data['query'], limit, user_id=g.current_user.id)
+        similar_entries = search_by_text(data['query'], limit, user_id=g.current_user.id, mode=data.get('mode'), date_range=date_range)
         
         return jsonify({
             'results': similar_entries
         }), 200
     except Exception as e:
         logger.exception("Error searching entries", extra={"route": "/entries/search", "method": "POST", "user_id": g.current_user.id})
-        return jsonify({'error': str(e)}), 500
\ No newline at end of file
+        return jsonify({'error': str(e)}), 500
+
+@entries_bp.route('/search/batch', methods=['POST'])
+@supabase_auth_required
+def search_entries_batch():
+    """Run several searches at once (one embeddings request and one database query for all)"""
+    data = request.get_json()
+    
+    queries = data.get('queries') if data else None
+    if not isinstance(queries, list) or not queries or not all(isinstance(q, str) and q.strip() for q in queries):
+        return jsonify({'error': 'Queries must be a non-empty list of strings'}), 400
+    if len(queries) > MAX_BATCH_QUERIES:
+        return jsonify({'error': f'At most {MAX_BATCH_QUERIES} queries per request'}), 400
+    try:
+        date_range = get_date_range(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        from backend.services.context_retrieval import search_by_texts
+        
+        limit = data.get('limit', 5)
+        # Only search the current user's entries
+        results = search_by_texts(queries, limit, user_id=g.current_user.id, mode=data.get('mode'), date_range=date_range)
+        
+        return jsonify({
+            'results': results
+        }), 200
+    except Exception as e:
+        logger.exception("Error searching entries", extra={"route": "/entries/search/batch", "method": "POST", "user_id": g.current_user.id})
+        return jsonify({'error': str(e)}), 500
@@ -1,57 +1,206 @@
 """
 Context retrieval service for finding similar entries using vector embeddings.
-Uses HNSW index for fast similarity search with fallback to brute-force.
+Uses per-user vector indexes: exact brute-force search for small journals and
+HNSW graphs for large ones. Their results are fused with a per-user BM25 keyword
+index, which alone answers queries for specific names and dates.
 """
 
 import numpy as np
 import os
+import re
+from datetime import datetime, timedelta, timezone
 from supabase import create_client, Client
-from backend.services.embedding import generate_embedding
+from backend.services.embedding import generate_embeddings
+from backend.services.lexical_index import lexical_index, is_lexical_query, reciprocal_rank_fusion
 
 # Initialize Supabase client for fallback search
 supabase_url = os.environ.get('SUPABASE_URL')
 supabase_key = os.environ.get('SUPABASE_SECRET_KEY')
 supabase: Client = create_client(supabase_url, supabase_key)
 
-__all__ = ['search_by_text']
+__all__ = ['search_by_text', 'search_by_texts', 'extract_date_range']
 
+# Candidates taken from each retriever per requested result before fusing
+CANDIDATES_PER_RESULT = 4
 
-def search_by_text(query_text, limit=5, user_id=None, user_client=None):
-    """Find entries with similar content to the query text using HNSW index
+
+def search_by_text(query_text, limit=5, user_id=None, user_client=None, mode=None, date_range=None):
+    """Find entries matching the query text, by meaning and by keywords
+    
+    Vector and BM25 candidates are merged with reciprocal-rank fusion. Queries
+    that only name people, places or dates are answered from the keyword index
+    without generating an embedding, falling back to hybrid search if nothing matches.
     
     Args:
         query_text: Text query to search for
         limit: Maximum number of results to return
-        user_id: Optional user_id to filter results
+        user_id: Optional user_id to filter results (keyword search needs one)
         user_client: Optional Supabase client for user-specific queries
+        mode: 'hybrid', 'vector' or 'lexical' (chosen from the query if None)
+        date_range: Optional (start, end) pair of datetimes or ISO strings; only entries
+            created from start up to (not including) end are returned, either end may be None
     
     Returns:
-        List of entry dictionaries with similarity scores
+        List of entry dictionaries with similarity scores (entries only found by
+        keyword have no 'similarity') and a 'score' from the fusion or BM25
     """
+    return search_by_texts([query_text], limit=limit, user_id=user_id, user_client=user_client, mode=mode, date_range=date_range)[0]
+
+
+def search_by_texts(query_texts, limit=5, user_id=None, user_client=None, mode=None, date_range=None):
+    """Run several searches with one round trip per stage
+    
+    All queries that need an embedding share one embeddings request, one batched
+    index search, and one database query to fetch the matching entries.
+    
+    Args:
+        query_texts: Text queries to search for
+        limit: Maximum number of results to return per query
+        user_id: Optional user_id to filter results (keyword search needs one)
+        user_client: Optional Supabase client for user-specific queries
+        mode: 'hybrid', 'vector' or 'lexical' (chosen per query if None)
+        date_range: Optional (start, end) creation date range, as for search_by_text()
+    
+    Returns:
+        One list of entry dictionaries per query, as returned by search_by_text()
+    """
+    import logging
+    search_logger = logging.getLogger(__name__)
     try:
-        import logging
-        search_logger = logging.getLogger(__name__)
-        search_logger.info(f"[search_by_text] Starting search for user_id={user_id}, query={query_text[:50]}")
+        search_logger.info(f"[search_by_texts] Starting {len(query_texts)} searches for user_id={user_id}, first query={query_texts[0][:50] if query_texts else ''}, date_range={date_range}")
+        
+        from backend.services.hnsw_index import search_candidates_batch, hydrate_candidate_lists, to_epoch_seconds, index as vector_index
         
-        # Generate embedding for query text
-        query_embedding = generate_embedding(query_text)
-        if not query_embedding:
-            search_logger.error(f"[search_by_text] ERROR: Failed to generate embedding for query: {query_text[:50]}")
-            return []
+        created_range = None
+        if date_range is not None and any(bound is not None for bound in date_range):
+            created_range = tuple(to_epoch_seconds(bound) for bound in date_range)
         
-        search_logger.info(f"[search_by_text] Generated embedding, length={len(query_embedding)}")
+        num_candidates = limit * CANDIDATES_PER_RESULT
+        modes = []
+        for query_text in query_texts:
+            if user_id is None:
+                # Keyword indexes are per user
+                modes.append('vector')
+            elif mode is None:
+                modes.append('lexical' if is_lexical_query(query_text) else 'hybrid')
+            else:
+                modes.append(mode)
         
-        # Use HNSW index for fast similarity search
-        from backend.services.hnsw_index import search_similar
-        results = search_similar(query_embedding, k=limit, user_id=user_id, user_client=user_client)
+        # Keyword search is local, so it costs no round trip; a date filter drops
+        # many keyword matches afterwards, so more of them are taken first
+        lexical_k = num_candidates if created_range is None else num_candidates * CANDIDATES_PER_RESULT
+        lexical_candidates = [
+            lexical_index.search(user_id, query_text, k=lexical_k) if query_mode != 'vector' else []
+            for query_text, query_mode in zip(query_texts, modes)
+        ]
+        if created_range is not None:
+            # Keyword matches are dated with the creation times kept in the vector index
+            for i, candidates in enumerate(lexical_candidates):
+                if candidates:
+                    in_range = set(vector_index.filter_created_range(user_id, [c['entry_id'] for c in candidates], created_range))
+                    lexical_candidates[i] = [c for c in candidates if c['entry_id'] in in_range]
+        candidate_lists = [None] * len(query_texts)
+        needs_vectors = []
+        for i, query_mode in enumerate(modes):
+            if query_mode == 'lexical' and lexical_candidates[i]:
+                # No embedding needed: the keyword matches are the answer
+                candidate_lists[i] = lexical_candidates[i][:limit]
+            else:
+                needs_vectors.append(i)
+        search_logger.info(f"[search_by_texts] {len(query_texts) - len(needs_vectors)} queries answered by keyword search alone")
         
-        search_logger.info(f"[search_by_text] Search returned {len(results)} results")
-        if not results:
-            search_logger.warning(f"[search_by_text] WARNING: HNSW search returned no results for user_id={user_id}, query={query_text[:50]}")
+        if needs_vectors:
+            embeddings = generate_embeddings([query_texts[i] for i in needs_vectors])
+            if not embeddings:
+                search_logger.error(f"[search_by_texts] ERROR: Failed to generate embeddings for {len(needs_vectors)} queries")
+            else:
+                search_logger.info(f"[search_by_texts] Generated {len(embeddings)} embeddings in one request")
+                vector_candidates = search_candidates_batch(embeddings, k=num_candidates, user_id=user_id, created_range=created_range)
+                for i, query_vector_candidates in zip(needs_vectors, vector_candidates):
+                    candidate_lists[i] = _fuse(query_vector_candidates, lexical_candidates[i], limit)
         
+        candidate_lists = [candidates or [] for candidates in candidate_lists]
+        results = hydrate_candidate_lists(candidate_lists, user_id=user_id, user_client=user_client)
+        
+        search_logger.info(f"[search_by_texts] Searches returned {[len(r) for r in results]} results")
         return results
     except Exception as e:
-        import logging
-        search_logger = logging.getLogger(__name__)
-        search_logger.error(f"[search_by_text] ERROR: Exception in search_by_text: {str(e)}", exc_info=True)
-        return []
\ No newline at end of file
+        search_logger.error(f"[search_by_texts] ERROR: Exception in search_by_texts: {str(e)}", exc_info=True)
+        return [[] for _ in query_texts]
+
+
+def _fuse(vector_candidates, lexical_candidates, limit):
+    """Merge one query's vector and keyword candidates into the top limit"""
+    similarities = {c['entry_id']: c['similarity'] for c in vector_candidates}
+    fused = reciprocal_rank_fusion(
+        [c['entry_id'] for c in vector_candidates],
+        [c['entry_id'] for c in lexical_candidates]
+    )[:limit]
+    candidates = []
+    for entry_id, score in fused:
+        candidate = {'entry_id': entry_id, 'score': score}
+        if entry_id in similarities:
+            candidate['similarity'] = similarities[entry_id]
+        candidates.append(candidate)
+    return candidates
+
+
+_MONTHS = ['january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october', 'november', 'december']
+_MONTH_PATTERN = '|'.join(_MONTHS)
+
+
+def _month_range(year, month):
+    start = datetime(year, month, 1, tzinfo=timezone.utc)
+    end = datetime(year + 1, 1, 1, tzinfo=timezone.utc) if month == 12 else datetime(year, month + 1, 1, tzinfo=timezone.utc)
+    return start, end
+
+
+def extract_date_range(text, now=None):
+    """Find the past period a question explicitly asks about, if it names one
+    
+    Recognizes phrases like "yesterday", "last week", "last month", "last year",
+    "last March", "in March", "March 2024" and "in 2023". Dates are in UTC.
+    Mentions of the current period ("today", "this week", "this year") are left
+    alone: they are usually said in passing, and filtering on them would hide
+    the older entries the question is really about.
+    
+    Args:
+        text: User message or search query
+        now: Current time (defaults to now, for tests)
+    
+    Returns:
+        (start, end) pair of datetimes with end exclusive, or None if no date is mentioned
+    """
+    if not text:
+        return None
+    text = text.lower()
+    now = now or datetime.now(timezone.utc)
+    today = datetime(now.year, now.month, now.day, tzinfo=timezone.utc)
+    
+    if re.search(r'\byesterday\b', text):
+        return today - timedelta(days=1), today
+    if re.search(r'\b(last|past) week\b', text):
+        return today - timedelta(days=7), today + timedelta(days=1)
+    if re.search(r'\blast month\b', text):
+        return _month_range(now.year - 1, 12) if now.month == 1 else _month_range(now.year, now.month - 1)
+    if re.search(r'\blast year\b', text):
+        return datetime(now.year - 1, 1, 1, tzinfo=timezone.utc), datetime(now.year, 1, 1, tzinfo=timezone.utc)
+    
+    match = re.search(rf'\b({_MONTH_PATTERN}),? (\d{{4}})\b', text)
+    if match:
+        return _month_range(int(match.group(2)), _MONTHS.index(match.group(1)) + 1)
+    match = re.search(rf'\b(last|in|during|since) ({_MONTH_PATTERN})\b', text)
+    if match:
+        month = _MONTHS.index(match.group(2)) + 1
+        # The most recent such month; "last March" in March means a year ago
+        if month < now.month or (month == now.month and match.group(1) != 'last'):
+            year = now.year
+        else:
+            year = now.year - 1
+        start, end = _month_range(year, month)
+        return (start, None) if match.group(1) == 'since' else (start, end)
+    match = re.search(r'\b(in|during) ((?:19|20)\d{2})\b', text)
+    if match:
+        year = int(match.group(2))
+        return datetime(year, 1, 1, tzinfo=timezone.utc), datetime(year + 1, 1, 1, tzinfo=timezone.utc)
+    return None
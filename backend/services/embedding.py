@@ -3,10 +3,18 @@ Embedding service for generating vector embeddings using OpenAI API.
 Handles embedding generation and vectorization of entries.
 """
 
+import openai
 from openai import OpenAI
+import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from dotenv import load_dotenv
 from supabase import create_client, Client
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from backend.services.embedding_cache import embedding_cache, cache_key
+from backend.services.index_wal import write_file_atomic
 
 # Force reload the .env file
 load_dotenv(override=True)
@@ -19,65 +27,344 @@ supabase_url = os.environ.get('SUPABASE_URL')
 supabase_key = os.environ.get('SUPABASE_SECRET_KEY')
 supabase: Client = create_client(supabase_url, supabase_key)
 
-__all__ = ['generate_embedding', 'vectorize_all_entries']
+__all__ = ['generate_embedding', 'generate_embeddings', 'vectorize_all_entries', 'update_entry_vectors', 'count_tokens', 'RateLimiter', 'EMBEDDING_MODEL', 'EMBEDDING_DIMENSIONS']
+
+EMBEDDING_MODEL = "text-embedding-3-large"
+EMBEDDING_DIMENSIONS = 1536  # Specify dimensions for the embedding
+MAX_INPUT_TOKENS = 8191  # Longest input the embedding models accept
+MAX_BATCH_INPUTS = 2048  # Most inputs the embeddings endpoint accepts per request
+
+# Errors worth retrying: the request may well succeed a little later
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+
+_encoding = None
+_encoding_lock = threading.Lock()
 
 def generate_embedding(text):
-    """Generate embedding for a single text using OpenAI API"""
+    """Generate embedding for a single text using OpenAI API
+    
+    Text embedded before (by any worker on this host) is served from the embedding cache.
+    """
+    key = cache_key(EMBEDDING_MODEL, EMBEDDING_DIMENSIONS, text)
+    cached = embedding_cache.get(key)
+    if cached is not None:
+        return cached
     try:
         response = client.embeddings.create(
-            model="text-embedding-3-large",
+            model=EMBEDDING_MODEL,
             input=text,
-            dimensions=1536  # Specify dimensions for the embedding
+            dimensions=EMBEDDING_DIMENSIONS
         )
-        return response.data[0].embedding
+        embedding = response.data[0].embedding
+        embedding_cache.put(key, embedding)
+        return embedding
     except Exception as e:
         print(f"Error generating embedding: {str(e)}")
         return None
 
-def vectorize_all_entries():
-    """Vectorize all entries that have processed content but no vectors
-    Flow: Only vectorize entries that have been processed (step 1 complete)
+def _tokenizer():
+    """tiktoken encoding of the embedding model, or False if it cannot be loaded"""
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            try:
+                import tiktoken
+                _encoding = tiktoken.encoding_for_model(EMBEDDING_MODEL)
+            except Exception as e:
+                # tiktoken downloads its vocabulary on first use, which fails offline
+                print(f"[vectorize] Warning: Could not load the tokenizer, estimating token counts: {str(e)}")
+                _encoding = False
+        return _encoding
+
+def count_tokens(text):
+    """Number of tokens text takes up in an embeddings request"""
+    encoding = _tokenizer()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    # Rarely less than 3 bytes per token, so this overestimates
+    return len(text.encode('utf-8')) // 3 + 1
+
+def truncate_tokens(text, max_tokens=MAX_INPUT_TOKENS):
+    """Cut text down to the longest prefix the embedding model accepts"""
+    encoding = _tokenizer()
+    if encoding:
+        tokens = encoding.encode(text, disallowed_special=())
+        return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+    encoded = text.encode('utf-8')
+    return text if len(encoded) // 3 + 1 <= max_tokens else encoded[:(max_tokens - 1) * 3].decode('utf-8', errors='ignore')
+
+def _request_embeddings(texts):
+    """Embed texts with one API call (raises on failure)"""
+    response = client.embeddings.create(
+        model=EMBEDDING_MODEL,
+        input=list(texts),
+        dimensions=EMBEDDING_DIMENSIONS
+    )
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+def _embed_with_cache(texts, request):
+    """Embed texts, calling request(texts) only for distinct texts missing from the embedding cache"""
+    keys = [cache_key(EMBEDDING_MODEL, EMBEDDING_DIMENSIONS, text) for text in texts]
+    embeddings = embedding_cache.get_many(keys)
+    missing = {}  # Maps the key of each text to embed to the text
+    for key, text in zip(keys, texts):
+        if key not in embeddings:
+            missing.setdefault(key, text)
+    if missing:
+        fetched = dict(zip(missing, request(list(missing.values()))))
+        embedding_cache.put_many(fetched)
+        embeddings.update(fetched)
+    return [embeddings[key] for key in keys]
+
+def generate_embeddings(texts):
+    """Generate embeddings for several texts with a single OpenAI API call
+    
+    Only texts missing from the embedding cache are sent, each distinct one once.
+    
+    Args:
+        texts: List of texts to embed
+    
+    Returns:
+        List of embeddings in the same order as texts, or None if the request failed
     """
+    if not texts:
+        return []
     try:
-        # Get all entries that have processed content but no vectors
-        response = supabase.table('entries').select('*').is_('vectors', 'null').not_.is_('processed', 'null').execute()
-        vectorless = response.data
-        
-        if not vectorless:
-            print("No entries found that need vectorization (all have vectors or are missing processed content)")
-            return True
-        
-        print(f"Found {len(vectorless)} entries that need vectorization")
+        return _embed_with_cache(texts, _request_embeddings)
+    except Exception as e:
+        print(f"Error generating embeddings: {str(e)}")
+        return None
+
+class RateLimiter:
+    def __init__(self, tokens_per_minute, requests_per_minute):
+        """Token buckets keeping API usage under per-minute token and request limits
         
-        for i, entry in enumerate(vectorless):
+        Args:
+            tokens_per_minute: Input tokens allowed per minute
+            requests_per_minute: Requests allowed per minute
+        """
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.tokens = float(tokens_per_minute)
+        self.requests = float(requests_per_minute)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self, tokens):
+        """Block until a request of this many tokens fits in the limits, then count it"""
+        # A request larger than a whole minute's budget waits for a full bucket
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                elapsed = now - self.updated
+                self.updated = now
+                self.tokens = min(self.tokens_per_minute, self.tokens + elapsed * self.tokens_per_minute / 60)
+                self.requests = min(self.requests_per_minute, self.requests + elapsed * self.requests_per_minute / 60)
+                if self.tokens >= tokens and self.requests >= 1:
+                    self.tokens -= tokens
+                    self.requests -= 1
+                    return
+                wait_seconds = max(
+                    (tokens - self.tokens) * 60 / self.tokens_per_minute,
+                    (1 - self.requests) * 60 / self.requests_per_minute
+                )
+            time.sleep(wait_seconds)
+
+def _iter_vectorless_pages(after, page_size):
+    """Yield pages of processed entries without vectors, in user_and_entry_id order after the given id"""
+    last_entry_id = after
+    while True:
+        query = supabase.table('entries').select('user_and_entry_id, user_id, user_entry_id, content, processed')\
+            .is_('vectors', 'null').not_.is_('processed', 'null')
+        if last_entry_id is not None:
+            query = query.gt('user_and_entry_id', last_entry_id)
+        response = query.order('user_and_entry_id').limit(page_size).execute()
+        page = response.data if response.data else []
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        last_entry_id = page[-1]['user_and_entry_id']
+
+def _iter_batches(pages, max_tokens, max_inputs):
+    """Group entries into embeddings requests of at most max_tokens tokens and max_inputs inputs
+    
+    Yields:
+        Lists of (entry, text to embed, token count), in user_and_entry_id order
+    """
+    batch, batch_tokens = [], 0
+    for page in pages:
+        for entry in page:
             entry_id = entry.get('user_and_entry_id')  # Primary key is 'user_and_entry_id'
             if not entry_id:
                 print(f"Skipping entry: missing 'user_and_entry_id' field")
                 continue
-            processed_content = entry.get('processed', '').strip()
-            
-            if not processed_content:
+            text = (entry.get('processed') or '').strip()
+            if not text:
                 print(f"Skipping entry {entry_id}: no processed content")
                 continue
             
-            try:
-                print(f"Vectorizing entry {entry_id} ({i+1}/{len(vectorless)})...")
-                # Generate embedding from processed content
-                embedding = generate_embedding(processed_content)
+            tokens = count_tokens(text)
+            if tokens > MAX_INPUT_TOKENS:
+                print(f"Entry {entry_id} is {tokens} tokens long, embedding its first {MAX_INPUT_TOKENS}")
+                text = truncate_tokens(text)
+                tokens = count_tokens(text)
+            if batch and (batch_tokens + tokens > max_tokens or len(batch) >= max_inputs):
+                yield batch
+                batch, batch_tokens = [], 0
+            batch.append((entry, text, tokens))
+            batch_tokens += tokens
+    if batch:
+        yield batch
+
+def update_entry_vectors(client, entry_ids, vectors, processed=None, only_missing=False):
+    """Write vectors (and processed text) into existing entries with one statement
+    
+    Runs the update_entry_vectors Postgres function (backend/sql/update_entry_vectors.sql),
+    a single conditional UPDATE for the whole batch. It never inserts, so an entry
+    deleted meanwhile stays deleted, and only writes vectors and processed, so
+    concurrent edits to other columns are kept.
+    
+    Args:
+        client: Supabase client to write with
+        entry_ids: Entries to write
+        vectors: Embedding per entry (None writes NULL)
+        processed: Optional processed text per entry (None keeps the stored text)
+        only_missing: Only write entries whose vectors are still NULL
+    
+    Returns:
+        List of the entry_ids that were written
+    """
+    if not entry_ids:
+        return []
+    response = client.rpc('update_entry_vectors', {
+        'ids': list(entry_ids),
+        # pgvector parses the same '[0.1,0.2,...]' text it returns
+        'vecs': [None if vector is None else json.dumps([float(x) for x in vector], separators=(',', ':')) for vector in vectors],
+        'texts': None if processed is None else list(processed),
+        'only_missing': only_missing,
+    }).execute()
+    return [row['entry_id'] for row in response.data or []]
+
+def _save_batch(batch, embeddings):
+    """Write a batch of embeddings back to entries that still have no vectors
+    
+    Reprocessing an entry writes its vectors along with the new processed text,
+    so an entry still without vectors still has the processed text embedded here.
+    
+    Returns:
+        Number of entries written
+    """
+    entry_ids = [entry['user_and_entry_id'] for entry, _, _ in batch]
+    return len(update_entry_vectors(supabase, entry_ids, embeddings, only_missing=True))
+
+def _read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f).get('after')
+    except (FileNotFoundError, ValueError):
+        return None
+
+def vectorize_all_entries(restart=False):
+    """Vectorize all entries that have processed content but no vectors
+    Flow: Only vectorize entries that have been processed (step 1 complete)
+    
+    Entries are embedded in batches of up to VECTORIZE_BATCH_TOKENS tokens per
+    request, with VECTORIZE_CONCURRENCY requests in flight, kept under
+    VECTORIZE_TOKENS_PER_MINUTE and VECTORIZE_REQUESTS_PER_MINUTE, and written
+    back with conditional updates that skip entries vectorized meanwhile. Requests failing with rate limit, connection
+    or server errors are retried with exponential backoff.
+    
+    Progress is checkpointed to VECTORIZE_CHECKPOINT_PATH after every batch, so
+    an interrupted run resumes after the last entry whose batch, and every batch
+    before it, was saved. Embeddings of a batch that was sent but not saved come
+    from the embedding cache on the next run.
+    
+    Args:
+        restart: Ignore the checkpoint and scan every entry again
+    
+    Returns:
+        True if every batch was vectorized, False otherwise
+    """
+    page_size = int(os.environ.get('VECTORIZE_PAGE_SIZE', 1000))
+    max_tokens = int(os.environ.get('VECTORIZE_BATCH_TOKENS', 100000))
+    max_inputs = min(int(os.environ.get('VECTORIZE_BATCH_SIZE', 512)), MAX_BATCH_INPUTS)
+    concurrency = int(os.environ.get('VECTORIZE_CONCURRENCY', 4))
+    checkpoint_path = os.environ.get('VECTORIZE_CHECKPOINT_PATH', 'instance/vectorize.checkpoint')
+    limiter = RateLimiter(
+        int(os.environ.get('VECTORIZE_TOKENS_PER_MINUTE', 1000000)),
+        int(os.environ.get('VECTORIZE_REQUESTS_PER_MINUTE', 3000))
+    )
+    
+    @retry(retry=retry_if_exception_type(RETRYABLE_ERRORS), wait=wait_random_exponential(min=1, max=60),
+           stop=stop_after_attempt(6), reraise=True)
+    def request(texts):
+        # Cache hits never reach here, so they cost no quota
+        limiter.acquire(sum(count_tokens(text) for text in texts))
+        return _request_embeddings(texts)
+    
+    def vectorize_batch(batch):
+        embeddings = _embed_with_cache([text for _, text, _ in batch], request)
+        return _save_batch(batch, embeddings)
+    
+    try:
+        after = None if restart else _read_checkpoint(checkpoint_path)
+        if after is not None:
+            print(f"Resuming vectorization after entry {after}")
+        
+        started = time.perf_counter()
+        vectorized = failed = 0
+        next_sequence = 0
+        pending = {}  # Maps futures to (sequence number, last entry id, batch size)
+        done_sequences = {}  # Maps finished sequence numbers to their last entry id
+        saved_through = 0  # Every batch with a lower sequence number is finished
+        first_failed = None  # Sequence number of the first failed batch, which the checkpoint stays before
+        
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            def collect():
+                """Wait for at least one batch to finish and move the checkpoint forward"""
+                nonlocal vectorized, failed, saved_through, first_failed
+                finished, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    sequence, last_entry_id, size = pending.pop(future)
+                    try:
+                        vectorized += future.result()
+                        done_sequences[sequence] = last_entry_id
+                    except Exception as e:
+                        failed += size
+                        first_failed = sequence if first_failed is None else min(first_failed, sequence)
+                        print(f"✗ Error vectorizing batch ending at entry {last_entry_id}: {str(e)}")
                 
-                if embedding:
-                    # Store embedding in Supabase
-                    supabase.table('entries').update({
-                        'vectors': embedding
-                    }).eq('user_and_entry_id', entry_id).execute()
-                    print(f"✓ Entry {entry_id} vectorized successfully")
-                else:
-                    print(f"✗ Failed to generate embedding for entry {entry_id}")
-            except Exception as e:
-                print(f"✗ Error vectorizing entry {entry_id}: {str(e)}")
-                continue
+                # Advance the checkpoint over the finished prefix of batches
+                last_saved = None
+                while saved_through in done_sequences and (first_failed is None or saved_through < first_failed):
+                    last_saved = done_sequences.pop(saved_through)
+                    saved_through += 1
+                if last_saved is not None:
+                    os.makedirs(os.path.dirname(checkpoint_path) or '.', exist_ok=True)
+                    write_file_atomic(checkpoint_path, json.dumps({'after': last_saved}).encode('utf-8'))
+                    print(f"Vectorized {vectorized} entries ({vectorized / max(time.perf_counter() - started, 1e-9):.0f}/s), checkpoint at {last_saved}")
+            
+            for batch in _iter_batches(_iter_vectorless_pages(after, page_size), max_tokens, max_inputs):
+                # Bound the batches held in memory while requests are in flight
+                while len(pending) >= concurrency * 2:
+                    collect()
+                future = executor.submit(vectorize_batch, batch)
+                pending[future] = (next_sequence, batch[-1][0]['user_and_entry_id'], len(batch))
+                next_sequence += 1
+            while pending:
+                collect()
         
-        print(f"Vectorization complete! Processed {len(vectorless)} entries.")
+        if vectorized == 0 and failed == 0:
+            print("No entries found that need vectorization (all have vectors or are missing processed content)")
+        else:
+            print(f"Vectorization complete! Vectorized {vectorized} entries in {time.perf_counter() - started:.1f}s, {failed} failed.")
+        if failed:
+            return False
+        # A finished run leaves nothing to resume
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
         return True
     except Exception as e:
         print(f"Error vectorizing entries: {str(e)}")
@@ -0,0 +1,70 @@
+"""
+Two-tier cache of embeddings keyed by model, dimensions and a hash of the text.
+Identical text always embeds to the same vector, so repeat queries and retried
+background jobs are answered from an in-process LRU or, failing that, a SQLite
+file shared by every worker on the host, without an API call. Only hashes and
+vectors are stored, never the text itself.
+"""
+
+import hashlib
+import os
+import unicodedata
+
+import numpy as np
+
+from backend.services.two_tier_cache import TwoTierCache
+
+__all__ = ['EmbeddingCache', 'embedding_cache', 'cache_key', 'normalize_text']
+
+
+def normalize_text(text):
+    """Canonical form of text for cache keys (Unicode NFC, whitespace collapsed)"""
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+
+def cache_key(model, dimensions, text):
+    """Cache key of an embedding of text made with model at the given dimensions"""
+    digest = hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+    return f"{model}:{dimensions}:{digest}"
+
+
+class EmbeddingCache(TwoTierCache):
+    def __init__(self, max_entries=None, path=None, ttl_seconds=None, max_bytes=None):
+        """Initialize an in-process LRU of embeddings in front of a SQLite store
+
+        Args:
+            max_entries: Embeddings kept in process memory (defaults to EMBEDDING_CACHE_SIZE or 2000)
+            path: SQLite file of the disk tier, '' for memory only
+                (defaults to EMBEDDING_CACHE_PATH or instance/embedding_cache.sqlite3)
+            ttl_seconds: Seconds an embedding is kept on disk (defaults to EMBEDDING_CACHE_TTL or 30 days)
+            max_bytes: Approximate size bound of the disk tier, least recently used rows
+                are evicted past it (defaults to EMBEDDING_CACHE_MAX_BYTES or 512 MB)
+        """
+        if max_entries is None:
+            max_entries = int(os.environ.get('EMBEDDING_CACHE_SIZE', 2000))
+        if path is None:
+            path = os.environ.get('EMBEDDING_CACHE_PATH', 'instance/embedding_cache.sqlite3')
+        if ttl_seconds is None:
+            ttl_seconds = float(os.environ.get('EMBEDDING_CACHE_TTL', 30 * 24 * 3600))
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('EMBEDDING_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+        # Vectors are kept as float32 arrays in memory and raw float32 bytes on disk
+        super().__init__('embedding_cache', 'embeddings', 'vector', 'BLOB', max_entries, path, ttl_seconds, max_bytes,
+                         encode=lambda vector: vector.tobytes(),
+                         decode=lambda blob: np.frombuffer(blob, dtype=np.float32).copy())
+
+    def get_many(self, keys):
+        """Look up embeddings, first in memory and then on disk
+
+        Returns:
+            Dictionary mapping each cached key to its embedding as a list of floats
+        """
+        return {key: vector.tolist() for key, vector in super().get_many(keys).items()}
+
+    def put_many(self, embeddings):
+        """Cache embeddings (a dictionary mapping cache keys to vectors)"""
+        super().put_many({key: np.asarray(embedding, dtype=np.float32) for key, embedding in embeddings.items()})
+
+
+# Global cache instance used by the embedding service
+embedding_cache = EmbeddingCache()
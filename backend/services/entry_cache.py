@@ -0,0 +1,105 @@
+"""
+In-memory LRU cache of entry rows for hydrating search results.
+A conversation searches the same handful of entries turn after turn, so hot rows
+are served from memory instead of the database. Rows hold only the columns search
+results need, never the embedding vectors.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+__all__ = ['EntryCache', 'entry_cache', 'HYDRATION_COLUMNS']
+
+# Columns returned with search results (callers can ask for a subset)
+HYDRATION_COLUMNS = ('entry_id', 'user_and_entry_id', 'user_id', 'user_entry_id', 'content', 'processed', 'created_at')
+
+
+class EntryCache:
+    def __init__(self, max_entries=None, ttl_seconds=None):
+        """Initialize an LRU cache of entry rows keyed by user_and_entry_id
+
+        Rows are evicted when the vector index logs a change to the entry (in any
+        worker), when this worker updates or deletes it, and after ttl_seconds so
+        edits that never reach the index log are picked up eventually.
+
+        Args:
+            max_entries: Rows kept before the least recently used are evicted (defaults to ENTRY_CACHE_SIZE or 5000)
+            ttl_seconds: Seconds a row is trusted (defaults to ENTRY_CACHE_TTL or 300)
+        """
+        if max_entries is None:
+            max_entries = int(os.environ.get('ENTRY_CACHE_SIZE', 5000))
+        if ttl_seconds is None:
+            ttl_seconds = float(os.environ.get('ENTRY_CACHE_TTL', 300))
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.rows = OrderedDict()  # Maps user_and_entry_id to (row, time cached), least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, entry_ids, user_id):
+        """Look up cached rows belonging to user_id
+
+        Returns:
+            Dictionary mapping each cached entry_id to its row (missing ids were not cached)
+        """
+        user_id = str(user_id)
+        now = time.monotonic()
+        found = {}
+        with self.lock:
+            for entry_id in entry_ids:
+                cached = self.rows.get(entry_id)
+                if cached is None:
+                    continue
+                row, cached_at = cached
+                if now - cached_at > self.ttl_seconds:
+                    del self.rows[entry_id]
+                    continue
+                if str(row.get('user_id')) != user_id:
+                    continue
+                self.rows.move_to_end(entry_id)
+                found[entry_id] = row
+            self.hits += len(found)
+            self.misses += len(entry_ids) - len(found)
+        return found
+
+    def put_many(self, rows):
+        """Cache rows fetched from the database (each needs user_and_entry_id and user_id)"""
+        if self.max_entries <= 0:
+            return
+        now = time.monotonic()
+        with self.lock:
+            for row in rows:
+                entry_id = row.get('user_and_entry_id')
+                if entry_id is None or 'user_id' not in row:
+                    continue
+                self.rows[entry_id] = (row, now)
+                self.rows.move_to_end(entry_id)
+            while len(self.rows) > self.max_entries:
+                self.rows.popitem(last=False)
+
+    def invalidate(self, entry_id):
+        with self.lock:
+            self.rows.pop(entry_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.rows.clear()
+
+    def on_vector_change(self, record, user_ids=None):
+        """Follow changes logged by the vector index (see UserPartitionedIndex.add_listener)"""
+        if record is not None:
+            self.invalidate(record.entry_id)
+        elif user_ids is None:
+            # Changes may have been missed for anyone
+            self.clear()
+        else:
+            with self.lock:
+                for entry_id in [entry_id for entry_id, (row, _) in self.rows.items() if str(row.get('user_id')) in user_ids]:
+                    del self.rows[entry_id]
+
+
+# Global cache instance, registered with the vector index in hnsw_index
+entry_cache = EntryCache()
@@ -0,0 +1,98 @@
+"""
+Allocation of per-user entry ids (user_entry_id, and the user_and_entry_id key
+built from it). Each worker keeps a counter per user, seeded once from the
+user's highest user_entry_id, so allocating an id never reads the user's whole
+history. Workers do not share counters; an insert that collides with an id
+taken by another worker reseeds from the database and retries.
+"""
+
+import os
+import threading
+
+from postgrest.exceptions import APIError
+
+__all__ = ['EntryIdAllocator', 'entry_id_allocator']
+
+# Postgres error code of a unique constraint violation
+_UNIQUE_VIOLATION = '23505'
+
+
+class EntryIdAllocator:
+    def __init__(self, max_attempts=None):
+        """Initialize per-user entry id counters
+
+        Args:
+            max_attempts: Inserts tried before a conflict is raised to the caller
+                (defaults to ENTRY_ID_MAX_ATTEMPTS or 5)
+        """
+        if max_attempts is None:
+            max_attempts = int(os.environ.get('ENTRY_ID_MAX_ATTEMPTS', 5))
+        self.max_attempts = max_attempts
+        self.counters = {}  # Maps user_id to the last user_entry_id handed out by this worker
+        self.user_locks = {}  # Maps user_id to the lock guarding its counter
+        self.lock = threading.Lock()  # Guards user_locks
+
+    def _user_lock(self, user_id):
+        with self.lock:
+            lock = self.user_locks.get(user_id)
+            if lock is None:
+                lock = self.user_locks[user_id] = threading.Lock()
+            return lock
+
+    def _highest_id(self, client, user_id):
+        """The user's highest user_entry_id in the database (0 if they have no entries)"""
+        response = client.table('entries').select('user_entry_id').eq('user_id', user_id)\
+            .order('user_entry_id', desc=True).limit(1).execute()
+        return response.data[0]['user_entry_id'] if response.data else 0
+
+    def allocate(self, client, user_id, reseed=False):
+        """Hand out the user's next user_entry_id
+
+        Args:
+            client: Supabase client that can read the user's entries
+            user_id: Owner of the new entry
+            reseed: Read the highest id from the database again (after a conflict)
+        """
+        user_id = str(user_id)
+        with self._user_lock(user_id):
+            if reseed or user_id not in self.counters:
+                highest = self._highest_id(client, user_id)
+                # Never go back below an id this worker already handed out
+                self.counters[user_id] = max(highest, self.counters.get(user_id, 0))
+            self.counters[user_id] += 1
+            return self.counters[user_id]
+
+    def insert_entry(self, client, user_id, fields):
+        """Insert a new entry under the user's next free id
+
+        If another worker inserted the same id first, the counter is reseeded
+        from the database and the insert retried.
+
+        Args:
+            client: Supabase client to insert with
+            user_id: Owner of the new entry
+            fields: Other columns of the entry
+
+        Returns:
+            The insert response
+        """
+        reseed = False
+        for attempt in range(self.max_attempts):
+            user_entry_id = self.allocate(client, user_id, reseed=reseed)
+            entry_data = {
+                'user_id': user_id,
+                'user_entry_id': user_entry_id,
+                'user_and_entry_id': f"{user_id}_{user_entry_id}",
+                **fields
+            }
+            try:
+                return client.table('entries').insert(entry_data).execute()
+            except APIError as e:
+                if e.code != _UNIQUE_VIOLATION or attempt == self.max_attempts - 1:
+                    raise
+                print(f"[entry_ids] Entry id {user_id}_{user_entry_id} was taken by another worker, retrying")
+                reseed = True
+
+
+# Global allocator used by the routes that create entries
+entry_id_allocator = EntryIdAllocator()
@@ -0,0 +1,502 @@
+"""
+Background post-processing of new entries: process the text, embed it, save
+both and add the entry to the vector index. A fixed pool of worker threads
+shares one Supabase client and takes jobs from a bounded queue, so a burst of
+saves queues up instead of starting a thread (and a client) per request, and a
+full queue is reported to the caller instead of growing without bound. Failed
+steps are retried with jittered exponential backoff.
+
+Text is processed one entry at a time, but entries processed within a short
+window are embedded with one request, saved with one conditional update per
+entry and indexed with one add_items call per user.
+
+Every job is recorded in the job journal until it finishes, and recover() picks
+up jobs lost with a worker as well as entries that never got vectors at all.
+"""
+
+import os
+import queue
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+from tenacity import Retrying, retry_if_exception_type, retry_if_result, stop_after_attempt, wait_random_exponential
+
+from backend.services.job_journal import job_journal
+from backend.services.locks import file_lock
+
+__all__ = ['EntryProcessor', 'ProcessingQueueFull', 'entry_processor']
+
+# Steps of a job, in order, with latency tracked for each
+STAGES = ('process', 'embed', 'save', 'index')
+
+# Recent latencies kept per stage for percentiles
+_LATENCY_WINDOW = 500
+
+
+class ProcessingQueueFull(Exception):
+    """Raised when no job slot frees up in time; the caller should answer 503"""
+
+
+class _LatencyStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=_LATENCY_WINDOW)
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.recent.append(seconds)
+
+    def summary(self):
+        recent = sorted(self.recent)
+
+        def percentile(fraction):
+            return round(recent[min(len(recent) - 1, int(fraction * len(recent)))] * 1000, 1) if recent else None
+
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total / self.count * 1000, 1) if self.count else None,
+            'p50_ms': percentile(0.5),
+            'p95_ms': percentile(0.95),
+            'max_ms': round(self.max * 1000, 1),
+        }
+
+
+class _Slot:
+    """A reserved place in the queue, released unless a job is submitted into it"""
+
+    def __init__(self, processor):
+        self.processor = processor
+        self.submitted = False
+        self.released = False
+
+    def submit(self, entry_id, content, user_id, created_at=None, processed=None, record=True):
+        """Queue an entry for processing (at most once per slot)
+
+        Args:
+            content: Text of the entry, None to read the entry from the database
+            processed: Processed text if the entry was processed already
+            record: Record the job in the journal (False if it was claimed from it)
+        """
+        if self.submitted or self.released:
+            raise RuntimeError("This slot was already used or released")
+        self.submitted = True
+        if record:
+            self.processor.journal.add(entry_id, user_id, created_at)
+        self.processor._enqueue((entry_id, content, user_id, created_at, processed, time.perf_counter()))
+
+    def release(self):
+        """Give the slot back unless a job was submitted into it (safe to call more than once)"""
+        if not self.submitted and not self.released:
+            self.released = True
+            self.processor._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+class EntryProcessor:
+    def __init__(self, workers=None, capacity=None, enqueue_timeout=None, attempts=None, journal=None,
+                 batch_window=None, batch_size=None):
+        """Initialize a pool of workers that process, embed and index new entries
+
+        Args:
+            workers: Worker threads (defaults to ENTRY_PROCESSING_WORKERS or 4)
+            capacity: Jobs queued or running at once (defaults to ENTRY_PROCESSING_QUEUE_SIZE or 256)
+            enqueue_timeout: Seconds a request waits for a free slot before giving up
+                (defaults to ENTRY_PROCESSING_ENQUEUE_TIMEOUT or 2)
+            attempts: Tries per step before it is given up on (defaults to ENTRY_PROCESSING_ATTEMPTS or 4)
+            journal: JobJournal recording the jobs (defaults to the global journal)
+            batch_window: Seconds processed entries are gathered for one embeddings request
+                (defaults to ENTRY_BATCH_WINDOW_MS / 1000 or 0.1)
+            batch_size: Most entries per batch (defaults to ENTRY_BATCH_SIZE or 64)
+        """
+        if workers is None:
+            workers = int(os.environ.get('ENTRY_PROCESSING_WORKERS', 4))
+        if capacity is None:
+            capacity = int(os.environ.get('ENTRY_PROCESSING_QUEUE_SIZE', 256))
+        if enqueue_timeout is None:
+            enqueue_timeout = float(os.environ.get('ENTRY_PROCESSING_ENQUEUE_TIMEOUT', 2))
+        if attempts is None:
+            attempts = int(os.environ.get('ENTRY_PROCESSING_ATTEMPTS', 4))
+        if batch_window is None:
+            batch_window = float(os.environ.get('ENTRY_BATCH_WINDOW_MS', 100)) / 1000
+        if batch_size is None:
+            batch_size = int(os.environ.get('ENTRY_BATCH_SIZE', 64))
+        self.workers = workers
+        self.capacity = capacity
+        self.enqueue_timeout = enqueue_timeout
+        self.attempts = attempts
+        self.journal = journal or job_journal
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.jobs = queue.Queue()
+        self.ready = queue.Queue()  # Processed entries waiting to be embedded in a batch
+        self.slots = threading.BoundedSemaphore(capacity)  # Bounds jobs queued or running
+        self.lock = threading.Lock()  # Guards the threads, client and counters
+        self.threads = []
+        self.client = None
+        self.busy = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.recovered = 0
+        self.batches = 0
+        self.batched = 0
+        self.queue_wait = _LatencyStats()
+        self.stages = {stage: _LatencyStats() for stage in STAGES}
+
+    def slot(self, timeout=None):
+        """Reserve room for one job, waiting up to enqueue_timeout seconds for it
+
+        Reserve before writing the entry, so a full queue is reported before
+        anything is saved, then submit into the slot or release it:
+
+            with entry_processor.slot() as slot:
+                ...insert the entry...
+                slot.submit(entry_id, content, user_id, created_at)
+
+        Raises:
+            ProcessingQueueFull: If every slot stays taken for the whole wait
+        """
+        if not self.slots.acquire(timeout=self.enqueue_timeout if timeout is None else timeout):
+            with self.lock:
+                self.rejected += 1
+            raise ProcessingQueueFull(f"Entry processing queue is full ({self.capacity} jobs)")
+        return _Slot(self)
+
+    def submit(self, entry_id, content, user_id, created_at=None, timeout=None):
+        """Reserve a slot and queue an entry in one go (raises ProcessingQueueFull)"""
+        with self.slot(timeout) as slot:
+            slot.submit(entry_id, content, user_id, created_at)
+
+    def _release(self):
+        self.slots.release()
+
+    def _enqueue(self, job):
+        self._start()
+        with self.lock:
+            self.submitted += 1
+        self.jobs.put(job)
+
+    def _start(self):
+        # Started on first use, so importing the module never spawns threads
+        with self.lock:
+            if self.threads:
+                return
+            for number in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"entry-processing-{number}")
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+            thread = threading.Thread(target=self._batch_work, name="entry-processing-batches")
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _supabase(self):
+        with self.lock:
+            if self.client is None:
+                from backend.services.hnsw_index import create_service_client
+                self.client = create_service_client()
+            return self.client
+
+    def _work(self):
+        while True:
+            entry_id, content, user_id, created_at, processed, queued = self.jobs.get()
+            with self.lock:
+                self.busy += 1
+                self.queue_wait.record(time.perf_counter() - queued)
+            prepared = False
+            try:
+                prepared = self._prepare(entry_id, content, user_id, created_at, processed)
+            except Exception as e:
+                print(f"[entry_processing] ERROR: Processing entry {entry_id} failed: {str(e)}")
+            finally:
+                with self.lock:
+                    self.busy -= 1
+            if isinstance(prepared, dict):
+                self.ready.put(prepared)
+            else:
+                self._finish([entry_id], prepared)
+
+    def _batch_work(self):
+        """Embed, save and index processed entries in batches of those ready within batch_window"""
+        while True:
+            batch = [self.ready.get()]
+            deadline = time.perf_counter() + self.batch_window
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.ready.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            with self.lock:
+                self.batches += 1
+                self.batched += len(batch)
+            try:
+                self._embed_batch(batch)
+            except Exception as e:
+                print(f"[entry_processing] ERROR: Embedding a batch of {len(batch)} entries failed: {str(e)}")
+                self._finish([item['entry_id'] for item in batch], False)
+
+    def _finish(self, entry_ids, ok):
+        """Close the jobs of entry_ids in the journal and free their slots"""
+        for entry_id in entry_ids:
+            if ok:
+                self.journal.done(entry_id)
+            else:
+                self.journal.failed(entry_id)
+            with self.lock:
+                if ok:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+            self._release()
+
+    def _retrying(self, on_none=False):
+        """tenacity retry policy of a step, retrying exceptions (and None results if on_none)"""
+        retry = retry_if_exception_type(Exception)
+        if on_none:
+            retry = retry | retry_if_result(lambda result: result is None)
+        return Retrying(
+            retry=retry,
+            wait=wait_random_exponential(multiplier=0.5, max=30),
+            stop=stop_after_attempt(self.attempts),
+            # The last result (None) is returned, or its exception raised, once attempts run out
+            retry_error_callback=lambda state: state.outcome.result(),
+        )
+
+    def _timed(self, stage, function, *args, on_none=False):
+        started = time.perf_counter()
+        try:
+            return self._retrying(on_none)(function, *args)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.stages[stage].record(elapsed)
+
+    def _prepare(self, entry_id, content, user_id, created_at, processed=None):
+        """Process one entry's content, skipping whatever was done before
+
+        Returns:
+            The entry ready for embedding (a dictionary), True if nothing is left to
+            do (the entry was deleted meanwhile) or False if processing failed
+        """
+        from backend.services.initial_processing import process_text
+        from backend.services.hnsw_index import extract_vectors, index as vector_index
+        from backend.services.lexical_index import lexical_index
+
+        supabase = self._supabase()
+        if supabase is None:
+            return False
+
+        embedding = None
+        if content is None:
+            # Recovered job: pick up wherever the entry got to
+            response = supabase.table('entries').select('content, processed, vectors, created_at')\
+                .eq('user_and_entry_id', entry_id).execute()
+            if not response.data:
+                return True
+            entry = response.data[0]
+            content, processed, created_at = entry.get('content') or '', entry.get('processed'), entry.get('created_at')
+            if entry.get('vectors') is not None:
+                entry_ids, vectors = extract_vectors([{'user_and_entry_id': entry_id, 'vectors': entry['vectors']}], vector_index.dim)
+                embedding = vectors[0].tolist() if entry_ids else None
+
+        # Step 1: Process content through OpenAI
+        processed_content = processed if processed is not None else self._timed('process', process_text, content, on_none=True)
+        if processed_content is None:
+            print(f"[entry_processing] WARNING: Processing failed for entry {entry_id}, skipping vectorization")
+            return False
+        if not processed_content.strip():
+            # Empty entries have nothing to embed or index
+            return True
+        if processed is None:
+            lexical_index.upsert_entry(user_id, entry_id, content=content, processed=processed_content)
+        return {'entry_id': entry_id, 'user_id': user_id, 'created_at': created_at,
+                'processed': processed_content, 'embedding': embedding}
+
+    def _embed_batch(self, batch):
+        """Run the remaining steps for a batch of processed entries
+
+        Flow: 2. Vectorize processed content (one request) -> 3. Save -> 4. Add to index (one add_items per user)
+        """
+        from backend.services.embedding import generate_embeddings
+        from backend.services.hnsw_index import add_entries_to_index
+
+        # Entries recovered with vectors already saved only need indexing
+        to_embed = [item for item in batch if item['embedding'] is None]
+        if to_embed:
+            # Step 2: Generate embeddings from processed content
+            embeddings = self._timed('embed', generate_embeddings, [item['processed'] for item in to_embed], on_none=True)
+            for item, embedding in zip(to_embed, embeddings or []):
+                item['embedding'] = embedding
+
+            # Step 3: Save; processed content is kept even if embedding failed
+            saved = self._timed('save', self._save_batch, to_embed)
+
+            # Entries deleted before the save have nothing left to do and must not be indexed
+            deleted = {item['entry_id'] for item in to_embed if item['entry_id'] not in saved}
+            self._finish(list(deleted), True)
+            batch = [item for item in batch if item['entry_id'] not in deleted]
+
+        embedded = [item for item in batch if item['embedding']]
+        failed = [item['entry_id'] for item in batch if not item['embedding']]
+        if failed:
+            print(f"[entry_processing] WARNING: Embedding generation failed for {len(failed)} entries")
+
+        # Step 4: Add entries to the index (a failure schedules a reconcile of the users' indexes)
+        if embedded:
+            self._timed('index', add_entries_to_index, [
+                (item['entry_id'], item['embedding'], item['user_id'], item['created_at']) for item in embedded
+            ])
+        self._finish([item['entry_id'] for item in embedded], True)
+        self._finish(failed, False)
+
+    def _save_batch(self, items):
+        """Write processed content and vectors into a batch of existing entries with one UPDATE
+
+        Returns:
+            Set of the entry_ids written (entries deleted meanwhile are not)
+        """
+        from backend.services.embedding import update_entry_vectors
+
+        return set(update_entry_vectors(self._supabase(), [item['entry_id'] for item in items],
+                                        [item['embedding'] for item in items],
+                                        processed=[item['processed'] for item in items]))
+
+    def _free_slots(self, limit):
+        """Reserve up to limit slots without waiting"""
+        slots = []
+        while len(slots) < limit:
+            if not self.slots.acquire(blocking=False):
+                break
+            slots.append(_Slot(self))
+        return slots
+
+    def resume(self, limit=None):
+        """Queue journaled jobs due for a retry or orphaned by a worker that died
+
+        Returns:
+            Number of jobs queued
+        """
+        slots = self._free_slots(self.capacity if limit is None else limit)
+        try:
+            claimed = self.journal.claim(len(slots)) if slots else []
+            for slot, (entry_id, user_id, created_at) in zip(slots, claimed):
+                slot.submit(entry_id, None, user_id, created_at, record=False)
+            return len(claimed)
+        finally:
+            for slot in slots:
+                slot.release()
+
+    def sweep_orphans(self, limit=None, grace_seconds=None):
+        """Queue entries that never got vectors and have no job in the journal
+
+        Entries created in the last grace_seconds are left alone, as they may
+        still be in flight on another host. Entries whose job was given up on
+        are skipped. One worker per host sweeps at a time.
+
+        Args:
+            limit: Most entries to queue (defaults to the free slots)
+            grace_seconds: Minimum age of an entry (defaults to ENTRY_SWEEP_GRACE or 120)
+
+        Returns:
+            Number of entries queued
+        """
+        if grace_seconds is None:
+            grace_seconds = float(os.environ.get('ENTRY_SWEEP_GRACE', 120))
+        page_size = int(os.environ.get('ENTRY_SWEEP_PAGE_SIZE', 200))
+        lock_path = os.path.join(os.path.dirname(self.journal.path) or 'instance', 'entry_sweep.lock')
+        with file_lock(lock_path, blocking=False) as acquired:
+            if not acquired:
+                return 0
+            supabase = self._supabase()
+            if supabase is None:
+                return 0
+            cutoff = (datetime.now(timezone.utc) - timedelta(seconds=grace_seconds)).isoformat()
+            slots = self._free_slots(self.capacity if limit is None else limit)
+            queued = 0
+            last_entry_id = None
+            try:
+                while queued < len(slots):
+                    query = supabase.table('entries').select('user_and_entry_id, user_id, content, processed, created_at')\
+                        .is_('vectors', 'null').lt('created_at', cutoff)
+                    if last_entry_id is not None:
+                        query = query.gt('user_and_entry_id', last_entry_id)
+                    response = query.order('user_and_entry_id').limit(page_size).execute()
+                    page = response.data if response.data else []
+                    known = self.journal.known(entry['user_and_entry_id'] for entry in page)
+                    for entry in page:
+                        if queued == len(slots):
+                            break
+                        if entry['user_and_entry_id'] in known or not (entry.get('content') or entry.get('processed')):
+                            continue
+                        slots[queued].submit(entry['user_and_entry_id'], entry.get('content') or '', entry['user_id'],
+                                             entry.get('created_at'), processed=entry.get('processed'))
+                        queued += 1
+                    if len(page) < page_size:
+                        break
+                    last_entry_id = page[-1]['user_and_entry_id']
+            finally:
+                for slot in slots:
+                    slot.release()
+            return queued
+
+    def recover(self):
+        """Resume journaled jobs, then sweep for orphaned entries (run at startup and periodically)
+
+        Returns:
+            Dictionary with the number of jobs 'resumed' and orphans 'swept', or None if it failed
+        """
+        try:
+            resumed = self.resume()
+            swept = self.sweep_orphans()
+        except Exception as e:
+            print(f"[entry_processing] ERROR: Recovering jobs failed: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            return None
+        with self.lock:
+            self.recovered += resumed + swept
+        if resumed or swept:
+            print(f"[entry_processing] Resumed {resumed} journaled jobs, queued {swept} entries without vectors")
+        return {'resumed': resumed, 'swept': swept}
+
+    def stats(self):
+        """Queue depth, worker use, job counts and per-stage latency"""
+        with self.lock:
+            return {
+                'queue_depth': self.jobs.qsize(),
+                'batch_queue_depth': self.ready.qsize(),
+                'capacity': self.capacity,
+                'workers': self.workers,
+                'busy_workers': self.busy,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'recovered': self.recovered,
+                'batches': self.batches,
+                'mean_batch_size': round(self.batched / self.batches, 1) if self.batches else None,
+                'journal': self.journal.counts(),
+                'queue_wait': self.queue_wait.summary(),
+                'stages': {stage: stats.summary() for stage, stats in self.stages.items()},
+            }
+
+
+# Global processor shared by every route that saves entries
+entry_processor = EntryProcessor()
@@ -0,0 +1,592 @@
+"""
+Exact (brute-force) vector index for small per-user corpora.
+Keeps a user's vectors in one contiguous float32 matrix and ranks them with a
+single matrix-vector product, which beats a graph walk for a few thousand entries.
+Optionally scans a compact int8/float16 copy instead and re-ranks the best
+candidates at full precision, so the float32 matrix can stay on disk. The
+compact copy and the calibrated rerank_factor are saved with each snapshot, so
+loading one reads neither the whole float32 matrix nor re-encodes it.
+"""
+
+import numpy as np
+import os
+import pickle
+
+from backend.services.locks import ReadWriteLock
+
+__all__ = ['ExactIndex', 'QUANTIZATIONS', 'in_created_range']
+
+QUANTIZATIONS = ('float16', 'int8')
+
+# Rows converted to float32 at a time when scanning quantized vectors, which
+# bounds the temporary memory a search needs
+_SCAN_CHUNK_ROWS = 1024
+
+# Rows calibrate() measures recall over, so calibrating a large index stays cheap
+_CALIBRATION_ROWS = 4096
+
+
+def in_created_range(timestamps, created_range):
+    """Mask of timestamps inside created_range
+
+    Args:
+        timestamps: Array of epoch seconds (NaN for unknown, which never matches)
+        created_range: (start, end) epoch seconds, start inclusive and end exclusive,
+            either of which may be None for an open end
+    """
+    start, end = created_range
+    start = -np.inf if start is None else start
+    end = np.inf if end is None else end
+    return (timestamps >= start) & (timestamps < end)
+
+
+class ExactIndex:
+    def __init__(self, dim=1536, initial_capacity=256, quantization=None, rerank_factor=4, min_recall=None):
+        """Initialize exact index
+
+        Args:
+            dim: Dimensionality of vectors (1536 for OpenAI embeddings)
+            initial_capacity: Number of rows to allocate before the first resize
+            quantization: None to scan the float32 vectors, or 'float16'/'int8' to scan a
+                compact copy and re-rank the best candidates with the float32 vectors
+            rerank_factor: Candidates re-ranked at full precision per requested result
+            min_recall: Recall@k against full-precision search that calibrate() enforces
+        """
+        if quantization is not None and quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unsupported quantization: {quantization}")
+        self.dim = dim
+        self.initial_capacity = initial_capacity
+        self.quantization = quantization
+        self.rerank_factor = rerank_factor
+        self.min_recall = min_recall
+        self.vectors = None  # Unit-normalized rows, only the first len(id_to_entry_id) are in use
+        self.vectors_file = None  # Open snapshot file that quantized search reads re-ranked rows from
+        self.codes = None  # Quantized copy of vectors, row for row (quantized mode only)
+        self.scales = None  # Per-row factors turning int8 codes back into similarities
+        self.created_at = None  # Creation time of each row in epoch seconds (NaN if unknown)
+        self.id_to_entry_id = {}  # Maps matrix row numbers to database entry_ids
+        self.entry_id_to_id = {}  # Maps database entry_ids to matrix row numbers
+        # Searches share the read lock (NumPy releases the GIL during the product),
+        # writers that may reallocate the matrix take the write lock
+        self.lock = ReadWriteLock()
+
+    @property
+    def index(self):
+        """Matches HNSWIndex.index so callers can check whether anything is loaded"""
+        return self.vectors
+
+    def _normalize(self, vectors):
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def _quantize(self, rows):
+        """Encode unit-normalized float32 rows as (codes, scales)"""
+        if self.quantization == 'float16':
+            return rows.astype(np.float16), None
+        # Symmetric per-row int8: the largest component maps to 127
+        scales = np.abs(rows).max(axis=-1)
+        scales[scales == 0] = 1.0
+        codes = np.round(rows / scales[:, None] * 127).astype(np.int8)
+        return codes, (scales / 127).astype(np.float32)
+
+    def _encode_all(self):
+        # Chunked so a memory-mapped matrix is never copied into memory whole
+        count = len(self.vectors)
+        self.codes = np.zeros((count, self.dim), dtype=np.int8 if self.quantization == 'int8' else np.float16)
+        self.scales = np.zeros(count, dtype=np.float32) if self.quantization == 'int8' else None
+        for start in range(0, count, _SCAN_CHUNK_ROWS):
+            stop = min(start + _SCAN_CHUNK_ROWS, count)
+            codes, scales = self._quantize(np.asarray(self.vectors[start:stop], dtype=np.float32))
+            self.codes[start:stop] = codes
+            if scales is not None:
+                self.scales[start:stop] = scales
+
+    def _set_rows(self, start, rows):
+        """Store unit-normalized rows starting at row number start"""
+        self.vectors[start:start + len(rows)] = rows
+        if self.quantization:
+            codes, scales = self._quantize(rows)
+            self.codes[start:start + len(rows)] = codes
+            if scales is not None:
+                self.scales[start:start + len(rows)] = scales
+
+    def _set_created_at(self, start, created_at, count):
+        if created_at is None:
+            self.created_at[start:start + count] = np.nan
+        else:
+            self.created_at[start:start + count] = np.asarray(created_at, dtype=np.float64)
+
+    def _move_row(self, source, target):
+        self.vectors[target] = self.vectors[source]
+        self.created_at[target] = self.created_at[source]
+        if self.codes is not None:
+            self.codes[target] = self.codes[source]
+        if self.scales is not None:
+            self.scales[target] = self.scales[source]
+
+    def _grow(self, array, capacity, fill=0):
+        grown = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+        grown[:array.shape[0]] = array
+        return grown
+
+    def _map_snapshot(self, vectors):
+        """Serve vectors from a memory-mapped snapshot (call with the write lock held)"""
+        self._close_snapshot()
+        self.vectors = vectors
+        if self.quantization:
+            # Holding the file open keeps it readable after a checkpoint deletes it
+            self.vectors_file = open(vectors.filename, 'rb')
+
+    def _close_snapshot(self):
+        if self.vectors_file is not None:
+            self.vectors_file.close()
+            self.vectors_file = None
+
+    def _read_rows(self, rows):
+        """Full-precision copies of the given rows
+
+        Quantized indexes read them from the snapshot file instead of the mapping:
+        faulting in a few scattered rows maps whole page cache folios around each
+        one, which would make most of the float32 matrix resident after a while.
+        """
+        if self.vectors_file is None:
+            return np.asarray(self.vectors[rows], dtype=np.float32)
+        row_bytes = self.dim * self.vectors.itemsize
+        fd = self.vectors_file.fileno()
+        data = b''.join(os.pread(fd, row_bytes, self.vectors.offset + int(row) * row_bytes) for row in rows)
+        return np.frombuffer(data, dtype=self.vectors.dtype).reshape(len(rows), self.dim).astype(np.float32)
+
+    def _make_writable(self):
+        # A memory-mapped snapshot is shared read-only with other workers, so the
+        # first write in this process copies it into private memory
+        if isinstance(self.vectors, np.memmap):
+            self.vectors = np.array(self.vectors, dtype=np.float32)
+            self._close_snapshot()
+        if isinstance(self.codes, np.memmap):
+            self.codes = np.array(self.codes)
+        if isinstance(self.scales, np.memmap):
+            self.scales = np.array(self.scales)
+
+    def _ensure_capacity(self, count):
+        if self.vectors is None:
+            capacity = max(self.initial_capacity, count)
+            self.vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+            self.created_at = np.full(capacity, np.nan)
+            if self.quantization:
+                self._encode_all()
+        elif count > self.vectors.shape[0]:
+            # Double the allocation so appends stay amortized O(1)
+            capacity = max(self.vectors.shape[0] * 2, count)
+            self.vectors = self._grow(self.vectors, capacity)
+            self._close_snapshot()
+            self.created_at = self._grow(self.created_at, capacity, fill=np.nan)
+            if self.codes is not None:
+                self.codes = self._grow(self.codes, capacity)
+            if self.scales is not None:
+                self.scales = self._grow(self.scales, capacity)
+        else:
+            self._make_writable()
+
+    def build_from_vectors(self, entry_ids, vectors, created_at=None):
+        """Replace the index contents with the given vectors
+
+        Args:
+            entry_ids: Database entry_ids, one per row of vectors
+            vectors: float32 array of shape (len(entry_ids), dim)
+            created_at: Optional creation times in epoch seconds, one per row
+        """
+        normalized = self._normalize(np.asarray(vectors, dtype=np.float32))
+        with self.lock.write_lock():
+            self._close_snapshot()
+            self.vectors = None
+            self._ensure_capacity(len(entry_ids))
+            self._set_rows(0, normalized)
+            self._set_created_at(0, created_at, len(entry_ids))
+            self.id_to_entry_id = dict(enumerate(entry_ids))
+            self.entry_id_to_id = {entry_id: i for i, entry_id in enumerate(entry_ids)}
+        self.calibrate()
+        print(f"Built exact index with {len(entry_ids)} vectors")
+        return True
+
+    def add_entry(self, entry_id, vector, created_at=None):
+        """Add a single entry to the index (for incremental updates)
+
+        Args:
+            entry_id: Database entry_id
+            vector: Embedding vector for the entry
+            created_at: Entry creation time in epoch seconds, or None if unknown
+        """
+        with self.lock.write_lock():
+            return self._add_entry_locked(entry_id, vector, created_at)
+
+    def _add_entry_locked(self, entry_id, vector, created_at=None):
+        if entry_id in self.entry_id_to_id:
+            # Entry already in index, skip
+            return False
+
+        row = len(self.id_to_entry_id)
+        self._ensure_capacity(row + 1)
+        self._set_rows(row, self._normalize(np.asarray(vector, dtype=np.float32).reshape(1, -1)))
+        self._set_created_at(row, created_at, 1)
+
+        self.id_to_entry_id[row] = entry_id
+        self.entry_id_to_id[entry_id] = row
+        return True
+
+    def add_entries(self, entry_ids, vectors, created_at=None):
+        """Append a batch of entries (for streaming builds)
+
+        Args:
+            entry_ids: Database entry_ids, one per row of vectors
+            vectors: float32 array of shape (len(entry_ids), dim)
+            created_at: Optional creation times in epoch seconds, one per row
+
+        Returns:
+            Number of entries added (entries already in the index are skipped)
+        """
+        with self.lock.write_lock():
+            new_rows = [i for i, entry_id in enumerate(entry_ids) if entry_id not in self.entry_id_to_id]
+            if not new_rows:
+                return 0
+
+            start = len(self.id_to_entry_id)
+            self._ensure_capacity(start + len(new_rows))
+            self._set_rows(start, self._normalize(np.asarray(vectors, dtype=np.float32)[new_rows]))
+            self._set_created_at(start, None if created_at is None else np.asarray(created_at, dtype=np.float64)[new_rows], len(new_rows))
+            for row, i in enumerate(new_rows, start):
+                self.id_to_entry_id[row] = entry_ids[i]
+                self.entry_id_to_id[entry_ids[i]] = row
+            return len(new_rows)
+
+    def update_entry(self, entry_id, vector, created_at=None):
+        """Replace an entry's vector in place (after it is re-embedded)
+
+        Args:
+            entry_id: Database entry_id
+            vector: New embedding vector for the entry
+            created_at: Entry creation time in epoch seconds (keeps the stored time if None)
+        """
+        with self.lock.write_lock():
+            if entry_id not in self.entry_id_to_id:
+                return self._add_entry_locked(entry_id, vector, created_at)
+
+            self._make_writable()
+            row = self.entry_id_to_id[entry_id]
+            self._set_rows(row, self._normalize(np.asarray(vector, dtype=np.float32).reshape(1, -1)))
+            if created_at is not None:
+                self._set_created_at(row, created_at, 1)
+            return True
+
+    def delete_entry(self, entry_id):
+        """Remove an entry by moving the last row into its slot (no tombstones needed)
+
+        Args:
+            entry_id: Database entry_id
+        """
+        with self.lock.write_lock():
+            row = self.entry_id_to_id.pop(entry_id, None)
+            if row is None:
+                return False
+
+            last = len(self.id_to_entry_id) - 1
+            if row != last:
+                self._make_writable()
+                moved_entry_id = self.id_to_entry_id[last]
+                self._move_row(last, row)
+                self.id_to_entry_id[row] = moved_entry_id
+                self.entry_id_to_id[moved_entry_id] = row
+            del self.id_to_entry_id[last]
+            return True
+
+    def search(self, query_vector, k=5, created_range=None):
+        """Search for the exact k nearest neighbors to query_vector
+
+        Args:
+            query_vector: Vector to search for
+            k: Number of nearest neighbors to return
+            created_range: Optional (start, end) epoch seconds; only entries created in
+                that range are scanned (see in_created_range)
+
+        Returns:
+            List of dictionaries with entry_id and distance, most similar first
+        """
+        query = self._normalize(np.asarray(query_vector, dtype=np.float32))
+
+        with self.lock.read_lock():
+            count = len(self.id_to_entry_id)
+            if self.vectors is None or count == 0:
+                return []
+
+            rows = None
+            if created_range is not None:
+                rows = np.flatnonzero(in_created_range(self.created_at[:count], created_range))
+                if len(rows) == 0:
+                    return []
+
+            top, scores = self._top_k(query, k, count, rows)
+            order = np.argsort(-scores)
+            return self._to_results(top[order], scores[order])
+
+    def _top_k(self, query, k, count, rows=None, rerank_factor=None):
+        """Find the k best rows, out of every row or only the given (sorted) row numbers
+
+        Args:
+            rerank_factor: Candidates re-ranked per result in quantized search (defaults to self.rerank_factor)
+
+        Returns:
+            Tuple of (row numbers, similarities), unordered
+        """
+        num_rows = count if rows is None else len(rows)
+        # argpartition finds the top k in O(n), then only those k get sorted
+        k = min(k, num_rows)
+        if self.codes is None:
+            similarities = (self.vectors[:count] if rows is None else self.vectors[rows]) @ query
+            top = np.argpartition(-similarities, k - 1)[:k]
+            return (top if rows is None else rows[top]), similarities[top]
+
+        # Scan the compact copy, then re-rank the best candidates at full
+        # precision (reading rows in file order keeps memory-mapped reads local)
+        if rows is None:
+            coarse = self._coarse_similarities(query, count)
+        else:
+            coarse = self.codes[rows].astype(np.float32) @ query
+            if self.scales is not None:
+                coarse *= self.scales[rows]
+        num_candidates = min(num_rows, k * (rerank_factor or self.rerank_factor))
+        candidates = np.sort(np.argpartition(-coarse, num_candidates - 1)[:num_candidates])
+        if rows is not None:
+            candidates = rows[candidates]
+        exact = self._read_rows(candidates) @ query
+        best = np.argpartition(-exact, k - 1)[:k]
+        return candidates[best], exact[best]
+
+    def search_batch(self, query_vectors, k=5, created_range=None):
+        """Search for the exact k nearest neighbors of several queries at once
+
+        Args:
+            query_vectors: Array of shape (num_queries, dim)
+            k: Number of nearest neighbors to return per query
+            created_range: Optional (start, end) epoch seconds, as for search()
+
+        Returns:
+            One list of results per query, as returned by search()
+        """
+        queries = self._normalize(np.atleast_2d(np.asarray(query_vectors, dtype=np.float32)))
+        if self.codes is not None:
+            # Each query re-ranks different rows, so quantized search goes one at a time
+            return [self.search(query, k=k, created_range=created_range) for query in queries]
+
+        with self.lock.read_lock():
+            count = len(self.id_to_entry_id)
+            if self.vectors is None or count == 0:
+                return [[] for _ in queries]
+
+            if created_range is None:
+                rows = np.arange(count)
+                vectors = self.vectors[:count]
+            else:
+                rows = np.flatnonzero(in_created_range(self.created_at[:count], created_range))
+                if len(rows) == 0:
+                    return [[] for _ in queries]
+                vectors = self.vectors[rows]
+
+            # One matrix product scores every query against every row
+            similarities = queries @ vectors.T
+            k = min(k, len(rows))
+            tops = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+
+            results = []
+            for top, row_similarities in zip(tops, similarities):
+                scores = row_similarities[top]
+                order = np.argsort(-scores)
+                results.append(self._to_results(rows[top[order]], scores[order]))
+            return results
+
+    def _to_results(self, rows, similarities):
+        results = []
+        for row, similarity in zip(rows, similarities):
+            similarity = float(similarity)
+            results.append({
+                'entry_id': self.id_to_entry_id[int(row)],
+                'distance': 1.0 - similarity,
+                'similarity': similarity
+            })
+        return results
+
+    def _coarse_similarities(self, query, count):
+        similarities = np.empty(count, dtype=np.float32)
+        for start in range(0, count, _SCAN_CHUNK_ROWS):
+            stop = min(start + _SCAN_CHUNK_ROWS, count)
+            similarities[start:stop] = self.codes[start:stop].astype(np.float32) @ query
+        if self.scales is not None:
+            similarities *= self.scales[:count]
+        return similarities
+
+    def calibrate(self, k=5, num_queries=32, sample_rows=_CALIBRATION_ROWS):
+        """Raise rerank_factor until quantized search meets min_recall
+
+        Recall@k is measured against full-precision search over a sample of the
+        rows, using vectors from that sample as queries. Run when the index is
+        built or saved; load() restores the calibrated factor instead.
+
+        Args:
+            k: Number of neighbors recall is measured at
+            num_queries: Number of sampled rows used as queries
+            sample_rows: Number of rows searched (all of them in smaller indexes)
+
+        Returns:
+            Measured recall@k (1.0 when not quantized or no bound is configured)
+        """
+        with self.lock.read_lock():
+            count = len(self.id_to_entry_id)
+            if self.codes is None or self.min_recall is None or count <= k:
+                return 1.0
+
+            rng = np.random.default_rng(0)
+            sample = np.sort(rng.choice(count, size=min(sample_rows, count), replace=False))
+            queries = self._read_rows(np.sort(rng.choice(sample, size=min(num_queries, len(sample)), replace=False)))
+            exact = self._read_rows(sample) @ queries.T
+            truth = [set(sample[np.argpartition(-exact[:, i], k - 1)[:k]].tolist()) for i in range(len(queries))]
+
+            # Searches running meanwhile keep the current factor until the write lock below
+            rerank_factor = self.rerank_factor
+            while True:
+                hits = sum(len(truth[i] & set(self._top_k(query, k, count, sample, rerank_factor)[0].tolist())) for i, query in enumerate(queries))
+                recall = hits / (k * len(queries))
+                if recall >= self.min_recall or k * rerank_factor >= len(sample):
+                    break
+                rerank_factor *= 2
+                print(f"[calibrate] Recall@{k} {recall:.3f} is below {self.min_recall}, re-ranking {rerank_factor}x candidates")
+
+        with self.lock.write_lock():
+            self.rerank_factor = max(self.rerank_factor, rerank_factor)
+        return recall
+
+    def get_vectors(self):
+        """Return (entry_ids, vectors, creation times) for every row in the index"""
+        with self.lock.read_lock():
+            count = len(self.id_to_entry_id)
+            entry_ids = [self.id_to_entry_id[i] for i in range(count)]
+            if self.vectors is None:
+                return entry_ids, np.zeros((0, self.dim), dtype=np.float32), np.zeros(0)
+            return entry_ids, np.array(self.vectors[:count], dtype=np.float32), self.created_at[:count].copy()
+
+    def get_created_at(self, entry_id):
+        """Creation time of an entry in epoch seconds (NaN if unknown, None if not indexed)"""
+        with self.lock.read_lock():
+            row = self.entry_id_to_id.get(entry_id)
+            return None if row is None else float(self.created_at[row])
+
+    def save(self, path='exact_index'):
+        """Save index to disk, with the quantized copy and a freshly calibrated rerank_factor"""
+        if self.vectors is None:
+            print("Index not built yet")
+            return False
+
+        dir_path = os.path.dirname(path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+
+        self.calibrate()
+        with self.lock.read_lock():
+            count = len(self.id_to_entry_id)
+            np.save(f"{path}.npy", self.vectors[:count])
+            if self.codes is not None:
+                np.save(f"{path}_codes.npy", self.codes[:count])
+            if self.scales is not None:
+                np.save(f"{path}_scales.npy", self.scales[:count])
+            with open(f"{path}_mappings.pkl", 'wb') as f:
+                pickle.dump({
+                    'id_to_entry_id': self.id_to_entry_id,
+                    'entry_id_to_id': self.entry_id_to_id,
+                    'created_at': self.created_at[:count],
+                    'quantization': self.quantization,
+                    'rerank_factor': self.rerank_factor
+                }, f)
+        return True
+
+    def _load_codes(self, path, mappings, count, mmap):
+        """Quantized copy saved with a snapshot, as (codes, scales), or None if it has to be re-encoded"""
+        # Snapshots written without quantization, or with another one, have no usable copy
+        if not self.quantization or mappings.get('quantization') != self.quantization:
+            return None
+        try:
+            codes = np.load(f"{path}_codes.npy", mmap_mode='r' if mmap else None)
+            scales = np.load(f"{path}_scales.npy", mmap_mode='r' if mmap else None) if self.quantization == 'int8' else None
+        except FileNotFoundError:
+            return None
+        if len(codes) != count or (scales is not None and len(scales) != count):
+            return None
+        return codes, scales
+
+    def remap(self, path):
+        """Serve vectors from a just-saved snapshot instead of private memory
+
+        Call right after save(path) with no writes in between. The private copy made
+        by the first write after a memory-mapped load is released again.
+        """
+        vectors = np.load(f"{path}.npy", mmap_mode='r')
+        codes = np.load(f"{path}_codes.npy", mmap_mode='r') if self.codes is not None else None
+        scales = np.load(f"{path}_scales.npy", mmap_mode='r') if self.scales is not None else None
+        with self.lock.write_lock():
+            count = len(self.id_to_entry_id)
+            if len(vectors) != count:
+                return False
+            self._map_snapshot(vectors)
+            self.created_at = self.created_at[:count].copy()
+            if codes is not None:
+                self.codes = codes
+            if scales is not None:
+                self.scales = scales
+        return True
+
+    def load(self, path='exact_index', mmap=False):
+        """Load index from disk
+
+        Args:
+            path: Path prefix the index was saved under
+            mmap: Map the vectors read-only instead of copying them, so processes
+                loading the same snapshot share its pages (the file must not be
+                rewritten in place while mapped)
+        """
+        try:
+            vectors = np.load(f"{path}.npy", mmap_mode='r' if mmap else None)
+            with open(f"{path}_mappings.pkl", 'rb') as f:
+                mappings = pickle.load(f)
+
+            codes = self._load_codes(path, mappings, len(vectors), mmap)
+            with self.lock.write_lock():
+                if mmap or codes is not None:
+                    if mmap:
+                        self._map_snapshot(vectors)
+                    else:
+                        self._close_snapshot()
+                        self.vectors = vectors
+                    self.created_at = np.full(len(vectors), np.nan)
+                    if codes is not None:
+                        self.codes, self.scales = codes
+                    elif self.quantization:
+                        self._encode_all()
+                else:
+                    self._close_snapshot()
+                    self.vectors = None
+                    self._ensure_capacity(len(vectors))
+                    self._set_rows(0, np.asarray(vectors, dtype=np.float32))
+                # Snapshots written before creation times were indexed have none
+                self.created_at[:len(vectors)] = mappings.get('created_at', np.nan)
+                self.id_to_entry_id = mappings['id_to_entry_id']
+                self.entry_id_to_id = mappings['entry_id_to_id']
+            if codes is not None:
+                self.rerank_factor = max(self.rerank_factor, mappings.get('rerank_factor', self.rerank_factor))
+            else:
+                # Re-encoded from the float32 vectors, which the next save stores
+                self.calibrate()
+            return True
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print(f"Error loading exact index: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            return False
@@ -1,196 +1,439 @@
 import hnswlib
 import numpy as np
+import json
 import os
+import orjson
 import pickle
+import queue
+import threading
+import time
 from flask import current_app
+from backend.services.entry_cache import entry_cache, HYDRATION_COLUMNS
+from backend.services.exact_index import ExactIndex, QUANTIZATIONS, in_created_range
+from backend.services.id_map import EntryIdMap
+from backend.services.locks import ReadWriteLock, file_lock
+from backend.services.index_wal import IndexWAL, WALRecord, OP_ADD, OP_DELETE, OP_UPDATE, write_file_atomic
 # SQLAlchemy references removed - using Supabase
 from supabase import create_client, Client
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 
 # Force reload the .env file to ensure environment variables are loaded
 load_dotenv(override=True)
 
+def create_service_client():
+    """Create a Supabase client with the service role key for index builds"""
+    supabase_url = os.environ.get("SUPABASE_URL")
+    supabase_key = os.environ.get("SUPABASE_SECRET_KEY") 
+
+    if not supabase_url or not supabase_key:
+        print("[build_index] ERROR: Missing Supabase credentials")
+        print(f"[build_index] Supabase URL set: {bool(supabase_url)}, service key present: {bool(supabase_key)}")
+        return None
+    
+    # Service role keys typically start with "eyJ" (JWT) and are much longer than anon keys
+    if not supabase_key.startswith("eyJ"):
+        print("[build_index] WARNING: Service key doesn't start with 'eyJ' - might be anon key instead!")
+    
+    return create_client(supabase_url, supabase_key)
+
+def iter_vectorized_entry_pages(user_id=None, page_size=None):
+    """Stream entries that have vectors from the database, one page at a time
+    
+    Uses keyset pagination on the primary key and only selects the columns the
+    index needs, so memory stays bounded by the page size no matter how large
+    the entries table grows.
+    
+    Args:
+        user_id: Optional user_id to only fetch that user's entries
+        page_size: Rows per request (defaults to INDEX_BUILD_PAGE_SIZE or 500)
+        
+    Yields:
+        Lists of entry dictionaries with 'user_and_entry_id', 'user_id', 'created_at' and 'vectors'
+    """
+    if page_size is None:
+        page_size = int(os.environ.get('INDEX_BUILD_PAGE_SIZE', 500))
+    
+    supabase = create_service_client()
+    if supabase is None:
+        return
+    
+    last_entry_id = None
+    total = 0
+    while True:
+        query = supabase.table('entries').select('user_and_entry_id, user_id, created_at, vectors').not_.is_('vectors', 'null')
+        if user_id is not None:
+            query = query.eq('user_id', user_id)
+        if last_entry_id is not None:
+            query = query.gt('user_and_entry_id', last_entry_id)
+        response = query.order('user_and_entry_id').limit(page_size).execute()
+        page = response.data if response.data else []
+        
+        if not page:
+            break
+        total += len(page)
+        yield page
+        
+        if len(page) < page_size:
+            break
+        last_entry_id = page[-1]['user_and_entry_id']
+    
+    print(f"[build_index] Streamed {total} entries with vectors (user_id={user_id})")
+    if total == 0 and user_id is None:
+        log_missing_vectors(supabase)
+
+def log_missing_vectors(supabase):
+    """Print why a full index build found nothing to index"""
+    print("[build_index] ERROR: No vectorized entries found in database")
+    try:
+        total_response = supabase.table('entries').select('user_and_entry_id', count='exact').limit(1).execute()
+        total_count = total_response.count if hasattr(total_response, 'count') else 0
+        print(f"[build_index] Total entries in database: {total_count}")
+        
+        no_vectors_response = supabase.table('entries').select('user_and_entry_id', count='exact').is_('vectors', 'null').limit(1).execute()
+        no_vectors_count = no_vectors_response.count if hasattr(no_vectors_response, 'count') else 0
+        print(f"[build_index] Entries without vectors: {no_vectors_count}")
+    except Exception as e:
+        print(f"[build_index] Error checking entry counts: {str(e)}")
+        import traceback
+        traceback.print_exc()
+
+def extract_vectors(all_entries, dim):
+    """Validate entry rows and decode their vectors
+    
+    Rows are checked one by one, but the conversion to float32 happens in one
+    NumPy call for the whole page instead of one np.array call per row.
+    
+    Args:
+        all_entries: List of entry dictionaries with 'user_and_entry_id' and 'vectors'
+        dim: Expected vector dimensionality
+        
+    Returns:
+        Tuple of (entry_ids, float32 array of shape (len(entry_ids), dim))
+    """
+    entry_ids = []
+    rows = []
+    
+    for entry in all_entries:
+        entry_id = entry.get('user_and_entry_id')  # Primary key is 'user_and_entry_id'
+        if not entry_id:
+            print(f"Warning: Entry missing 'user_and_entry_id' field, skipping")
+            continue
+        vector = entry.get('vectors')
+        
+        # pgvector columns come back from PostgREST as '[0.1,0.2,...]' text
+        if isinstance(vector, str):
+            try:
+                vector = orjson.loads(vector)
+            except orjson.JSONDecodeError:
+                print(f"Warning: Entry {entry_id} has undecodable vector text, skipping")
+                continue
+        
+        # Ensure vector is a list/array and has correct length
+        if not isinstance(vector, (list, np.ndarray)):
+            print(f"Warning: Entry {entry_id} has invalid vector type {type(vector)}, skipping")
+            continue
+        
+        if len(vector) != dim:
+            print(f"Warning: Entry {entry_id} has vector with wrong dimension {len(vector)} (expected {dim}), skipping")
+            continue
+        
+        entry_ids.append(entry_id)
+        rows.append(vector)
+    
+    if not rows:
+        return entry_ids, np.zeros((0, dim), dtype=np.float32)
+    
+    vectors = np.asarray(rows, dtype=np.float32)
+    
+    # NaN or inf would poison every cosine distance they touch
+    finite = np.isfinite(vectors).all(axis=1)
+    if not finite.all():
+        for row in np.flatnonzero(~finite):
+            print(f"Warning: Entry {entry_ids[row]} has non-finite vector values, skipping")
+        entry_ids = [entry_id for entry_id, ok in zip(entry_ids, finite) if ok]
+        vectors = vectors[finite]
+    
+    return entry_ids, vectors
+
+def to_epoch_seconds(value):
+    """Convert a created_at value (ISO string, datetime or number) to epoch seconds
+    
+    Naive datetimes are taken to be UTC, like Postgres timestamps without a zone.
+    
+    Returns:
+        Seconds since the epoch as a float, or None if value is missing or unparseable
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.timestamp()
+    return None
+
+def extract_created_at(all_entries, entry_ids):
+    """Creation times in epoch seconds for entry_ids, as returned by extract_vectors()
+    
+    Args:
+        all_entries: Entry dictionaries the entry_ids were extracted from
+        entry_ids: Entry ids to look up, in order
+        
+    Returns:
+        float64 array with one value per entry_id (NaN where created_at is missing)
+    """
+    created_at = {entry.get('user_and_entry_id'): to_epoch_seconds(entry.get('created_at')) for entry in all_entries}
+    return np.array([np.nan if created_at.get(entry_id) is None else created_at[entry_id] for entry_id in entry_ids], dtype=np.float64)
+
+def prefetch_in_background(iterator, depth=2):
+    """Run an iterator in a background thread, keeping up to depth items ready
+    
+    Lets the next page be fetched and decoded while the current one is being
+    inserted into hnswlib (which releases the GIL and uses every core).
+    """
+    items = queue.Queue(maxsize=depth)
+    done = object()
+    
+    def produce():
+        try:
+            for item in iterator:
+                items.put((item, None))
+        except Exception as e:
+            items.put((None, e))
+        items.put((done, None))
+    
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    
+    while True:
+        item, error = items.get()
+        if error is not None:
+            raise error
+        if item is done:
+            return
+        yield item
+
 class HNSWIndex:
-    def __init__(self, dim=1536, ef_construction=200, M=16):
+    def __init__(self, dim=1536, ef_construction=200, M=16, num_threads=None, ef_search=None, filter_exact_max=None, coarse_dim=None, rerank_factor=4):
         """Initialize HNSW index
         
+        With coarse_dim set, the graph is built on the first coarse_dim dimensions of
+        each vector only. OpenAI's text-embedding-3 vectors are trained so that their
+        leading dimensions form a usable embedding on their own (Matryoshka
+        representation learning), so the truncated graph finds nearly the same
+        neighbors in a fraction of the memory and distance computations. The best
+        rerank_factor * k candidates of the graph walk are then re-ranked with the
+        full vectors, which are kept outside the graph and can be memory-mapped.
+        
         Args:
             dim: Dimensionality of vectors (1536 for OpenAI embeddings)
             ef_construction: Controls index quality vs build time (higher = better quality but slower)
             M: Controls maximum number of outgoing connections in the graph
+            num_threads: hnswlib threads for batch inserts (defaults to INDEX_BUILD_THREADS or all cores)
+            ef_search: Candidate list size while searching (defaults to INDEX_EF_SEARCH or 50)
+            filter_exact_max: Date-filtered searches matching at most this many entries scan
+                them exactly instead of walking the graph (defaults to INDEX_FILTER_EXACT_MAX or 2000)
+            coarse_dim: Leading dimensions the graph is built on (None or dim for the whole vector)
+            rerank_factor: Graph candidates re-ranked with the full vectors per requested result
         """
         self.dim = dim
+        if coarse_dim is not None and not 0 < coarse_dim < dim:
+            coarse_dim = None
+        self.coarse_dim = coarse_dim
+        self.rerank_factor = rerank_factor
         self.ef_construction = ef_construction
         self.M = M
+        if ef_search is None:
+            ef_search = int(os.environ.get('INDEX_EF_SEARCH', 50))
+        self.ef_search = ef_search
+        if num_threads is None:
+            num_threads = int(os.environ.get('INDEX_BUILD_THREADS', os.cpu_count() or 1))
+        self.num_threads = num_threads
+        if filter_exact_max is None:
+            filter_exact_max = int(os.environ.get('INDEX_FILTER_EXACT_MAX', 2000))
+        self.filter_exact_max = filter_exact_max
         self.index = None
-        self.id_to_entry_id = {}  # Maps HNSW internal IDs to database entry_ids
-        self.entry_id_to_id = {}  # Maps database entry_ids to HNSW internal IDs
+        self.created_at = np.zeros(0)  # Creation time per internal ID in epoch seconds (NaN if unknown or deleted)
+        self.vectors = None  # Unit-normalized full vectors per internal ID (coarse graphs only)
+        self.entry_id_to_id = EntryIdMap()  # Maps database entry_ids to HNSW internal IDs and back
+        self.next_id = 0  # Next unused internal ID, only advanced under the write lock
+        # Searches share the read lock; hnswlib releases the GIL inside knn_query,
+        # so concurrent searches run in parallel while writers wait their turn
+        self.lock = ReadWriteLock()
         
-    def build_index(self):
-        """Build HNSW index from all vectorized entries in the database"""
+    def build_index(self, user_id=None):
+        """Build HNSW index from vectorized entries in the database
+        
+        Args:
+            user_id: Optional user_id to only index that user's entries
+        """
         try:
-            # Initialize Supabase client
-            supabase_url = os.environ.get("SUPABASE_URL")
-            # Use SUPABASE_SECRET_KEY (service role key) - fallback to SUPABASE_SERVICE_ROLE_KEY for backwards compatibility
-            supabase_key = os.environ.get("SUPABASE_SECRET_KEY") 
-
-            print(f"[build_index] Supabase URL: {supabase_url[:30]}..." if supabase_url else "[build_index] ERROR: SUPABASE_URL not set")
-            print(f"[build_index] Service key present: {bool(supabase_key)}")
-            
-            # Debug: Show first few characters of service key to verify it's loaded
-            if supabase_key:
-                print(f"[build_index] Service key starts with: {supabase_key[:20]}... (length: {len(supabase_key)})")
-                # Service role keys typically start with "eyJ" (JWT) and are much longer than anon keys
-                if not supabase_key.startswith("eyJ"):
-                    print("[build_index] WARNING: Service key doesn't start with 'eyJ' - might be anon key instead!")
-            
-            if not supabase_url or not supabase_key:
-                print("[build_index] ERROR: Missing Supabase credentials")
-                return False
-            
-            supabase = create_client(supabase_url, supabase_key)
-            
-            # First, test if we can query ANY entries at all (without filters)
-            print("[build_index] Testing basic query to verify Supabase connection...")
-            test_response = supabase.table('entries').select('user_and_entry_id').limit(1).execute()
-            test_entries = test_response.data if test_response.data else []
-            print(f"[build_index] Basic test query returned {len(test_entries)} entries")
-            
-            if test_entries:
-                print(f"[build_index] Sample entry ID: {test_entries[0].get('user_and_entry_id')}")
-            
-            # Get all entries with vectors from Supabase
-            print("[build_index] Querying Supabase for entries with vectors...")
-            
-            # Try multiple query approaches to find entries with vectors
-            # Approach 1: Use not_.is_('vectors', 'null')
-            try:
-                response = supabase.table('entries').select('*').not_.is_('vectors', 'null').execute()
-                all_entries = response.data if response.data else []
-                print(f"[build_index] Query 1 (not_.is_): Found {len(all_entries)} entries")
-            except Exception as e:
-                print(f"[build_index] Query 1 failed: {str(e)}")
-                all_entries = []
-            
-            # Approach 2: If first query returns nothing, try getting all entries and filter manually
-            if not all_entries:
-                print("[build_index] Query 1 returned no results, trying alternative query...")
-                try:
-                    # Get a sample of entries to check
-                    sample_response = supabase.table('entries').select('user_and_entry_id, vectors').limit(10).execute()
-                    sample_entries = sample_response.data if sample_response.data else []
-                    print(f"[build_index] Sample query returned {len(sample_entries)} entries")
-                    
-                    # Check if any have vectors
-                    entries_with_vectors = [e for e in sample_entries if e.get('vectors') is not None]
-                    print(f"[build_index] Sample entries with vectors: {len(entries_with_vectors)}")
-                    
-                    if entries_with_vectors:
-                        # If sample has vectors, try getting all with a different query
-                        print("[build_index] Sample shows vectors exist, trying full query...")
-                        full_response = supabase.table('entries').select('*').execute()
-                        all_entries = [e for e in (full_response.data if full_response.data else []) if e.get('vectors') is not None]
-                        print(f"[build_index] Full query with manual filter: Found {len(all_entries)} entries with vectors")
-                except Exception as e:
-                    print(f"[build_index] Alternative query failed: {str(e)}")
-                    import traceback
-                    traceback.print_exc()
-            
-            if not all_entries:
-                print("[build_index] ERROR: No vectorized entries found in database")
-                # Check total entries to see if any exist at all
-                try:
-                    total_response = supabase.table('entries').select('user_and_entry_id', count='exact').execute()
-                    total_count = total_response.count if hasattr(total_response, 'count') else 0
-                    print(f"[build_index] Total entries in database: {total_count}")
-                    
-                    # Check entries without vectors
-                    no_vectors_response = supabase.table('entries').select('user_and_entry_id', count='exact').is_('vectors', 'null').execute()
-                    no_vectors_count = no_vectors_response.count if hasattr(no_vectors_response, 'count') else 0
-                    print(f"[build_index] Entries without vectors: {no_vectors_count}")
-                    
-                    # Try to get a few entries to inspect
-                    inspect_response = supabase.table('entries').select('user_and_entry_id, vectors').limit(5).execute()
-                    inspect_entries = inspect_response.data if inspect_response.data else []
-                    print(f"[build_index] Sample entries for inspection: {len(inspect_entries)}")
-                    for entry in inspect_entries:
-                        has_vectors = entry.get('vectors') is not None
-                        print(f"[build_index]   Entry {entry.get('user_and_entry_id')}: vectors={'present' if has_vectors else 'null'}")
-                except Exception as e:
-                    print(f"[build_index] Error checking entry counts: {str(e)}")
-                    import traceback
-                    traceback.print_exc()
-                return False
-            
-            print(f"[build_index] Found {len(all_entries)} entries with vectors, building index...")
-                
-            # Create new index
-            self.index = hnswlib.Index(space='cosine', dim=self.dim)
-            
-            # Initialize with slightly more capacity than needed
-            num_elements = len(all_entries)
-            self.index.init_index(max_elements=num_elements + 100, ef_construction=self.ef_construction, M=self.M)
-            
-            # Add vectors to index
-            vectors = []
-            ids = []
-            
-            for i, entry in enumerate(all_entries):
-                entry_id = entry.get('user_and_entry_id')  # Primary key is 'user_and_entry_id'
-                if not entry_id:
-                    print(f"Warning: Entry missing 'user_and_entry_id' field, skipping")
-                    continue
-                vector = entry.get('vectors')
-                
-                # Validate vector
-                if not vector:
-                    print(f"Warning: Entry {entry_id} has null/empty vector, skipping")
-                    continue
-                
-                # Ensure vector is a list/array and has correct length
-                if not isinstance(vector, (list, np.ndarray)):
-                    print(f"Warning: Entry {entry_id} has invalid vector type {type(vector)}, skipping")
-                    continue
-                
-                vector_array = np.array(vector, dtype=np.float32)
-                if len(vector_array) != self.dim:
-                    print(f"Warning: Entry {entry_id} has vector with wrong dimension {len(vector_array)} (expected {self.dim}), skipping")
-                    continue
-                
-                vectors.append(vector_array)
-                ids.append(i)
-                self.id_to_entry_id[i] = entry_id
-                self.entry_id_to_id[entry_id] = i
+            self.index = None
+            started = time.perf_counter()
+            added = 0
+            decoded_pages = (extract_vectors(page, self.dim) for page in iter_vectorized_entry_pages(user_id))
+            for entry_ids, vectors in prefetch_in_background(decoded_pages):
+                added += self.add_entries(entry_ids, vectors)
             
-            if not vectors:
-                print("No valid vectors found to add to index")
+            if not added:
                 return False
-                
-            self.index.add_items(np.array(vectors), ids)
-            
-            # Set search parameters
-            self.index.set_ef(50)  # ef parameter controls search speed vs accuracy tradeoff
-            
-            print(f"Built HNSW index with {len(vectors)} vectors (out of {num_elements} entries)")
+            elapsed = time.perf_counter() - started
+            print(f"Built HNSW index with {added} vectors in {elapsed:.1f}s ({added / max(elapsed, 1e-9):.0f} vectors/s)")
             return True
         except Exception as e:
             print(f"[build_index] ERROR: Exception during index build: {str(e)}")
             import traceback
             traceback.print_exc()
             return False
+    
+    def build_from_entries(self, all_entries):
+        """Build HNSW index from already fetched entry rows
+        
+        Args:
+            all_entries: List of entry dictionaries with 'user_and_entry_id' and 'vectors'
+        """
+        print(f"[build_index] Found {len(all_entries)} entries with vectors, building index...")
+        entry_ids, vectors = extract_vectors(all_entries, self.dim)
+        if not entry_ids:
+            print("No valid vectors found to add to index")
+            return False
+        return self.build_from_vectors(entry_ids, vectors)
+    
+    def build_from_vectors(self, entry_ids, vectors, created_at=None):
+        """Build HNSW index from already validated vectors
+        
+        Args:
+            entry_ids: Database entry_ids, one per row of vectors
+            vectors: float32 array of shape (len(entry_ids), dim)
+            created_at: Optional creation times in epoch seconds, one per row
+        """
+        # Create new index
+        graph = hnswlib.Index(space='cosine', dim=self.graph_dim)
+        
+        # Initialize with slightly more capacity than needed
+        num_elements = len(entry_ids)
+        graph.init_index(max_elements=num_elements + 100, ef_construction=self.ef_construction, M=self.M)
+        
+        ids = list(range(num_elements))
+        graph.add_items(self._graph_rows(vectors), ids, num_threads=self.num_threads)
         
-    def add_entry(self, entry_id, vector):
+        # Set search parameters
+        graph.set_ef(self.ef_search)  # ef parameter controls search speed vs accuracy tradeoff
+        
+        timestamps = np.full(graph.max_elements, np.nan)
+        if created_at is not None:
+            timestamps[:num_elements] = created_at
+        full_vectors = None
+        if self.coarse_dim:
+            full_vectors = np.zeros((graph.max_elements, self.dim), dtype=np.float32)
+            full_vectors[:num_elements] = self._normalize(vectors)
+        
+        with self.lock.write_lock():
+            self.index = graph
+            self.created_at = timestamps
+            self.vectors = full_vectors
+            self.entry_id_to_id = EntryIdMap.from_pairs(entry_ids, ids)
+            self.next_id = num_elements
+        
+        print(f"Built HNSW index with {num_elements} vectors")
+        return True
+        
+    def add_entry(self, entry_id, vector, created_at=None):
         """Add a single entry to the index (for incremental updates)
         
         Args:
             entry_id: Database entry_id
             vector: Embedding vector for the entry
+            created_at: Entry creation time in epoch seconds, or None if unknown
+        """
+        with self.lock.write_lock():
+            return self._add_entry_locked(entry_id, vector, created_at)
+    
+    def add_entries(self, entry_ids, vectors, created_at=None):
+        """Add a batch of entries with one add_items call (for streaming builds)
+        
+        Args:
+            entry_ids: Database entry_ids, one per row of vectors
+            vectors: float32 array of shape (len(entry_ids), dim)
+            created_at: Optional creation times in epoch seconds, one per row
+            
+        Returns:
+            Number of entries added (entries already in the index are skipped)
         """
+        with self.lock.write_lock():
+            self._init_if_needed()
+            
+            new_rows = [i for i, entry_id in enumerate(entry_ids) if entry_id not in self.entry_id_to_id]
+            if not new_rows:
+                return 0
+            
+            # Grow geometrically so a streamed build resizes O(log n) times
+            needed = self.next_id + len(new_rows)
+            if needed > self.index.max_elements:
+                self.index.resize_index(max(needed, self.index.max_elements * 2))
+            
+            ids = list(range(self.next_id, needed))
+            rows = np.asarray(vectors, dtype=np.float32)[new_rows]
+            self.index.add_items(self._graph_rows(rows), ids, num_threads=self.num_threads)
+            self._grow_arrays(needed)
+            if self.coarse_dim:
+                self.vectors[self.next_id:needed] = self._normalize(rows)
+            if created_at is not None:
+                self.created_at[self.next_id:needed] = np.asarray(created_at, dtype=np.float64)[new_rows]
+            for internal_id, row in zip(ids, new_rows):
+                self.entry_id_to_id.add(entry_ids[row], internal_id)
+            self.next_id = needed
+            return len(new_rows)
+    
+    def _init_if_needed(self):
         if self.index is None:
             # Initialize index if it doesn't exist
-            self.index = hnswlib.Index(space='cosine', dim=self.dim)
+            self.index = hnswlib.Index(space='cosine', dim=self.graph_dim)
             self.index.init_index(max_elements=1000, ef_construction=self.ef_construction, M=self.M)
-            self.index.set_ef(50)
+            self.index.set_ef(self.ef_search)
+            self.created_at = np.full(self.index.max_elements, np.nan)
+            self.vectors = np.zeros((self.index.max_elements, self.dim), dtype=np.float32) if self.coarse_dim else None
+            self.next_id = 0
+    
+    @property
+    def graph_dim(self):
+        """Dimensionality of the vectors stored in the graph"""
+        return self.coarse_dim or self.dim
+    
+    def _graph_rows(self, vectors):
+        # hnswlib normalizes cosine vectors itself, so truncating is all it takes
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        return np.ascontiguousarray(vectors[:, :self.coarse_dim]) if self.coarse_dim else vectors
+    
+    def _normalize(self, vectors):
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+    
+    def _grow_arrays(self, count):
+        # Grows geometrically like the graph, so appends stay amortized O(1)
+        if count > len(self.created_at):
+            grown = np.full(max(count, len(self.created_at) * 2), np.nan)
+            grown[:len(self.created_at)] = self.created_at
+            self.created_at = grown
+        # A memory-mapped snapshot is shared read-only with other workers, so the
+        # first write in this process copies it into private memory
+        if self.coarse_dim and (count > len(self.vectors) or isinstance(self.vectors, np.memmap)):
+            grown = np.zeros((max(count, len(self.created_at)), self.dim), dtype=np.float32)
+            grown[:len(self.vectors)] = self.vectors
+            self.vectors = grown
+    
+    def _add_entry_locked(self, entry_id, vector, created_at=None):
+        self._init_if_needed()
         
         # Check if entry already exists
         if entry_id in self.entry_id_to_id:
@@ -198,7 +441,6 @@ class HNSWIndex:
             return False
         
         # Check if we need to resize the index
-        current_count = len(self.id_to_entry_id)
         try:
             max_elements = self.index.max_elements
             current_elements = self.index.element_count
@@ -216,24 +458,91 @@ class HNSWIndex:
             # If we can't check, just try to add and let it fail gracefully
             pass
         
-        # Get current count to use as internal ID
-        internal_id = len(self.id_to_entry_id)
+        # Allocate the next internal ID (deleted entries keep theirs until compaction)
+        internal_id = self.next_id
         
         # Add to index
-        self.index.add_items(np.array([vector]), [internal_id])
+        self.index.add_items(self._graph_rows(vector), [internal_id], num_threads=1)
         
         # Update mappings
-        self.id_to_entry_id[internal_id] = entry_id
-        self.entry_id_to_id[entry_id] = internal_id
+        self.next_id += 1
+        self._grow_arrays(self.next_id)
+        if self.coarse_dim:
+            self.vectors[internal_id] = self._normalize(vector)[0]
+        self.created_at[internal_id] = np.nan if created_at is None else created_at
+        self.entry_id_to_id.add(entry_id, internal_id)
         
         return True
     
-    def search(self, query_vector, k=5):
+    def update_entry(self, entry_id, vector, created_at=None):
+        """Replace an entry's vector in place (after it is re-embedded)
+        
+        Args:
+            entry_id: Database entry_id
+            vector: New embedding vector for the entry
+            created_at: Entry creation time in epoch seconds (keeps the stored time if None)
+        """
+        with self.lock.write_lock():
+            if entry_id not in self.entry_id_to_id:
+                return self._add_entry_locked(entry_id, vector, created_at)
+            
+            # Adding an existing label makes hnswlib overwrite the vector and relink its neighbors
+            internal_id = self.entry_id_to_id[entry_id]
+            self.index.add_items(self._graph_rows(vector), [internal_id], num_threads=1)
+            if self.coarse_dim:
+                self._grow_arrays(self.next_id)
+                self.vectors[internal_id] = self._normalize(vector)[0]
+            if created_at is not None:
+                self.created_at[internal_id] = created_at
+            return True
+    
+    def delete_entry(self, entry_id):
+        """Mark an entry deleted so searches skip it
+        
+        The node stays in the graph as a tombstone until the index is compacted.
+        
+        Args:
+            entry_id: Database entry_id
+        """
+        with self.lock.write_lock():
+            internal_id = self.entry_id_to_id.remove(entry_id)
+            if internal_id is None:
+                return False
+            
+            self.index.mark_deleted(internal_id)
+            # Keeps tombstones out of the matches of date-filtered searches
+            self.created_at[internal_id] = np.nan
+            return True
+    
+    def tombstone_ratio(self):
+        """Fraction of graph nodes that belong to deleted entries"""
+        if self.index is None or self.index.element_count == 0:
+            return 0.0
+        return 1.0 - len(self.entry_id_to_id) / self.index.element_count
+    
+    def get_vectors(self):
+        """Return (entry_ids, vectors, creation times) for every live entry in the index"""
+        with self.lock.read_lock():
+            internal_ids = self.entry_id_to_id.internal_ids()
+            entry_ids = [self.entry_id_to_id.entry_id(i) for i in internal_ids]
+            if not entry_ids:
+                return entry_ids, np.zeros((0, self.dim), dtype=np.float32), np.zeros(0)
+            return entry_ids, self._full_vectors(internal_ids), self.created_at[internal_ids]
+    
+    def get_created_at(self, entry_id):
+        """Creation time of an entry in epoch seconds (NaN if unknown, None if not indexed)"""
+        with self.lock.read_lock():
+            internal_id = self.entry_id_to_id.get(entry_id)
+            return None if internal_id is None else float(self.created_at[internal_id])
+    
+    def search(self, query_vector, k=5, created_range=None):
         """Search for k nearest neighbors to query_vector
         
         Args:
             query_vector: Vector to search for
             k: Number of nearest neighbors to return
+            created_range: Optional (start, end) epoch seconds; only entries created in
+                that range are returned (see in_created_range)
             
         Returns:
             List of dictionaries with entry_id and distance
@@ -242,30 +551,139 @@ class HNSWIndex:
             print("Index not built yet")
             return []
             
-        if len(self.id_to_entry_id) == 0:
-            return []
-            
         # Convert query vector to numpy array
         query_vector = np.array(query_vector)
         
-        # Search index - search for more results than needed to account for user filtering
-        search_k = min(k * 3, len(self.id_to_entry_id))  # Get 3x results to filter by user
-        labels, distances = self.index.knn_query(query_vector, k=search_k)
+        with self.lock.read_lock():
+            if len(self.entry_id_to_id) == 0:
+                return []
+            
+            if created_range is not None:
+                return self._search_created_range(query_vector, k, created_range)
+            
+            if self.coarse_dim:
+                labels, _ = self.index.knn_query(self._graph_rows(query_vector), k=self._candidate_count(k, len(self.entry_id_to_id)))
+                return self._rerank(query_vector, labels[0], k)
+            
+            # Search index - each partition only holds one user's entries, so no over-fetching is needed
+            search_k = min(k, len(self.entry_id_to_id))
+            labels, distances = self.index.knn_query(query_vector, k=search_k)
+            
+            # Convert to list of dictionaries
+            results = []
+            for i in range(len(labels[0])):
+                internal_id = labels[0][i]
+                entry_id = self.entry_id_to_id.entry_id(internal_id)
+                distance = distances[0][i]
+                # Convert distance to similarity (1 - distance for cosine similarity)
+                similarity = 1.0 - float(distance)
+                results.append({
+                    'entry_id': entry_id,
+                    'distance': float(distance),
+                    'similarity': similarity
+                })
+            
+        return results
+    
+    def _search_created_range(self, query_vector, k, created_range):
+        """Search only the entries created in created_range (call under the read lock)
+        
+        A narrow range is scored exactly, which is both faster and more accurate than
+        walking a graph whose nodes mostly fail the filter. A wide range walks the
+        graph with hnswlib's filter so only matching nodes are returned.
+        """
+        matching = np.flatnonzero(in_created_range(self.created_at[:self.next_id], created_range))
+        if len(matching) == 0:
+            return []
+        
+        search_k = min(k, len(matching))
+        if len(matching) > self.filter_exact_max:
+            created_at = self.created_at
+            start = -np.inf if created_range[0] is None else created_range[0]
+            end = np.inf if created_range[1] is None else created_range[1]
+            try:
+                if self.coarse_dim:
+                    labels, _ = self.index.knn_query(self._graph_rows(query_vector), k=self._candidate_count(k, len(matching)), num_threads=1, filter=lambda label: start <= created_at[label] < end)
+                    return self._rerank(query_vector, labels[0], k)
+                labels, distances = self.index.knn_query(query_vector, k=search_k, num_threads=1, filter=lambda label: start <= created_at[label] < end)
+                return [{
+                    'entry_id': self.entry_id_to_id.entry_id(internal_id),
+                    'distance': float(distance),
+                    'similarity': 1.0 - float(distance)
+                } for internal_id, distance in zip(labels[0], distances[0])]
+            except RuntimeError:
+                # The filtered walk ran out of candidates before finding k matches
+                pass
         
-        # Convert to list of dictionaries
-        results = []
-        for i in range(len(labels[0])):
-            internal_id = labels[0][i]
-            entry_id = self.id_to_entry_id[internal_id]
-            distance = distances[0][i]
-            # Convert distance to similarity (1 - distance for cosine similarity)
-            similarity = 1.0 - float(distance)
-            results.append({
-                'entry_id': entry_id,
-                'distance': float(distance),
-                'similarity': similarity
-            })
+        return self._rerank(query_vector, matching, k)
+    
+    def _candidate_count(self, k, available):
+        """Graph candidates to fetch for re-ranking k results (coarse graphs only)"""
+        return min(max(k, k * self.rerank_factor), available)
+    
+    def _full_vectors(self, internal_ids):
+        """Unit-normalized full vectors of internal IDs (call under the read lock)"""
+        if self.coarse_dim:
+            return np.array(self.vectors[internal_ids], dtype=np.float32)
+        return self._normalize(self.index.get_items(internal_ids))
+    
+    def _rerank(self, query_vector, internal_ids, k):
+        """Score candidates by exact cosine similarity with their full vectors and keep the best k
+        
+        Call under the read lock.
+        """
+        internal_ids = np.asarray(internal_ids, dtype=np.int64)
+        if len(internal_ids) == 0:
+            return []
+        query = self._normalize(query_vector)[0]
+        similarities = self._full_vectors(internal_ids) @ query
+        search_k = min(k, len(internal_ids))
+        top = np.argpartition(-similarities, search_k - 1)[:search_k]
+        top = top[np.argsort(-similarities[top])]
+        return [{
+            'entry_id': self.entry_id_to_id.entry_id(internal_ids[i]),
+            'distance': 1.0 - float(similarities[i]),
+            'similarity': float(similarities[i])
+        } for i in top]
+    
+    def search_batch(self, query_vectors, k=5, created_range=None):
+        """Search for the k nearest neighbors of several queries with one knn_query call
+        
+        Args:
+            query_vectors: Array of shape (num_queries, dim)
+            k: Number of nearest neighbors to return per query
+            created_range: Optional (start, end) epoch seconds, as for search()
             
+        Returns:
+            One list of results per query, as returned by search()
+        """
+        query_vectors = np.atleast_2d(np.asarray(query_vectors, dtype=np.float32))
+        if self.index is None:
+            print("Index not built yet")
+            return [[] for _ in query_vectors]
+        
+        if created_range is not None:
+            return [self.search(query_vector, k=k, created_range=created_range) for query_vector in query_vectors]
+        
+        with self.lock.read_lock():
+            if len(self.entry_id_to_id) == 0:
+                return [[] for _ in query_vectors]
+            
+            # hnswlib spreads the queries over its own threads
+            if self.coarse_dim:
+                labels, _ = self.index.knn_query(self._graph_rows(query_vectors), k=self._candidate_count(k, len(self.entry_id_to_id)))
+                return [self._rerank(query_vector, query_labels, k) for query_vector, query_labels in zip(query_vectors, labels)]
+            
+            search_k = min(k, len(self.entry_id_to_id))
+            labels, distances = self.index.knn_query(query_vectors, k=search_k)
+            
+            results = []
+            for query_labels, query_distances in zip(labels, distances):
+                results.append([{
+                    'entry_id': self.entry_id_to_id.entry_id(internal_id),
+                    'distance': float(distance),
+                    'similarity': 1.0 - float(distance)
+                } for internal_id, distance in zip(query_labels, query_distances)])
         return results
         
     def save(self, path='hnsw_index'):
@@ -279,35 +697,86 @@ class HNSWIndex:
         if dir_path:
             os.makedirs(dir_path, exist_ok=True)
         
-        # Save index
-        self.index.save_index(f"{path}.bin")
-        
-        # Save mappings
-        with open(f"{path}_mappings.pkl", 'wb') as f:
-            pickle.dump({
-                'id_to_entry_id': self.id_to_entry_id,
-                'entry_id_to_id': self.entry_id_to_id
-            }, f)
+        with self.lock.read_lock():
+            # Save index
+            self.index.save_index(f"{path}.bin")
+            if self.coarse_dim:
+                np.save(f"{path}_vectors.npy", self.vectors[:self.next_id])
             
+            # Save mappings as plain arrays, written before the .meta file that marks the snapshot complete
+            self.entry_id_to_id.save(path)
+            np.save(f"{path}_created_at.npy", self.created_at[:self.next_id])
+            with open(f"{path}.meta", 'wb') as f:
+                f.write(orjson.dumps({'coarse_dim': self.coarse_dim}))
+            
+        return True
+    
+    def remap(self, path, mmap=True):
+        """Serve the mappings, and the full vectors of a coarse graph, from a just-saved snapshot
+        
+        Call right after save(path) with no writes in between. Releases the private
+        memory that writes since the last load used, and the previous snapshot's files.
+        """
+        entry_id_to_id = EntryIdMap.load(path, mmap=mmap)
+        vectors = np.load(f"{path}_vectors.npy", mmap_mode='r') if self.coarse_dim and mmap else None
+        with self.lock.write_lock():
+            if len(entry_id_to_id) != len(self.entry_id_to_id):
+                return False
+            self.entry_id_to_id = entry_id_to_id
+            if vectors is not None and len(vectors) == self.next_id:
+                self.vectors = vectors
         return True
+    
+    def _load_mappings(self, path, mmap):
+        """Load (entry_id_to_id, created_at, coarse_dim) saved with a snapshot"""
+        if os.path.exists(f"{path}.meta"):
+            with open(f"{path}.meta", 'rb') as f:
+                meta = orjson.loads(f.read())
+            return EntryIdMap.load(path, mmap=mmap), np.load(f"{path}_created_at.npy"), meta.get('coarse_dim')
+        
+        # Snapshots written before the mappings were stored as arrays
+        with open(f"{path}_mappings.pkl", 'rb') as f:
+            mappings = pickle.load(f)
+        entry_id_to_id = mappings['entry_id_to_id']
+        return EntryIdMap.from_pairs(list(entry_id_to_id), list(entry_id_to_id.values())), mappings.get('created_at'), mappings.get('coarse_dim')
+        
+    def load(self, path='hnsw_index', mmap=False):
+        """Load index from disk
+        
+        A snapshot keeps the coarse_dim it was built with, whatever this index was
+        configured with, until it is rebuilt.
         
-    def load(self, path='hnsw_index'):
-        """Load index from disk"""
+        Args:
+            path: Path prefix the index was saved under
+            mmap: Map the id mappings, and the full vectors of a coarse graph, read-only
+                instead of copying them, so processes loading the same snapshot share its pages
+        """
         try:
+            # Load mappings
+            entry_id_to_id, saved_created_at, coarse_dim = self._load_mappings(path, mmap)
+            
             # Create new index
-            self.index = hnswlib.Index(space='cosine', dim=self.dim)
+            graph = hnswlib.Index(space='cosine', dim=coarse_dim or self.dim)
             
             # Load index
-            self.index.load_index(f"{path}.bin")
-            
-            # Load mappings
-            with open(f"{path}_mappings.pkl", 'rb') as f:
-                mappings = pickle.load(f)
-                self.id_to_entry_id = mappings['id_to_entry_id']
-                self.entry_id_to_id = mappings['entry_id_to_id']
+            graph.load_index(f"{path}.bin")
+            vectors = np.load(f"{path}_vectors.npy", mmap_mode='r' if mmap else None) if coarse_dim else None
                 
             # Set search parameters
-            self.index.set_ef(50)
+            graph.set_ef(self.ef_search)
+            
+            # Snapshots written before creation times were indexed have none
+            timestamps = np.full(graph.max_elements, np.nan)
+            if saved_created_at is not None:
+                timestamps[:len(saved_created_at)] = saved_created_at
+            
+            with self.lock.write_lock():
+                self.index = graph
+                self.coarse_dim = coarse_dim
+                self.vectors = vectors
+                self.created_at = timestamps
+                self.entry_id_to_id = entry_id_to_id
+                self.next_id = graph.element_count
             
             return True
         except FileNotFoundError:
@@ -319,158 +788,1191 @@ class HNSWIndex:
             traceback.print_exc()
             return False
 
-# Global index instance
-index = HNSWIndex()
 
-def build_and_save_index():
-    """Build and save index"""
-    print("[build_and_save_index] Starting index build...")
-    try:
-        success = index.build_index()
-        if success:
-            print("[build_and_save_index] Index built successfully, saving...")
+
+class UserPartitionedIndex:
+    def __init__(self, path='instance/hnsw_index', dim=1536, ef_construction=200, M=16, exact_threshold=None, checkpoint_bytes=None, compaction_ratio=None, mmap_snapshots=None, quantization=None, rerank_factor=None, min_recall=None, coarse_dim=None):
+        """Initialize a collection of per-user vector indexes
+        
+        Every user gets their own index, so a search only scans that user's vectors
+        and always returns up to k of their entries without post-filtering. Users
+        with at most exact_threshold entries get an ExactIndex (brute force is both
+        faster and exact at that size), larger users get an HNSW graph.
+        
+        Incremental adds are appended to a write-ahead log in the index directory and
+        replayed on load. Once the log grows past checkpoint_bytes, the affected users'
+        indexes are written out as new snapshot files and the log starts over.
+        
+        Deleted entries become tombstones in HNSW graphs; once more than
+        compaction_ratio of a graph is tombstones it is rebuilt in the background.
+        
+        Rebuilds never block searches: new indexes are built off to the side and
+        swapped in when complete, while searches keep using the current ones. A
+        user seen for the first time is served by exact search straight away and
+        promoted to HNSW in the background if they are large enough.
+        
+        Exact snapshots are memory-mapped read-only, so every gunicorn worker on a
+        host shares one copy through the page cache. Every snapshot write bumps a
+        version file; workers notice the change on their next search and swap in
+        the newer snapshots without restarting.
+        
+        With quantization set, exact indexes scan an int8 or float16 copy of their
+        vectors and only read the float32 snapshot to re-rank the best
+        rerank_factor * k candidates, cutting resident memory 2-4x. The re-rank
+        depth is raised as needed to keep recall@5 at or above min_recall, measured
+        whenever a snapshot is written and stored with it.
+        
+        With coarse_dim set, HNSW graphs are built on the first coarse_dim dimensions
+        of each vector and re-rank rerank_factor * k candidates with the full
+        vectors, which are kept in memory-mapped snapshot files like exact indexes.
+        Changing coarse_dim takes effect as graphs are rebuilt; existing snapshots
+        keep their layout.
+        
+        Args:
+            path: Directory holding one saved index per user
+            dim: Dimensionality of vectors (1536 for OpenAI embeddings)
+            ef_construction: Controls index quality vs build time (higher = better quality but slower)
+            M: Controls maximum number of outgoing connections in the graph
+            exact_threshold: Largest partition served by exact search (defaults to EXACT_SEARCH_THRESHOLD or 5000)
+            checkpoint_bytes: Log size that triggers a checkpoint (defaults to INDEX_CHECKPOINT_BYTES or 4 MB)
+            compaction_ratio: Tombstone ratio that triggers a rebuild (defaults to INDEX_COMPACTION_RATIO or 0.2)
+            mmap_snapshots: Memory-map exact snapshots instead of copying them (defaults to INDEX_MMAP or true)
+            quantization: 'int8' or 'float16' compact storage for exact indexes (defaults to INDEX_QUANTIZATION or none)
+            rerank_factor: Candidates re-ranked at full precision per result (defaults to INDEX_RERANK_FACTOR or 4)
+            min_recall: Recall@5 bound for quantized search (defaults to INDEX_MIN_RECALL or 0.95)
+            coarse_dim: Leading dimensions HNSW graphs are built on (defaults to INDEX_COARSE_DIM or 0, which uses all of them)
+        """
+        self.path = path
+        self.dim = dim
+        self.ef_construction = ef_construction
+        self.M = M
+        if exact_threshold is None:
+            exact_threshold = int(os.environ.get('EXACT_SEARCH_THRESHOLD', 5000))
+        self.exact_threshold = exact_threshold
+        if checkpoint_bytes is None:
+            checkpoint_bytes = int(os.environ.get('INDEX_CHECKPOINT_BYTES', 4 * 1024 * 1024))
+        self.checkpoint_bytes = checkpoint_bytes
+        if compaction_ratio is None:
+            compaction_ratio = float(os.environ.get('INDEX_COMPACTION_RATIO', 0.2))
+        self.compaction_ratio = compaction_ratio
+        if mmap_snapshots is None:
+            mmap_snapshots = os.environ.get('INDEX_MMAP', 'true').lower() == 'true'
+        self.mmap_snapshots = mmap_snapshots
+        if quantization is None:
+            quantization = os.environ.get('INDEX_QUANTIZATION', '').lower() or None
+        if quantization is not None and quantization not in QUANTIZATIONS:
+            raise ValueError(f"INDEX_QUANTIZATION must be one of {', '.join(QUANTIZATIONS)}, got {quantization}")
+        self.quantization = quantization
+        if rerank_factor is None:
+            rerank_factor = int(os.environ.get('INDEX_RERANK_FACTOR', 4))
+        self.rerank_factor = rerank_factor
+        if min_recall is None:
+            min_recall = float(os.environ.get('INDEX_MIN_RECALL', 0.95))
+        self.min_recall = min_recall
+        if coarse_dim is None:
+            coarse_dim = int(os.environ.get('INDEX_COARSE_DIM', 0))
+        self.coarse_dim = coarse_dim or None
+        self._rebuilding = set()  # user_ids with a background rebuild running
+        self._rebuilding_lock = threading.Lock()  # Guards _rebuilding, so two threads never start the same rebuild
+        self._build_thread = None  # Background full build started by rebuild_in_background()
+        self.build_lock_path = os.path.join(path, 'build.lock')  # Lets one full build run per host
+        self.listeners = []  # Callbacks told about every logged change, see add_listener()
+        self.partitions = {}  # Maps user_id to that user's HNSWIndex or ExactIndex
+        self.wal = IndexWAL(os.path.join(path, 'wal.log'))
+        self.wal_offset = 0  # How far into the log this process has applied records
+        self.wal_identity = self.wal.identity()
+        self.version_path = os.path.join(path, 'version')
+        self.checkpoint_path = os.path.join(path, 'checkpoint.state')  # Users covered by the last checkpoint
+        self.snapshot_version = self._version_identity()  # Version file this process last checked
+    
+    def _new_partition(self, num_elements=0):
+        if num_elements <= self.exact_threshold:
+            return self._new_exact_index()
+        return self._new_hnsw_index()
+    
+    def add_listener(self, callback):
+        """Call callback(record) for every logged change, including other workers' changes
+        
+        Lets indexes kept next to this one (like the lexical index) follow the same
+        writes. callback(None, user_ids) means changes to those users (everyone if
+        user_ids is None) may have been missed and everything derived from the log
+        for them should be treated as stale. Callbacks run while index locks are
+        held, so they must be quick.
+        """
+        self.listeners.append(callback)
+    
+    def _notify(self, record, user_ids=None):
+        for callback in self.listeners:
             try:
-                save_success = index.save('instance/hnsw_index')
-                if save_success:
-                    print("[build_and_save_index] Index saved successfully")
-                    return True
+                if record is None:
+                    callback(None, user_ids)
                 else:
-                    print("[build_and_save_index] WARNING: Index build succeeded but save failed")
-                    return False
-            except Exception as save_error:
-                print(f"[build_and_save_index] ERROR: Index build succeeded but save failed with exception: {str(save_error)}")
-                import traceback
-                traceback.print_exc()
-                return False
-        else:
-            print("[build_and_save_index] ERROR: Index build failed (returned False)")
-            return False
-    except Exception as e:
-        print(f"[build_and_save_index] ERROR: Index build failed with exception: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return False
+                    callback(record)
+            except Exception as e:
+                print(f"[index] ERROR: Index change listener failed: {str(e)}")
     
-def load_index():
-    """Load index from disk"""
-    return index.load('instance/hnsw_index')
+    def _new_exact_index(self):
+        return ExactIndex(dim=self.dim, quantization=self.quantization, rerank_factor=self.rerank_factor, min_recall=self.min_recall)
     
-def search_similar(query_vector, k=5, user_id=None, user_client=None):
-    """Search for similar entries using HNSW index
+    def _new_hnsw_index(self):
+        return HNSWIndex(dim=self.dim, ef_construction=self.ef_construction, M=self.M, coarse_dim=self.coarse_dim, rerank_factor=self.rerank_factor)
     
-    Args:
-        query_vector: Embedding vector to search for
-        k: Number of results to return
-        user_id: Optional user_id to filter results
-        user_client: Optional Supabase client for user-specific queries
+    def _promote_if_needed(self, user_id, partition):
+        """Switch a user to an HNSW graph once exact search gets too slow for them
+        
+        The graph is built by a background rebuild while the ExactIndex keeps
+        serving, so writers holding the log lock never wait on it. Call once the
+        partition is in self.partitions, where the rebuild looks for it.
+        """
+        if isinstance(partition, ExactIndex) and len(partition.id_to_entry_id) > self.exact_threshold:
+            self._rebuild_in_background(user_id)
     
-    Returns:
-        List of entry dictionaries with similarity scores
-    """
-    import logging
-    index_logger = logging.getLogger(__name__)
-    index_logger.info(f"[search_similar] Starting search, user_id={user_id}, k={k}")
+    def _decode_pages(self, user_id=None):
+        """Fetch pages and decode them into per-user (user_id, entry_ids, vectors, created_at) batches"""
+        for page in iter_vectorized_entry_pages(user_id):
+            # Pages are ordered by '<user_id>_<n>' keys, so each one spans only a few users
+            entries_by_user = {}
+            for entry in page:
+                entries_by_user.setdefault(entry.get('user_id'), []).append(entry)
+            
+            batches = []
+            for uid, user_entries in entries_by_user.items():
+                if uid is None:
+                    print(f"Warning: {len(user_entries)} entries missing 'user_id' field, skipping")
+                    continue
+                entry_ids, vectors = extract_vectors(user_entries, self.dim)
+                if entry_ids:
+                    batches.append((uid, entry_ids, vectors, extract_created_at(user_entries, entry_ids)))
+            yield batches
     
-    # Try to load index if not already loaded
-    if index.index is None:
-        index_logger.info("[search_similar] Index not loaded, attempting to load...")
-        if not load_index():
-            index_logger.info("[search_similar] Failed to load index, building new index...")
-            if not build_and_save_index():
-                index_logger.error("[search_similar] ERROR: Failed to build index")
-                return []
+    def _stream_build(self, user_id=None, promote=True):
+        """Build partitions page by page as entries stream in from the database
+        
+        Fetching and decoding run in a background thread one page ahead, while
+        the current page is inserted with hnswlib's multi-threaded add_items.
+        
+        Args:
+            user_id: Optional user_id to only build that user's partition
+            promote: Switch partitions past exact_threshold to HNSW while building
+                (if False every partition is an ExactIndex, which is quick to build)
+            
+        Returns:
+            Dict mapping user_id to the built partition
+        """
+        started = time.perf_counter()
+        added = 0
+        partitions = {}
+        for batches in prefetch_in_background(self._decode_pages(user_id)):
+            for uid, entry_ids, vectors, created_at in batches:
+                partition = partitions.get(uid) or (self._new_partition(len(entry_ids)) if promote else self._new_exact_index())
+                added += partition.add_entries(entry_ids, vectors, created_at)
+                if promote and isinstance(partition, ExactIndex) and len(partition.id_to_entry_id) > self.exact_threshold:
+                    # Nothing is served from these partitions yet, so switch to HNSW right away
+                    partition = self._build_partition_from_vectors(*partition.get_vectors())
+                partitions[uid] = partition
+        
+        for partition in partitions.values():
+            if isinstance(partition, ExactIndex):
+                partition.calibrate()
+        
+        elapsed = time.perf_counter() - started
+        if added:
+            print(f"[build_index] Indexed {added} vectors for {len(partitions)} users in {elapsed:.1f}s ({added / max(elapsed, 1e-9):.0f} vectors/s)")
+        return partitions
+    
+    def _build_partition_from_vectors(self, entry_ids, vectors, created_at=None):
+        if not entry_ids:
+            return None
+        partition = self._new_partition(len(entry_ids))
+        partition.build_from_vectors(entry_ids, vectors, created_at)
+        return partition
+    
+    def partition_path(self, user_id):
+        """Path of the pointer file naming a user's current snapshot"""
+        return os.path.join(self.path, f"{user_id}.json")
+    
+    def _snapshot_prefix(self, user_id, generation):
+        return os.path.join(self.path, f"{user_id}.{generation}")
+    
+    def _load_snapshot(self, user_id):
+        """Load a user's latest snapshot, or None if they have never been saved"""
+        # A checkpoint in another worker can delete the files between reading the
+        # pointer and opening them, in which case the pointer has already moved on
+        for _ in range(3):
+            pointer = self._read_pointer(user_id)
+            if pointer is None:
+                return None
+            
+            prefix = self._snapshot_prefix(user_id, pointer['generation'])
+            if pointer['kind'] == 'hnsw':
+                partition = self._new_hnsw_index()
+                loaded = os.path.exists(f"{prefix}.bin") and partition.load(prefix, mmap=self.mmap_snapshots)
+            else:
+                # Snapshot files are immutable, so they can be shared read-only. Quantized
+                # indexes always map them, they only read full vectors to re-rank
+                partition = self._new_exact_index()
+                loaded = os.path.exists(f"{prefix}.npy") and partition.load(prefix, mmap=self.mmap_snapshots or self.quantization is not None)
+            
+            if loaded:
+                partition.generation = pointer['generation']
+                return partition
+        return None
+    
+    def _read_pointer(self, user_id):
+        try:
+            with open(self.partition_path(user_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+    
+    def _version_identity(self):
+        try:
+            stat_result = os.stat(self.version_path)
+        except FileNotFoundError:
+            return None
+        return (stat_result.st_ino, stat_result.st_mtime_ns)
+    
+    def _bump_version(self):
+        """Record that snapshots changed (call while holding self.wal.lock())"""
+        try:
+            with open(self.version_path) as f:
+                version = int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            version = 0
+        write_file_atomic(self.version_path, str(version + 1).encode('utf-8'))
+    
+    def refresh_snapshots(self):
+        """Swap out partitions whose snapshot was replaced by another worker
+        
+        Call while holding self.wal.local_lock(). Replaced partitions are dropped
+        and lazily reloaded from the newer snapshot on next use; searches already
+        running on the old partition finish undisturbed.
+        """
+        version = self._version_identity()
+        if version == self.snapshot_version:
+            return
+        self.snapshot_version = version
+        
+        for user_id, partition in list(self.partitions.items()):
+            pointer = self._read_pointer(user_id)
+            if pointer is not None and pointer['generation'] != getattr(partition, 'generation', None):
+                del self.partitions[user_id]
+    
+    def _load_partition(self, user_id):
+        """Load a user's snapshot and replay their logged changes on top of it
+        
+        Must be called while holding self.wal.local_lock().
+        """
+        while True:
+            identity = self.wal.identity()
+            partition = self._load_snapshot(user_id)
+            records, _, read_identity = self.wal.read(0)
+            # If a checkpoint replaced the log meanwhile, the snapshot may predate it
+            if read_identity == identity:
+                break
+        
+        for record in records:
+            if record.user_id == str(user_id):
+                partition, _ = self._apply_to(partition, record)
+        
+        if partition is not None:
+            self.partitions[user_id] = partition
+            print(f"[get_partition] Loaded index for user {user_id} with {len(partition.entry_id_to_id)} entries")
+            self._promote_if_needed(user_id, partition)
+        return partition
+    
+    def get_partition(self, user_id, build=True):
+        """Get a user's index, loading it from disk or building it from the database if needed
+        
+        Args:
+            user_id: User whose index to return
+            build: Build the index from the database if it is not on disk
+            
+        Returns:
+            HNSWIndex or ExactIndex for the user, or None if the user has no indexed entries
+        """
+        partition = self.partitions.get(user_id)
+        if partition is not None:
+            return partition
+        
+        with self.wal.local_lock():
+            partition = self.partitions.get(user_id) or self._load_partition(user_id)
+        if partition is not None or not build:
+            return partition
+        
+        # Query the database without holding the lock so other users are not blocked.
+        # Exact search needs no graph, so the user is served as soon as their vectors arrive
+        built = self._stream_build(user_id, promote=False).get(user_id)
+        if built is None:
+            return None
+        
+        with self.wal.lock():
+            # Another thread or worker may have saved this user in the meantime
+            partition = self.partitions.get(user_id) or self._load_partition(user_id)
+            if partition is None:
+                self.partitions[user_id] = built
+                self.save(user_id)
+                partition = built
+        
+        self._promote_if_needed(user_id, partition)
+        return partition
+    
+    def build_index(self):
+        """Build every user's index from the database and swap them in atomically
+        
+        The new indexes are built alongside the current ones, which keep serving
+        searches until the swap. Only one build runs at a time on a host; callers
+        that arrive while one is running wait for it and load its result instead.
+        
+        Returns:
+            True if any index is available afterwards, False otherwise
+        """
+        with file_lock(self.build_lock_path, blocking=False) as acquired:
+            if acquired:
+                return self._build_and_swap()
+        
+        print("[build_index] Another build is already running, waiting for it to finish")
+        with file_lock(self.build_lock_path):
+            pass
+        return self.load()
+    
+    def _build_and_swap(self):
+        """Build every partition, replay the log onto them, then swap and snapshot them"""
+        try:
+            partitions = self._stream_build()
+            
+            with self.wal.lock():
+                # Changes logged while the database was being read may not be in the new
+                # indexes yet; replaying the whole log is safe because every op is idempotent
+                records, offset, identity = self.wal.read(0)
+                for record in records:
+                    partition, _ = self._apply_to(partitions.get(record.user_id), record)
+                    if partition is not None:
+                        partitions[record.user_id] = partition
+                if not partitions:
+                    return False
+                
+                with self.wal.local_lock():
+                    self.partitions = partitions
+                    self.wal_offset = offset
+                    self.wal_identity = identity
+                print(f"Built {len(partitions)} per-user indexes")
+                
+                # The snapshots now hold everything in the log
+                if self.save():
+                    self.wal.reset()
+                    self.wal_offset = 0
+                    self.wal_identity = self.wal.identity()
+            return True
+        except Exception as e:
+            print(f"[build_index] ERROR: Exception during index build: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    def rebuild_in_background(self):
+        """Start build_index() in a background thread unless a build is already running
+        
+        Returns:
+            True if a new build was started
+        """
+        with self.wal.local_lock():
+            if self._build_thread is not None and self._build_thread.is_alive():
+                return False
+            self._build_thread = threading.Thread(target=self.build_index)
+            self._build_thread.daemon = True
+            self._build_thread.start()
+        print("[build_index] Started background index build")
+        return True
+    
+    def _apply_to(self, partition, record):
+        """Apply one logged change to a user's partition
+        
+        Returns:
+            Tuple of (partition to keep for the user, whether anything changed)
+        """
+        if record.op == OP_DELETE:
+            if partition is None:
+                return partition, False
+            deleted = partition.delete_entry(record.entry_id)
+            if deleted:
+                self._maybe_compact(record.user_id, partition)
+            return partition, deleted
+        
+        if record.op == OP_UPDATE and partition is not None and record.entry_id in partition.entry_id_to_id:
+            return partition, partition.update_entry(record.entry_id, record.vector, record.created_at)
+        
+        if record.op not in (OP_ADD, OP_UPDATE):
+            return partition, False
+        
+        # An addition, or an update for an entry that was never indexed
+        if partition is None:
+            # First vectorized entry for this user
+            partition = self._new_partition()
+        
+        return partition, partition.add_entry(record.entry_id, record.vector, record.created_at)
+    
+    def _apply(self, record):
+        """Apply one logged change to the in-memory partitions
+        
+        Every in-process mutation goes through here under self.wal.local_lock(),
+        which keeps changes to a user's partition in log order.
+        """
+        with self.wal.local_lock():
+            partition = self.partitions.get(record.user_id)
+            if partition is None:
+                # Loading replays the whole log for this user, including this record
+                return self._load_partition(record.user_id) is not None
+            
+            partition, changed = self._apply_to(partition, record)
+            self.partitions[record.user_id] = partition
+            if changed:
+                self._promote_if_needed(record.user_id, partition)
+            return changed
+    
+    def add_entry(self, user_id, entry_id, vector, created_at=None):
+        """Add a single entry to its owner's index (for incremental updates)
+        
+        The entry is appended to the write-ahead log before it is applied, so it
+        survives restarts without re-saving the user's whole index.
+        
+        Args:
+            user_id: Owner of the entry
+            entry_id: Database entry_id
+            vector: Embedding vector for the entry
+            created_at: Entry creation time in epoch seconds (defaults to now, since
+                entries are indexed right after they are written)
+        """
+        partition = self.get_partition(user_id)
+        if partition is not None and entry_id in partition.entry_id_to_id:
+            # Entry already in index, skip
+            return False
+        
+        if created_at is None:
+            created_at = time.time()
+        record = WALRecord(OP_ADD, str(user_id), entry_id, np.asarray(vector, dtype=np.float32), created_at)
+        with self.wal.lock():
+            self.wal.append(record.op, record.user_id, record.entry_id, record.vector, record.created_at)
+            self._notify(record)
+            added = self._apply(record)
+            if self.wal.size() >= self.checkpoint_bytes:
+                self.checkpoint()
+        return added
+    
+    def add_entries(self, entries):
+        """Add a batch of new entries, possibly of several users, with one log write
+        
+        Each user's new entries go into their index with a single add_entries
+        (one add_items) call instead of one call per entry.
+        
+        Args:
+            entries: List of (user_id, entry_id, vector, created_at) tuples, with
+                created_at in epoch seconds or None for now
+        
+        Returns:
+            Number of entries added (entries already indexed are skipped)
+        """
+        now = time.time()
+        records = []
+        seen = set()
+        for user_id, entry_id, vector, created_at in entries:
+            partition = self.get_partition(user_id)
+            if (str(user_id), entry_id) in seen or (partition is not None and entry_id in partition.entry_id_to_id):
+                continue
+            seen.add((str(user_id), entry_id))
+            records.append(WALRecord(OP_ADD, str(user_id), entry_id, np.asarray(vector, dtype=np.float32),
+                                     now if created_at is None else created_at))
+        if not records:
+            return 0
+        
+        with self.wal.lock():
+            self.wal.append_many(records)
+            for record in records:
+                self._notify(record)
+            added = self._apply_additions(records)
+            if self.wal.size() >= self.checkpoint_bytes:
+                self.checkpoint()
+        return added
+    
+    def _apply_additions(self, records):
+        """Apply logged OP_ADD records, with one add_entries call per user
+        
+        Returns:
+            Number of entries added
+        """
+        records_by_user = {}
+        for record in records:
+            records_by_user.setdefault(record.user_id, []).append(record)
+        
+        added = 0
+        with self.wal.local_lock():
+            for user_id, user_records in records_by_user.items():
+                partition = self.partitions.get(user_id)
+                if partition is None:
+                    # Loading replays the whole log for this user, including these records
+                    partition = self._load_partition(user_id)
+                    added += sum(1 for record in user_records if partition is not None and record.entry_id in partition.entry_id_to_id)
+                    continue
+                
+                count = partition.add_entries(
+                    [record.entry_id for record in user_records],
+                    np.stack([record.vector for record in user_records]),
+                    created_at=[np.nan if record.created_at is None else record.created_at for record in user_records]
+                )
+                self.partitions[user_id] = partition
+                if count:
+                    self._promote_if_needed(user_id, partition)
+                added += count
+        return added
+    
+    def update_entry(self, user_id, entry_id, vector, created_at=None):
+        """Replace an entry's vector after it was re-embedded (adds it if missing)
+        
+        Args:
+            user_id: Owner of the entry
+            entry_id: Database entry_id
+            vector: New embedding vector for the entry
+            created_at: Entry creation time in epoch seconds (keeps the indexed time if None)
+        """
+        self.get_partition(user_id)
+        record = WALRecord(OP_UPDATE, str(user_id), entry_id, np.asarray(vector, dtype=np.float32), created_at)
+        with self.wal.lock():
+            self.wal.append(record.op, record.user_id, record.entry_id, record.vector, record.created_at)
+            self._notify(record)
+            updated = self._apply(record)
+            if self.wal.size() >= self.checkpoint_bytes:
+                self.checkpoint()
+        return updated
+    
+    def remove_entry(self, user_id, entry_id):
+        """Remove a deleted entry from its owner's index
+        
+        Args:
+            user_id: Owner of the entry
+            entry_id: Database entry_id
+        """
+        partition = self.get_partition(user_id, build=False)
+        if partition is None or entry_id not in partition.entry_id_to_id:
+            return False
+        
+        record = WALRecord(OP_DELETE, str(user_id), entry_id, None)
+        with self.wal.lock():
+            self.wal.append(record.op, record.user_id, record.entry_id)
+            self._notify(record)
+            return self._apply(record)
+    
+    def log_changes(self, records):
+        """Log and apply a batch of WALRecords with a single log write
+        
+        Used to patch indexes in bulk (see index_reconcile), where one fsync per
+        entry would dominate the run time. Only loaded partitions are changed in
+        memory; the others pick the records up from the log when they are loaded.
+        
+        Returns:
+            Number of records logged
+        """
+        if not records:
+            return 0
+        with self.wal.lock():
+            self.wal.append_many(records)
+            for record in records:
+                self._notify(record)
+                if record.user_id in self.partitions:
+                    self._apply(record)
+            if self.wal.size() >= self.checkpoint_bytes:
+                self.checkpoint()
+        return len(records)
+    
+    def _maybe_compact(self, user_id, partition):
+        """Start a background rebuild once too much of a user's graph is tombstones"""
+        if not isinstance(partition, HNSWIndex) or partition.tombstone_ratio() < self.compaction_ratio:
+            return
+        self._rebuild_in_background(user_id)
+    
+    def _rebuild_in_background(self, user_id):
+        """Rebuild a user's index in a background thread (one at a time per user)"""
+        with self._rebuilding_lock:
+            if user_id in self._rebuilding:
+                return
+            self._rebuilding.add(user_id)
+        thread = threading.Thread(target=self._rebuild_partition, args=(user_id,))
+        thread.daemon = True
+        thread.start()
+    
+    def _rebuild_partition(self, user_id):
+        """Rebuild a user's index from its live entries and swap it in
+        
+        Drops tombstones from HNSW graphs and promotes oversized exact indexes.
+        Every worker replaying the same changes asks for the same rebuild, so only
+        one per host runs it; the others load its snapshot on their next search.
+        """
+        try:
+            with file_lock(os.path.join(self.path, 'rebuild', f"{user_id}.lock"), blocking=False) as acquired:
+                if not acquired:
+                    return
+                # Retry if the partition changed while the replacement was being built
+                for _ in range(3):
+                    partition = self.partitions.get(user_id)
+                    if partition is None:
+                        return
+                    pointer = self._read_pointer(user_id)
+                    if pointer is not None and pointer['generation'] != getattr(partition, 'generation', None):
+                        # Another worker saved a newer snapshot (perhaps rebuilt already), swapped in on next search
+                        return
+                    entry_ids = set(partition.entry_id_to_id)
+                    
+                    compacted = self._build_partition_from_vectors(*partition.get_vectors())
+                    with self.wal.lock():
+                        if self.partitions.get(user_id) is not partition or set(partition.entry_id_to_id) != entry_ids:
+                            continue
+                        if compacted is None:
+                            self.partitions[user_id] = self._new_partition()
+                        else:
+                            self.partitions[user_id] = compacted
+                        self.save(user_id)
+                        print(f"[rebuild] Rebuilt index for user {user_id} with {len(entry_ids)} live entries")
+                        return
+        except Exception as e:
+            print(f"[rebuild] ERROR: Rebuild failed for user {user_id}: {str(e)}")
+            import traceback
+            traceback.print_exc()
+        finally:
+            with self._rebuilding_lock:
+                self._rebuilding.discard(user_id)
+    
+    def catch_up(self):
+        """Apply log records written by other worker processes since the last call
+        
+        Skipped if another thread is already applying changes in this process,
+        so searches never queue up behind a checkpoint or compaction.
+        """
+        with self.wal.local_lock(blocking=False) as acquired:
+            if not acquired:
+                return
+            
+            records, offset, identity = self.wal.read(self.wal_offset)
+            if identity != self.wal_identity:
+                if self.wal_identity is not None:
+                    # Another worker checkpointed: the new snapshots hold everything from the
+                    # old log, so reload partitions lazily and start reading the new log
+                    self.partitions = {}
+                    records, offset, identity = self.wal.read(0)
+                    self._notify(None, self._checkpointed_user_ids())
+                self.wal_identity = identity
+            
+            self.wal_offset = offset
+            self.refresh_snapshots()
+            for record in records:
+                self._notify(record)
+                # Partitions that are not loaded pick the record up when they are
+                if record.user_id in self.partitions:
+                    self._apply(record)
+    
+    def _checkpointed_user_ids(self):
+        """Users whose changes were in the log this process last read, or None if unknown
+        
+        Unknown when more than one checkpoint happened since this process last read the log.
+        """
+        try:
+            with open(self.checkpoint_path) as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if self.wal_identity is None or state.get('log') != list(self.wal_identity):
+            return None
+        return set(state['user_ids'])
+    
+    def checkpoint(self):
+        """Snapshot every user with logged changes and start a new empty log"""
+        with self.wal.lock():
+            self.catch_up()
+            records, _, _ = self.wal.read(0)
+            user_ids = {record.user_id for record in records}
+            
+            for user_id in user_ids:
+                if self.get_partition(user_id, build=False) is not None:
+                    self.save(user_id)
+            
+            # Tells workers that had not read the whole log which users they missed changes for
+            write_file_atomic(self.checkpoint_path, json.dumps({
+                'log': self.wal.identity(),
+                'user_ids': sorted(user_ids)
+            }).encode('utf-8'))
+            self.wal.reset()
+            self.wal_offset = 0
+            self.wal_identity = self.wal.identity()
+            print(f"[checkpoint] Wrote snapshots for {len(user_ids)} users and reset the log")
+    
+    def search(self, query_vector, k=5, user_id=None, created_range=None):
+        """Search for k nearest neighbors to query_vector
+        
+        Args:
+            query_vector: Vector to search for
+            k: Number of nearest neighbors to return
+            user_id: Only search this user's entries (searches every partition if None)
+            created_range: Optional (start, end) epoch seconds; only entries created in
+                that range are returned (see in_created_range)
+            
+        Returns:
+            List of dictionaries with entry_id and distance
+        """
+        self.catch_up()
+        
+        if user_id is not None:
+            partition = self.get_partition(user_id)
+            return partition.search(query_vector, k=k, created_range=created_range) if partition else []
+        
+        results = []
+        # Copied first: another thread may load or drop a partition mid-search
+        for partition in list(self.partitions.values()):
+            results.extend(partition.search(query_vector, k=k, created_range=created_range))
+        results.sort(key=lambda x: x['similarity'], reverse=True)
+        return results[:k]
+    
+    def search_batch(self, query_vectors, k=5, user_id=None, created_range=None):
+        """Search for the k nearest neighbors of several queries at once
+        
+        Args:
+            query_vectors: Array of shape (num_queries, dim)
+            k: Number of nearest neighbors to return per query
+            user_id: Only search this user's entries (searches every partition if None)
+            created_range: Optional (start, end) epoch seconds, as for search()
+            
+        Returns:
+            One list of results per query, as returned by search()
+        """
+        self.catch_up()
+        
+        if user_id is not None:
+            partition = self.get_partition(user_id)
+            return partition.search_batch(query_vectors, k=k, created_range=created_range) if partition else [[] for _ in query_vectors]
+        
+        merged = [[] for _ in query_vectors]
+        for partition in list(self.partitions.values()):
+            for results, partition_results in zip(merged, partition.search_batch(query_vectors, k=k, created_range=created_range)):
+                results.extend(partition_results)
+        for results in merged:
+            results.sort(key=lambda x: x['similarity'], reverse=True)
+            del results[k:]
+        return merged
+    
+    def filter_created_range(self, user_id, entry_ids, created_range):
+        """Keep the entry_ids of a user's indexed entries created in created_range
+        
+        Lets results found without the vector index (like keyword matches) be
+        restricted to the same dates. Entries that are not indexed are dropped.
+        """
+        partition = self.get_partition(user_id)
+        if partition is None:
+            return []
+        created_at = np.array([partition.get_created_at(entry_id) for entry_id in entry_ids], dtype=np.float64)
+        return [entry_id for entry_id, keep in zip(entry_ids, in_created_range(created_at, created_range)) if keep]
+    
+    def _snapshot_entry_ids(self, user_id):
+        """entry_ids in a user's latest snapshot, or None if they have never been saved
+        
+        Reads only the id mappings, not the vectors or the graph.
+        """
+        # A checkpoint in another worker can delete the files between reading the
+        # pointer and opening them, in which case the pointer has already moved on
+        for _ in range(3):
+            pointer = self._read_pointer(user_id)
+            if pointer is None:
+                return None
+            
+            prefix = self._snapshot_prefix(user_id, pointer['generation'])
+            try:
+                if pointer['kind'] == 'hnsw' and os.path.exists(f"{prefix}.meta"):
+                    return set(EntryIdMap.load(prefix, mmap=True))
+                # Exact snapshots, and HNSW snapshots written before the mappings were stored as arrays
+                with open(f"{prefix}_mappings.pkl", 'rb') as f:
+                    return set(pickle.load(f)['entry_id_to_id'])
+            except FileNotFoundError:
+                continue
+        return None
+    
+    def indexed_entry_ids(self, user_ids):
+        """entry_ids in the index of each user that has one
+        
+        Indexes that are not loaded are read from the id mappings of their snapshot
+        plus one pass over the log for all of them, so checking every user loads
+        no vectors or graphs.
+        
+        Args:
+            user_ids: Users to look up
+            
+        Returns:
+            Dictionary mapping the user_ids that have an index to sets of entry_ids
+        """
+        partitions = dict(self.partitions)
+        unloaded = [user_id for user_id in user_ids if user_id not in partitions]
+        entry_ids, records = {}, []
+        while unloaded:
+            identity = self.wal.identity()
+            entry_ids = {user_id: self._snapshot_entry_ids(user_id) for user_id in unloaded}
+            records, _, read_identity = self.wal.read(0)
+            # If a checkpoint replaced the log meanwhile, the snapshots may predate it
+            if read_identity == identity:
+                break
+        
+        for record in records:
+            if record.user_id not in entry_ids:
+                continue
+            if record.op == OP_DELETE:
+                if entry_ids[record.user_id] is not None:
+                    entry_ids[record.user_id].discard(record.entry_id)
+            elif record.op in (OP_ADD, OP_UPDATE):
+                # An index is created by its user's first addition
+                if entry_ids[record.user_id] is None:
+                    entry_ids[record.user_id] = set()
+                entry_ids[record.user_id].add(record.entry_id)
+        
+        for user_id in user_ids:
+            if user_id in partitions:
+                entry_ids[user_id] = set(partitions[user_id].entry_id_to_id)
+        return {user_id: ids for user_id, ids in entry_ids.items() if ids is not None}
+    
+    def drop_partition(self, user_id):
+        """Forget a user's in-memory index so it is reloaded or rebuilt on next use"""
+        with self.wal.local_lock():
+            self.partitions.pop(user_id, None)
+    
+    def save(self, user_id=None):
+        """Write a new snapshot of one user's index, or every loaded index
+        
+        Snapshot files are never modified in place: each save writes a new
+        generation and then atomically swaps the user's pointer file, so other
+        workers loading concurrently never see a half-written index.
+        """
+        user_ids = [user_id] if user_id is not None else list(self.partitions)
+        saved = True
+        with self.wal.lock():
+            for uid in user_ids:
+                partition = self.partitions.get(uid)
+                if partition is None:
+                    saved = False
+                    continue
+                
+                generation = f"{time.time_ns():x}"
+                if not partition.save(self._snapshot_prefix(uid, generation)):
+                    saved = False
+                    continue
+                
+                pointer = {
+                    'generation': generation,
+                    'kind': 'hnsw' if isinstance(partition, HNSWIndex) else 'exact'
+                }
+                write_file_atomic(self.partition_path(uid), json.dumps(pointer).encode('utf-8'))
+                partition.generation = generation
+                if isinstance(partition, ExactIndex) and (self.mmap_snapshots or self.quantization is not None):
+                    # Drop the private copy made by writes since the partition was loaded
+                    partition.remap(self._snapshot_prefix(uid, generation))
+                elif isinstance(partition, HNSWIndex):
+                    partition.remap(self._snapshot_prefix(uid, generation), mmap=self.mmap_snapshots)
+                
+                # Remove older generations now that nothing new will open them
+                current_prefix = f"{uid}.{generation}"
+                for filename in os.listdir(self.path):
+                    if filename.startswith(f"{uid}.") and not filename.startswith(current_prefix) and filename != f"{uid}.json":
+                        os.remove(os.path.join(self.path, filename))
+            
+            self._bump_version()
+            # Our own partitions already match the new snapshots
+            self.snapshot_version = self._version_identity()
+        return saved
+    
+    def saved_user_ids(self):
+        """user_ids that have a snapshot on disk"""
+        if not os.path.isdir(self.path):
+            return []
+        return [os.path.splitext(filename)[0] for filename in os.listdir(self.path) if filename.endswith('.json')]
+    
+    def load(self):
+        """Load every saved user index from disk"""
+        loaded = False
+        for user_id in self.saved_user_ids():
+            if self.get_partition(user_id, build=False) is not None:
+                loaded = True
+        return loaded
+
+
+# Global index instance
+index = UserPartitionedIndex('instance/hnsw_index')
+# Cached entry rows are evicted whenever any worker logs a change to the entry
+index.add_listener(entry_cache.on_vector_change)
+
+def build_and_save_index():
+    """Build and save every user's index (searches keep using the old indexes meanwhile)"""
+    print("[build_and_save_index] Starting index build...")
+    try:
+        # build_index() snapshots the new indexes before returning
+        success = index.build_index()
+        if success:
+            print("[build_and_save_index] Index built and saved successfully")
+            return True
         else:
-            index_logger.info("[search_similar] Index loaded successfully")
-    else:
-        index_logger.info(f"[search_similar] Index already loaded, has {len(index.id_to_entry_id)} entries")
+            print("[build_and_save_index] ERROR: Index build failed (returned False)")
+            return False
+    except Exception as e:
+        print(f"[build_and_save_index] ERROR: Index build failed with exception: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return False
+    
+def load_index():
+    """Load every saved user index from disk"""
+    return index.load()
+
+def user_id_from_entry_id(entry_id):
+    """Extract the owner's user_id from a '<user_id>_<user_entry_id>' primary key"""
+    return str(entry_id).rsplit('_', 1)[0]
+    
+def search_similar(query_vector, k=5, user_id=None, user_client=None):
+    """Search for similar entries using HNSW index
+    
+    Args:
+        query_vector: Embedding vector to search for
+        k: Number of results to return
+        user_id: Optional user_id to restrict the search to that user's index
+        user_client: Optional Supabase client for user-specific queries
     
-    # Search index
-    index_logger.info(f"[search_similar] Searching index for {k * 3 if user_id else k} candidates...")
-    candidates = index.search(query_vector, k=k * 3 if user_id else k)  # Get more if filtering by user
+    Returns:
+        List of entry dictionaries with similarity scores
+    """
+    import logging
+    index_logger = logging.getLogger(__name__)
+    index_logger.info(f"[search_similar] Starting search, user_id={user_id}, k={k}")
     
+    candidates = search_candidates(query_vector, k=k, user_id=user_id)
     index_logger.info(f"[search_similar] Index search returned {len(candidates)} candidates")
     if not candidates:
         index_logger.warning("[search_similar] No candidates found from index search")
         return []
     
-    # If no user filtering needed, fetch entries and return
+    results = hydrate_candidates(candidates, user_id=user_id, user_client=user_client)
+    index_logger.info(f"[search_similar] Returning {len(results)} final results")
+    return results
+
+def search_candidates(query_vector, k=5, user_id=None, created_range=None):
+    """Find the entry_ids nearest to query_vector without fetching the entries
+    
+    Args:
+        query_vector: Embedding vector to search for
+        k: Number of results to return
+        user_id: Optional user_id to restrict the search to that user's index
+        created_range: Optional (start, end) epoch seconds to restrict results to
+            entries created in that range
+    
+    Returns:
+        List of dictionaries with entry_id, distance and similarity, most similar first
+    """
+    if user_id is None:
+        load_all_partitions()
+    
+    # Search index - a user's search only walks that user's partition
+    return index.search(query_vector, k=k, user_id=user_id, created_range=created_range)
+
+def search_candidates_batch(query_vectors, k=5, user_id=None, created_range=None):
+    """Find the entry_ids nearest to each of several query vectors in one index pass
+    
+    Args:
+        query_vectors: Embedding vectors to search for
+        k: Number of results to return per query
+        user_id: Optional user_id to restrict the search to that user's index
+        created_range: Optional (start, end) epoch seconds, as for search_candidates()
+    
+    Returns:
+        One list of candidates per query, as returned by search_candidates()
+    """
     if user_id is None:
-        # Fetch full entry data from Supabase
-        supabase = create_client(
-            os.environ.get("SUPABASE_URL"),
-            os.environ.get("SUPABASE_PUBLISHABLE_KEY")
-        )
-        
-        entry_ids = [c['entry_id'] for c in candidates[:k]]
-        response = supabase.table('entries').select('*').in_('user_and_entry_id', entry_ids).execute()
+        load_all_partitions()
+    return index.search_batch(query_vectors, k=k, user_id=user_id, created_range=created_range)
+
+def load_all_partitions():
+    """Make sure every user's index is in memory before searching across all users"""
+    import logging
+    index_logger = logging.getLogger(__name__)
+    
+    if not index.partitions:
+        # Searching across all users needs every partition in memory
+        index_logger.info("[load_all_partitions] No indexes loaded, attempting to load...")
+        if not load_index():
+            # Never build inline: the request would hang for the whole build. Whatever
+            # is loaded keeps being served until the new indexes are swapped in
+            index_logger.info("[load_all_partitions] No saved indexes, building new indexes in the background...")
+            index.rebuild_in_background()
+
+def hydrate_candidates(candidates, user_id=None, user_client=None, columns=None):
+    """Fetch the entries for ranked candidates, keeping their order
+    
+    Args:
+        candidates: List of dictionaries with 'entry_id', best first; any other keys
+            (like 'similarity') are copied onto the returned entries
+        user_id: Optional user_id the entries must belong to
+        user_client: Optional Supabase client for user-specific queries
+        columns: Columns to return (defaults to HYDRATION_COLUMNS)
+    
+    Returns:
+        List of entry dictionaries, in candidate order
+    """
+    return hydrate_candidate_lists([candidates], user_id=user_id, user_client=user_client, columns=columns)[0]
+
+def hydrate_candidate_lists(candidate_lists, user_id=None, user_client=None, columns=None):
+    """Fetch the entries for several ranked candidate lists with a single query
+    
+    Only the requested columns are selected, so embedding vectors never leave the
+    database. When user_id is given, recently fetched rows are served from
+    entry_cache and only the misses are queried.
+    
+    Args:
+        candidate_lists: Lists of candidates, as passed to hydrate_candidates()
+        user_id: Optional user_id the entries must belong to
+        user_client: Optional Supabase client for user-specific queries
+        columns: Columns to return (defaults to HYDRATION_COLUMNS)
+    
+    Returns:
+        One list of entry dictionaries per candidate list, in candidate order (an
+        entry found by several lists is copied, so each copy keeps its own scores)
+    """
+    import logging
+    index_logger = logging.getLogger(__name__)
+    entry_ids = list(dict.fromkeys(c['entry_id'] for candidates in candidate_lists for c in candidates))
+    if not entry_ids:
+        return [[] for _ in candidate_lists]
+    
+    if columns is None:
+        columns = HYDRATION_COLUMNS
+    # Rows are cached with every hydration column, so any subset of them can be served
+    use_cache = user_id is not None and set(columns) <= set(HYDRATION_COLUMNS)
+    
+    entry_map = entry_cache.get_many(entry_ids, user_id) if use_cache else {}
+    missing_ids = [entry_id for entry_id in entry_ids if entry_id not in entry_map]
+    if missing_ids:
+        client = user_client if user_client else _default_client()
+        select_columns = HYDRATION_COLUMNS if use_cache else columns
+        query = client.table('entries').select(', '.join(select_columns)).in_('user_and_entry_id', missing_ids)
+        if user_id is not None:
+            query = query.eq('user_id', user_id)
+        response = query.execute()
         entries = response.data if response.data else []
-        
-        # Match entries with similarity scores
-        entry_map = {e.get('user_and_entry_id'): e for e in entries}
+        if use_cache:
+            entry_cache.put_many(entries)
+        for entry in entries:
+            entry_map[entry.get('user_and_entry_id')] = entry
+    index_logger.info(f"[hydrate_candidates] {len(entry_ids) - len(missing_ids)} of {len(entry_ids)} entries served from cache for user_id={user_id}")
+    
+    # Match entries with their scores (candidates are already sorted, best first)
+    result_lists = []
+    for candidates in candidate_lists:
         results = []
-        for candidate in candidates[:k]:
+        for candidate in candidates:
             candidate_id = candidate['entry_id']
             if candidate_id in entry_map:
-                entry = entry_map[candidate_id]
-                entry['similarity'] = candidate['similarity']
+                row = entry_map[candidate_id]
+                entry = {column: row.get(column) for column in columns}
+                for key, value in candidate.items():
+                    if key not in ('entry_id', 'distance'):
+                        entry[key] = value
                 results.append(entry)
-        
-        return results
-    
-    # Filter by user_id - fetch entries and filter
-    client = user_client if user_client else create_client(
-        os.environ.get("SUPABASE_URL"),
-        os.environ.get("SUPABASE_PUBLISHABLE_KEY")
-    )
-    
-    entry_ids = [c['entry_id'] for c in candidates]
-    index_logger.info(f"[search_similar] Filtering {len(entry_ids)} candidates by user_id={user_id}")
-    response = client.table('entries').select('*').in_('user_and_entry_id', entry_ids).eq('user_id', user_id).execute()
-    entries = response.data if response.data else []
-    index_logger.info(f"[search_similar] Database query returned {len(entries)} entries for user_id={user_id}")
-    
-    # Match entries with similarity scores and sort by similarity
-    entry_map = {e.get('user_and_entry_id'): e for e in entries}
-    results = []
-    for candidate in candidates:
-        candidate_id = candidate['entry_id']
-        if candidate_id in entry_map:
-            entry = entry_map[candidate_id]
-            entry['similarity'] = candidate['similarity']
-            results.append(entry)
-    
-    index_logger.info(f"[search_similar] Matched {len(results)} entries after filtering")
-    
-    # Sort by similarity (highest first) and return top k
-    results.sort(key=lambda x: x['similarity'], reverse=True)
-    final_results = results[:k]
-    index_logger.info(f"[search_similar] Returning {len(final_results)} final results")
-    return final_results
+        result_lists.append(results)
+    return result_lists
 
-def add_entry_to_index(entry_id, vector):
+_default_client_instance = None
+
+def _default_client():
+    """Supabase client with the publishable key, created once and reused for hydration"""
+    global _default_client_instance
+    if _default_client_instance is None:
+        _default_client_instance = create_client(
+            os.environ.get("SUPABASE_URL"),
+            os.environ.get("SUPABASE_PUBLISHABLE_KEY")
+        )
+    return _default_client_instance
+
+def add_entry_to_index(entry_id, vector, user_id=None, created_at=None):
     """Add a single entry to the index (for incremental updates)
     
     Args:
         entry_id: Database entry_id
         vector: Embedding vector for the entry
+        user_id: Owner of the entry (derived from entry_id if not given)
+        created_at: The entry's created_at (ISO string, datetime or epoch seconds; defaults to now)
     
     Returns:
-        True if successful, False otherwise (index will be rebuilt on next search)
+        True if successful, False otherwise (the user's index is then reconciled in the background)
     """
+    if user_id is None:
+        user_id = user_id_from_entry_id(entry_id)
     try:
-        # Try to load index if not already loaded
-        if index.index is None:
-            if not load_index():
-                # If no index exists, we'll build it on next search
-                return False
-        
-        success = index.add_entry(entry_id, vector)
-        if success:
-            # Save updated index
-            index.save('instance/hnsw_index')
-        return success
+        # Logged to the write-ahead log, snapshots are only rewritten at checkpoints
+        return index.add_entry(user_id, entry_id, vector, created_at=to_epoch_seconds(created_at))
+    except Exception as e:
+        print(f"Error adding entry to index: {str(e)}. Reconciling the user's index in the background.")
+        _recover_partition(user_id)
+        return False
+
+
+def add_entries_to_index(entries):
+    """Add a batch of new entries to the index with one log write and one add_items per user
+    
+    Args:
+        entries: List of (entry_id, vector, user_id, created_at) tuples; user_id
+            may be None (derived from entry_id), created_at as for add_entry_to_index
+    
+    Returns:
+        True if successful, False otherwise (the users' indexes are then reconciled in the background)
+    """
+    batch = []
+    for entry_id, vector, user_id, created_at in entries:
+        if user_id is None:
+            user_id = user_id_from_entry_id(entry_id)
+        batch.append((user_id, entry_id, vector, to_epoch_seconds(created_at)))
+    try:
+        index.add_entries(batch)
+        return True
     except Exception as e:
-        print(f"Error adding entry to index: {str(e)}. Index will be rebuilt on next search.")
-        # Clear the index so it gets rebuilt on next search
-        index.index = None
-        return False 
\ No newline at end of file
+        print(f"Error adding entries to index: {str(e)}. Reconciling the users' indexes in the background.")
+        for user_id in {user_id for user_id, _, _, _ in batch}:
+            _recover_partition(user_id)
+        return False
+
+def update_entry_in_index(entry_id, vector, user_id=None, created_at=None):
+    """Replace an entry's vector in the index after it was re-embedded
+    
+    Args:
+        entry_id: Database entry_id
+        vector: New embedding vector for the entry
+        user_id: Owner of the entry (derived from entry_id if not given)
+        created_at: The entry's created_at (keeps the indexed time if not given)
+    """
+    if user_id is None:
+        user_id = user_id_from_entry_id(entry_id)
+    try:
+        return index.update_entry(user_id, entry_id, vector, created_at=to_epoch_seconds(created_at))
+    except Exception as e:
+        print(f"Error updating entry in index: {str(e)}. Reconciling the user's index in the background.")
+        _recover_partition(user_id)
+        return False
+
+def remove_entry_from_index(entry_id, user_id=None):
+    """Remove a deleted entry from the index
+    
+    Args:
+        entry_id: Database entry_id
+        user_id: Owner of the entry (derived from entry_id if not given)
+    """
+    if user_id is None:
+        user_id = user_id_from_entry_id(entry_id)
+    try:
+        return index.remove_entry(user_id, entry_id)
+    except Exception as e:
+        print(f"Error removing entry from index: {str(e)}. Reconciling the user's index in the background.")
+        _recover_partition(user_id)
+        return False
+
+def _recover_partition(user_id):
+    """Reload a user's index after a failed write and patch in whatever the write missed"""
+    from backend.services.index_reconcile import reconcile_in_background
+    # The in-memory partition may be half-modified; the snapshot plus log is not
+    index.drop_partition(user_id)
+    reconcile_in_background(user_id)
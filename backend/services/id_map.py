@@ -0,0 +1,200 @@
+"""
+Compact mapping between a vector index's internal ids and database entry_ids.
+Entry ids are stored as one UTF-8 byte array indexed by an offsets array, with a
+sorted table of 64-bit hashes for lookups by entry_id. Saved maps are plain .npy
+files that load memory-mapped, so a million-entry index opens without building
+any Python objects. Changes since the last save are kept in small dictionaries
+and folded into the arrays as they grow.
+"""
+
+import hashlib
+from collections.abc import Mapping
+
+import numpy as np
+
+__all__ = ['EntryIdMap']
+
+# Changes kept in dictionaries before they are folded into the arrays (also
+# folded once they outnumber the entries in the arrays, so folding stays amortized O(1))
+_MIN_COMPACT_CHANGES = 4096
+
+_ARRAYS = ('blob', 'offsets', 'hashes', 'order')
+
+
+def _hash(entry_id):
+    # Stable across processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(entry_id.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class EntryIdMap(Mapping):
+    def __init__(self, blob=None, offsets=None, hashes=None, order=None):
+        """Initialize a map from database entry_ids to internal ids
+
+        Acts as a read-only dictionary of entry_id -> internal id; change it with
+        add() and remove(), and look internal ids up with entry_id().
+
+        Args:
+            blob: uint8 array of the UTF-8 entry_ids back to back, in internal id order
+            offsets: int64 array; internal id i maps to blob[offsets[i]:offsets[i + 1]]
+                (an empty span means the id is unused)
+            hashes: Sorted uint64 hashes of every entry_id in blob
+            order: int64 internal id of each hash
+        """
+        # Replaced as one tuple, so lookups made without the index lock never mix old and new arrays
+        self.arrays = (
+            np.zeros(0, dtype=np.uint8) if blob is None else blob,
+            np.zeros(1, dtype=np.int64) if offsets is None else offsets,
+            np.zeros(0, dtype=np.uint64) if hashes is None else hashes,
+            np.zeros(0, dtype=np.int64) if order is None else order,
+        )
+        self.added = {}  # Maps entry_ids added since the arrays were built to internal ids
+        self.added_ids = {}  # Reverse of added
+        self.removed = set()  # Internal ids in the arrays whose entries were removed since
+
+    @classmethod
+    def from_pairs(cls, entry_ids, internal_ids):
+        """Build a map straight into arrays from matching lists of entry_ids and internal ids"""
+        id_map = cls()
+        id_map.added = dict(zip(entry_ids, (int(internal_id) for internal_id in internal_ids)))
+        id_map.added_ids = {internal_id: entry_id for entry_id, internal_id in id_map.added.items()}
+        id_map.compact()
+        return id_map
+
+    def _stored_entry_id(self, internal_id, arrays=None):
+        """entry_id stored in the arrays for internal_id (None if unused or removed)"""
+        blob, offsets, _, _ = arrays or self.arrays
+        if internal_id >= len(offsets) - 1 or internal_id in self.removed:
+            return None
+        start, end = offsets[internal_id], offsets[internal_id + 1]
+        if start == end:
+            return None
+        return blob[start:end].tobytes().decode('utf-8')
+
+    def _stored_internal_id(self, entry_id):
+        arrays = self.arrays
+        _, _, hashes, order = arrays
+        hashed = np.uint64(_hash(entry_id))
+        position = int(np.searchsorted(hashes, hashed))
+        # Distinct entry_ids can share a hash, so every candidate is compared
+        while position < len(hashes) and hashes[position] == hashed:
+            internal_id = int(order[position])
+            if self._stored_entry_id(internal_id, arrays) == entry_id:
+                return internal_id
+            position += 1
+        return None
+
+    def __getitem__(self, entry_id):
+        internal_id = self.added.get(entry_id)
+        if internal_id is None:
+            internal_id = self._stored_internal_id(entry_id)
+        if internal_id is None:
+            raise KeyError(entry_id)
+        return internal_id
+
+    def __contains__(self, entry_id):
+        return entry_id in self.added or self._stored_internal_id(entry_id) is not None
+
+    def __len__(self):
+        return len(self.arrays[2]) - len(self.removed) + len(self.added)
+
+    def __iter__(self):
+        arrays = self.arrays
+        for internal_id in self._stored_internal_ids(arrays):
+            yield self._stored_entry_id(internal_id, arrays)
+        yield from list(self.added)
+
+    def _stored_internal_ids(self, arrays=None):
+        internal_ids = np.flatnonzero(np.diff((arrays or self.arrays)[1]))
+        if self.removed:
+            internal_ids = internal_ids[~np.isin(internal_ids, list(self.removed))]
+        return internal_ids
+
+    def entry_id(self, internal_id):
+        """entry_id of an internal id (raises KeyError if the id is unused)"""
+        internal_id = int(internal_id)
+        entry_id = self.added_ids.get(internal_id)
+        if entry_id is None:
+            entry_id = self._stored_entry_id(internal_id)
+        if entry_id is None:
+            raise KeyError(internal_id)
+        return entry_id
+
+    def internal_ids(self):
+        """Sorted int64 array of every internal id in use"""
+        added_ids = np.fromiter(self.added_ids, dtype=np.int64, count=len(self.added_ids))
+        return np.union1d(self._stored_internal_ids(), added_ids)
+
+    def add(self, entry_id, internal_id):
+        """Map a new entry_id (not already in the map) to internal_id"""
+        internal_id = int(internal_id)
+        self.added[entry_id] = internal_id
+        self.added_ids[internal_id] = entry_id
+        if len(self.added) + len(self.removed) > max(_MIN_COMPACT_CHANGES, len(self.arrays[2])):
+            self.compact()
+
+    def remove(self, entry_id):
+        """Forget an entry_id
+
+        Returns:
+            Its internal id, or None if it was not in the map
+        """
+        internal_id = self.added.pop(entry_id, None)
+        if internal_id is not None:
+            del self.added_ids[internal_id]
+            return internal_id
+        internal_id = self._stored_internal_id(entry_id)
+        if internal_id is not None:
+            self.removed.add(internal_id)
+        return internal_id
+
+    def compact(self):
+        """Fold the changes kept in dictionaries into freshly built arrays"""
+        blob, offsets, hashes, order = self.arrays
+        count = max(len(offsets) - 1, max(self.added_ids, default=-1) + 1)
+        entry_ids = [None] * count
+        stored_blob = blob.tobytes()
+        for internal_id in self._stored_internal_ids().tolist():
+            entry_ids[internal_id] = stored_blob[offsets[internal_id]:offsets[internal_id + 1]]
+        for internal_id, entry_id in self.added_ids.items():
+            entry_ids[internal_id] = entry_id.encode('utf-8')
+
+        lengths = np.fromiter((len(entry_id) if entry_id else 0 for entry_id in entry_ids), dtype=np.int64, count=count)
+        new_offsets = np.zeros(count + 1, dtype=np.int64)
+        np.cumsum(lengths, out=new_offsets[1:])
+
+        # Hashes of entries already in the arrays are reused rather than recomputed
+        hash_by_id = dict(zip(order.tolist(), hashes.tolist()))
+        live_ids = np.flatnonzero(lengths)
+        live_hashes = np.fromiter(
+            (hash_by_id[internal_id] if internal_id in hash_by_id and internal_id not in self.added_ids
+             else _hash(entry_ids[internal_id].decode('utf-8')) for internal_id in live_ids.tolist()),
+            dtype=np.uint64, count=len(live_ids))
+        sort = np.argsort(live_hashes, kind='stable')
+
+        self.arrays = (
+            np.frombuffer(b''.join(entry_id for entry_id in entry_ids if entry_id), dtype=np.uint8).copy(),
+            new_offsets,
+            live_hashes[sort],
+            live_ids[sort].astype(np.int64),
+        )
+        self.added = {}
+        self.added_ids = {}
+        self.removed = set()
+
+    def save(self, path):
+        """Write the map as {path}_entry_<array>.npy files"""
+        if self.added or self.removed:
+            self.compact()
+        for name, array in zip(_ARRAYS, self.arrays):
+            np.save(f"{path}_entry_{name}.npy", array)
+
+    @classmethod
+    def load(cls, path, mmap=False):
+        """Load a map written by save()
+
+        Args:
+            path: Path prefix the map was saved under
+            mmap: Map the arrays read-only instead of copying them (the files must
+                not be rewritten in place while mapped)
+        """
+        return cls(**{name: np.load(f"{path}_entry_{name}.npy", mmap_mode='r' if mmap else None) for name in _ARRAYS})
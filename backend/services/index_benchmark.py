@@ -0,0 +1,387 @@
+"""
+Offline recall/latency benchmark for the vector indexes.
+Builds HNSWIndex and ExactIndex over synthetic or exported embeddings for a grid
+of parameters and corpus sizes, and measures each one against brute-force ground
+truth. Results are written as JSON so runs from different releases can be compared.
+"""
+
+import multiprocessing
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import hnswlib
+import numpy as np
+import orjson
+
+from backend.services.exact_index import ExactIndex
+from backend.services.hnsw_index import HNSWIndex, extract_vectors
+
+__all__ = [
+    'synthetic_embeddings',
+    'load_exported_embeddings',
+    'exact_ground_truth',
+    'run_benchmark',
+    'compare_results',
+    'coarse_tradeoffs',
+]
+
+# Rows multiplied at a time when computing ground truth, to bound memory on 1M-vector corpora
+_GROUND_TRUTH_CHUNK_ROWS = 65536
+
+
+def synthetic_embeddings(count, dim=1536, num_clusters=100, spread=0.6, seed=0):
+    """Generate unit vectors clustered around random topics, like real journal embeddings
+
+    Args:
+        count: Number of vectors
+        dim: Dimensionality of vectors
+        num_clusters: Number of topic centers
+        spread: Noise added around each center (higher = harder to search)
+        seed: Random seed, so runs are reproducible
+
+    Returns:
+        float32 array of shape (count, dim)
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((num_clusters, dim)).astype(np.float32)
+    vectors = np.empty((count, dim), dtype=np.float32)
+    # Generated in chunks so a 1M x 1536 corpus needs no float64 temporaries
+    for start in range(0, count, _GROUND_TRUTH_CHUNK_ROWS):
+        stop = min(start + _GROUND_TRUTH_CHUNK_ROWS, count)
+        noise = rng.standard_normal((stop - start, dim), dtype=np.float32)
+        vectors[start:stop] = centers[rng.integers(0, num_clusters, stop - start)] + spread * noise
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def load_exported_embeddings(path, dim=1536):
+    """Load embeddings exported from the entries table
+
+    Args:
+        path: A .npy matrix, or a JSON array / JSON Lines file of entry rows with a 'vectors' field
+        dim: Expected dimensionality of vectors
+
+    Returns:
+        float32 array of shape (count, dim)
+    """
+    if path.endswith('.npy'):
+        vectors = np.load(path).astype(np.float32)
+    else:
+        with open(path, 'rb') as f:
+            data = f.read()
+        if data.lstrip().startswith(b'['):
+            rows = orjson.loads(data)
+        else:
+            rows = [orjson.loads(line) for line in data.splitlines() if line.strip()]
+        # Exports do not always include the primary key, any unique id will do here
+        for i, row in enumerate(rows):
+            row.setdefault('user_and_entry_id', i)
+        _, vectors = extract_vectors(rows, dim)
+
+    if vectors.ndim != 2 or vectors.shape[1] != dim:
+        raise ValueError(f"Expected vectors of dimension {dim}, got shape {vectors.shape}")
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def exact_ground_truth(corpus, queries, k):
+    """Brute-force the true k nearest neighbors of each query by cosine similarity
+
+    Args:
+        corpus: Unit-normalized float32 array of shape (n, dim)
+        queries: Unit-normalized float32 array of shape (q, dim)
+        k: Number of neighbors
+
+    Returns:
+        int array of shape (q, k) with corpus row numbers
+    """
+    best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+    best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+    for start in range(0, len(corpus), _GROUND_TRUTH_CHUNK_ROWS):
+        scores = queries @ corpus[start:start + _GROUND_TRUTH_CHUNK_ROWS].T
+        rows = np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)
+        # Keep a running top k, so only one chunk of scores is in memory at a time
+        scores = np.concatenate([best_scores, scores], axis=1)
+        rows = np.concatenate([best_rows, rows], axis=1)
+        keep = np.argpartition(-scores, min(k, scores.shape[1]) - 1, axis=1)[:, :k]
+        best_scores = np.take_along_axis(scores, keep, axis=1)
+        best_rows = np.take_along_axis(rows, keep, axis=1)
+    return best_rows
+
+
+def resident_memory_bytes():
+    """Current resident set size of this process"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # No procfs (e.g. macOS): fall back to the peak, which is still comparable between runs
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if platform.system() == 'Darwin' else peak * 1024
+
+
+def _measure_queries(index, queries, truth, k):
+    """Run every query one at a time, as the API does, and score it against truth"""
+    latencies = np.empty(len(queries))
+    hits = 0
+    started = time.perf_counter()
+    for i, query in enumerate(queries):
+        query_started = time.perf_counter()
+        results = index.search(query, k=k)
+        latencies[i] = time.perf_counter() - query_started
+        hits += len({int(r['entry_id']) for r in results} & set(truth[i].tolist()))
+    elapsed = time.perf_counter() - started
+
+    return {
+        'p50_ms': float(np.percentile(latencies, 50) * 1000),
+        'p99_ms': float(np.percentile(latencies, 99) * 1000),
+        'qps': len(queries) / elapsed,
+        'recall_at_k': hits / (k * len(queries)),
+    }
+
+
+def _measure_in_fresh_process(index_class, index_kwargs, path, load_kwargs, queries, k):
+    """Resident memory a new worker needs to load an index and serve the queries
+
+    Runs in a spawned process, where no freed memory from earlier builds can be
+    reused and hide the cost.
+    """
+    before = resident_memory_bytes()
+    index = index_class(**index_kwargs)
+    index.load(path, **load_kwargs)
+    for query in queries:
+        # Counts the pages of memory-mapped snapshots that searches touch
+        index.search(query, k=k)
+    return resident_memory_bytes() - before
+
+
+def _build_and_reload(index_class, index_kwargs, corpus, queries, k, load_kwargs=None):
+    """Build an index, save it and load it back the way a worker would
+
+    Returns:
+        Tuple of (loaded index, build seconds, resident bytes of a worker serving the index)
+    """
+    load_kwargs = load_kwargs or {}
+    started = time.perf_counter()
+    built = index_class(**index_kwargs)
+    # Entry ids are strings, as in the database; each one is its corpus row number
+    built.build_from_vectors([str(row) for row in range(len(corpus))], corpus)
+    build_seconds = time.perf_counter() - started
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'index')
+        built.save(path)
+        del built
+
+        with multiprocessing.get_context('spawn').Pool(1) as pool:
+            memory_bytes = pool.apply(_measure_in_fresh_process, (index_class, index_kwargs, path, load_kwargs, queries, k))
+        loaded = index_class(**index_kwargs)
+        loaded.load(path, **load_kwargs)
+    return loaded, build_seconds, memory_bytes
+
+
+def _benchmark_hnsw(corpus, queries, truth, k, M, ef_construction, ef_search_values, coarse_dim=None, rerank_factor=4):
+    index, build_seconds, memory_bytes = _build_and_reload(
+        HNSWIndex, {'dim': corpus.shape[1], 'ef_construction': ef_construction, 'M': M,
+                    'coarse_dim': coarse_dim, 'rerank_factor': rerank_factor},
+        corpus, queries, k,
+        # Id mappings and the full vectors of coarse graphs are memory-mapped, as in production
+        {'mmap': True})
+
+    results = []
+    # ef only affects searching, so every value is measured on the same graph
+    for ef_search in ef_search_values:
+        index.ef_search = ef_search
+        index.index.set_ef(ef_search)
+        result = {
+            'index': 'hnsw',
+            'M': M,
+            'ef_construction': ef_construction,
+            'ef_search': ef_search,
+            'coarse_dim': index.coarse_dim,
+            'rerank_factor': rerank_factor if index.coarse_dim else None,
+            'build_seconds': build_seconds,
+            'memory_bytes': memory_bytes,
+        }
+        result.update(_measure_queries(index, queries, truth, k))
+        results.append(result)
+    return results
+
+
+def _benchmark_exact(corpus, queries, truth, k, quantization, rerank_factor):
+    index, build_seconds, memory_bytes = _build_and_reload(
+        ExactIndex, {'dim': corpus.shape[1], 'quantization': quantization, 'rerank_factor': rerank_factor},
+        corpus, queries, k,
+        # Quantized indexes are always served from a memory-mapped snapshot
+        {'mmap': quantization is not None})
+
+    result = {
+        'index': 'exact',
+        'quantization': quantization,
+        'rerank_factor': rerank_factor if quantization else None,
+        'build_seconds': build_seconds,
+        'memory_bytes': memory_bytes,
+    }
+    result.update(_measure_queries(index, queries, truth, k))
+    return result
+
+
+def _run_metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'hnswlib': getattr(hnswlib, '__version__', None),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'build_threads': int(os.environ.get('INDEX_BUILD_THREADS', os.cpu_count() or 1)),
+    }
+
+
+def run_benchmark(sizes, dim=1536, num_queries=200, k=5, M_values=(16,), ef_construction_values=(200,),
+                  ef_search_values=(50,), coarse_configs=((None, 4),), exact_configs=((None, 4),), embeddings=None,
+                  output_path=None, seed=0):
+    """Benchmark every parameter combination at every corpus size
+
+    Args:
+        sizes: Corpus sizes to test (sizes larger than the available embeddings are skipped)
+        dim: Dimensionality of vectors
+        num_queries: Number of held-out queries per corpus size
+        k: Number of neighbors per query (recall@k is reported)
+        M_values: HNSW M values to try
+        ef_construction_values: HNSW ef_construction values to try
+        ef_search_values: HNSW search ef values to try on each built graph
+        coarse_configs: (coarse_dim, rerank_factor) pairs to build HNSW graphs with
+            (None for a graph over the full vectors, which coarse_tradeoffs compares against)
+        exact_configs: (quantization, rerank_factor) pairs to benchmark ExactIndex with
+            (empty to skip exact search, which is slow on large corpora)
+        embeddings: Optional float32 array of real embeddings (synthetic vectors are used if None)
+        output_path: Optional path of a JSON file to write the results to
+        seed: Random seed for synthetic data and query sampling
+
+    Returns:
+        Dict with run metadata and one result per (size, configuration)
+    """
+    report = {'run': _run_metadata(), 'k': k, 'num_queries': num_queries,
+              'source': 'synthetic' if embeddings is None else 'exported', 'results': []}
+
+    if embeddings is None:
+        embeddings = synthetic_embeddings(max(sizes) + num_queries, dim=dim, seed=seed)
+    # Queries are held out of every corpus, so no query is its own nearest neighbor
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(embeddings))
+    queries = embeddings[order[:num_queries]]
+    pool = embeddings[order[num_queries:]]
+
+    for size in sizes:
+        if size > len(pool):
+            print(f"[benchmark] Skipping size {size}, only {len(pool)} vectors available")
+            continue
+        corpus = np.ascontiguousarray(pool[:size])
+        truth = exact_ground_truth(corpus, queries, k)
+        print(f"[benchmark] Corpus of {size} vectors, {num_queries} queries, k={k}")
+
+        results = []
+        for M in M_values:
+            for ef_construction in ef_construction_values:
+                for coarse_dim, rerank_factor in coarse_configs:
+                    results.extend(_benchmark_hnsw(corpus, queries, truth, k, M, ef_construction, ef_search_values,
+                                                   coarse_dim, rerank_factor))
+        for quantization, rerank_factor in exact_configs:
+            results.append(_benchmark_exact(corpus, queries, truth, k, quantization, rerank_factor))
+
+        for result in results:
+            result['size'] = size
+            print(f"[benchmark] {_describe(result)}: recall@{k}={result['recall_at_k']:.3f} "
+                  f"p50={result['p50_ms']:.2f}ms p99={result['p99_ms']:.2f}ms qps={result['qps']:.0f} "
+                  f"build={result['build_seconds']:.1f}s memory={result['memory_bytes'] / 2**20:.1f}MB")
+        report['results'].extend(results)
+
+        if output_path:
+            # Rewritten after every size so a long 1M-vector run leaves partial results
+            with open(output_path, 'wb') as f:
+                f.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+    return report
+
+
+def _config_key(result):
+    """Identify the same configuration across two runs"""
+    if result['index'] == 'hnsw':
+        # Runs from before coarse graphs existed only have full-dimension graphs
+        return ('hnsw', result['size'], result['M'], result['ef_construction'], result['ef_search'],
+                result.get('coarse_dim'), result.get('rerank_factor'))
+    return ('exact', result['size'], result['quantization'], result['rerank_factor'])
+
+
+def _describe(result):
+    if result['index'] == 'hnsw':
+        description = f"hnsw size={result['size']} M={result['M']} ef_construction={result['ef_construction']} ef_search={result['ef_search']}"
+        if result.get('coarse_dim'):
+            description += f" coarse_dim={result['coarse_dim']} rerank_factor={result['rerank_factor']}"
+        return description
+    return f"exact size={result['size']} quantization={result['quantization']} rerank_factor={result['rerank_factor']}"
+
+
+def compare_results(baseline, current, recall_tolerance=0.01, latency_tolerance=0.25):
+    """Find configurations that got worse since a baseline run
+
+    Args:
+        baseline: Report returned by run_benchmark (or loaded from its JSON output)
+        current: Report to check against the baseline
+        recall_tolerance: Largest acceptable drop in recall@k
+        latency_tolerance: Largest acceptable relative increase in p99 latency
+
+    Returns:
+        List of human-readable regression descriptions (empty if none)
+    """
+    baseline_results = {_config_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        previous = baseline_results.get(_config_key(result))
+        if previous is None:
+            continue
+        if result['recall_at_k'] < previous['recall_at_k'] - recall_tolerance:
+            regressions.append(f"{_describe(result)}: recall@k fell from {previous['recall_at_k']:.3f} to {result['recall_at_k']:.3f}")
+        if result['p99_ms'] > previous['p99_ms'] * (1 + latency_tolerance):
+            regressions.append(f"{_describe(result)}: p99 latency rose from {previous['p99_ms']:.2f}ms to {result['p99_ms']:.2f}ms")
+    return regressions
+
+
+def coarse_tradeoffs(report):
+    """Compare every coarse HNSW graph with the full-dimension graph built with the same parameters
+
+    Args:
+        report: Report returned by run_benchmark (or loaded from its JSON output)
+
+    Returns:
+        List of human-readable comparisons (empty if the report has no pairs to compare)
+    """
+    full_graphs = {
+        (result['size'], result['M'], result['ef_construction'], result['ef_search']): result
+        for result in report['results'] if result['index'] == 'hnsw' and not result.get('coarse_dim')
+    }
+    lines = []
+    for result in report['results']:
+        if result['index'] != 'hnsw' or not result.get('coarse_dim'):
+            continue
+        full = full_graphs.get((result['size'], result['M'], result['ef_construction'], result['ef_search']))
+        if full is None:
+            continue
+        lines.append(
+            f"{_describe(result)}: recall@{report['k']} {result['recall_at_k']:.3f} vs {full['recall_at_k']:.3f} "
+            f"({result['recall_at_k'] - full['recall_at_k']:+.3f}), "
+            f"p99 {result['p99_ms']:.2f}ms vs {full['p99_ms']:.2f}ms, "
+            f"memory {result['memory_bytes'] / 2**20:.1f}MB vs {full['memory_bytes'] / 2**20:.1f}MB, "
+            f"build {result['build_seconds']:.1f}s vs {full['build_seconds']:.1f}s"
+        )
+    return lines
@@ -0,0 +1,255 @@
+"""
+Incremental reconciliation of the vector indexes with the entries table.
+Instead of re-downloading every vector, a run pulls the entries vectorized since
+the last run (tracked by a created_at + entry id high-water mark) and diffs the
+ids of vectorized entries against the indexed ids to catch missed adds and
+deletes: every run for the users with new entries, and for everyone on a
+slower cadence. Differences are patched into the indexes through the
+write-ahead log, so every worker picks them up.
+"""
+
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from backend.services.hnsw_index import create_service_client, extract_created_at, extract_vectors, index as vector_index
+from backend.services.index_wal import WALRecord, OP_ADD, OP_DELETE, write_file_atomic
+from backend.services.locks import file_lock
+
+__all__ = ['reconcile_index', 'reconcile_in_background']
+
+# Ids per request when fetching the vectors of missing entries
+_FETCH_CHUNK = 200
+
+# Seconds between id diffs of every indexed user (users with new entries are diffed every run)
+FULL_DIFF_INTERVAL = int(os.environ.get('RECONCILE_FULL_DIFF_INTERVAL', 6 * 60 * 60))
+
+_background_threads = {}  # Maps the user_id being reconciled (None for everyone) to its thread
+_background_lock = threading.Lock()
+
+
+def _state_path(partitioned_index):
+    # Not a '.json' file, which the index directory reserves for snapshot pointers
+    return os.path.join(partitioned_index.path, 'reconcile.state')
+
+
+def _read_high_water_mark(partitioned_index):
+    try:
+        with open(_state_path(partitioned_index)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _write_high_water_mark(partitioned_index, mark):
+    os.makedirs(partitioned_index.path, exist_ok=True)
+    write_file_atomic(_state_path(partitioned_index), json.dumps(mark).encode('utf-8'))
+
+
+def _quote(value):
+    # PostgREST filter values containing ',', '.', ':' or parentheses must be quoted
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _latest_mark(supabase):
+    """High-water mark of the newest vectorized entry, or None if there are none"""
+    response = supabase.table('entries').select('created_at, user_and_entry_id').not_.is_('vectors', 'null')\
+        .order('created_at', desc=True).order('user_and_entry_id', desc=True).limit(1).execute()
+    if not response.data:
+        return None
+    row = response.data[0]
+    return {'created_at': row['created_at'], 'entry_id': row['user_and_entry_id']}
+
+
+def _iter_vectorized_since(supabase, mark, page_size):
+    """Yield pages of vectorized entries created after the (created_at, entry id) mark"""
+    while True:
+        created_at, entry_id = _quote(mark['created_at']), _quote(mark['entry_id'])
+        response = supabase.table('entries').select('user_and_entry_id, user_id, created_at, vectors').not_.is_('vectors', 'null')\
+            .or_(f"created_at.gt.{created_at},and(created_at.eq.{created_at},user_and_entry_id.gt.{entry_id})")\
+            .order('created_at').order('user_and_entry_id').limit(page_size).execute()
+        page = response.data if response.data else []
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        mark = {'created_at': page[-1]['created_at'], 'entry_id': page[-1]['user_and_entry_id']}
+
+
+def _vectorized_ids_by_user(supabase, user_ids, page_size):
+    """Ids of every vectorized entry, grouped by user_id (only ids are transferred)
+
+    Args:
+        supabase: Service client
+        user_ids: Only fetch the entries of these users (None for everyone)
+        page_size: Ids per request
+    """
+    if user_ids is not None:
+        ids_by_user = {}
+        user_ids = sorted(user_ids)
+        for start in range(0, len(user_ids), _FETCH_CHUNK):
+            ids_by_user.update(_vectorized_ids_page(supabase, user_ids[start:start + _FETCH_CHUNK], page_size))
+        return ids_by_user
+    return _vectorized_ids_page(supabase, None, page_size)
+
+
+def _vectorized_ids_page(supabase, user_ids, page_size):
+    ids_by_user = {}
+    last_entry_id = None
+    while True:
+        query = supabase.table('entries').select('user_and_entry_id, user_id').not_.is_('vectors', 'null')
+        if user_ids is not None:
+            query = query.in_('user_id', user_ids)
+        if last_entry_id is not None:
+            query = query.gt('user_and_entry_id', last_entry_id)
+        response = query.order('user_and_entry_id').limit(page_size).execute()
+        page = response.data if response.data else []
+        for entry in page:
+            ids_by_user.setdefault(str(entry['user_id']), set()).add(entry['user_and_entry_id'])
+        if len(page) < page_size:
+            return ids_by_user
+        last_entry_id = page[-1]['user_and_entry_id']
+
+
+def _add_records(partitioned_index, user_id, entries):
+    """OP_ADD records for the valid vectors among entries"""
+    entry_ids, vectors = extract_vectors(entries, partitioned_index.dim)
+    created_at = extract_created_at(entries, entry_ids)
+    return [
+        WALRecord(OP_ADD, str(user_id), entry_id, vector, None if np.isnan(timestamp) else float(timestamp))
+        for entry_id, vector, timestamp in zip(entry_ids, vectors, created_at)
+    ]
+
+
+def reconcile_index(user_id=None, partitioned_index=None):
+    """Patch the indexes so they match the vectorized entries in the database
+
+    Only users that already have an index are patched; users without one are
+    built from the database in full on first use anyway. A run checks:
+
+    1. Entries created after the stored high-water mark (skipped when reconciling
+       a single user, as the mark covers everyone): indexed if missing.
+    2. The ids of the vectorized entries of users with new entries, of everyone
+       every RECONCILE_FULL_DIFF_INTERVAL seconds, or of the single user being
+       reconciled: missing ones are fetched and indexed, indexed ones no longer in
+       the database are removed. This also catches entries vectorized long after
+       they were created.
+
+    Only one run at a time per host; a call made while another worker is
+    reconciling returns None straight away (its changes arrive through the log).
+
+    Args:
+        user_id: Only reconcile this user (None for everyone)
+        partitioned_index: Index to patch (defaults to the global index)
+
+    Returns:
+        Dictionary with the number of entries 'added' and 'removed', or None if skipped or failed
+    """
+    partitioned_index = partitioned_index or vector_index
+    with file_lock(os.path.join(partitioned_index.path, 'reconcile.lock'), blocking=False) as acquired:
+        if not acquired:
+            print("[reconcile] Another worker is already reconciling, skipping")
+            return None
+        try:
+            return _reconcile_locked(partitioned_index, user_id)
+        except Exception as e:
+            print(f"[reconcile] ERROR: Reconciliation failed: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            return None
+
+
+def _reconcile_locked(partitioned_index, user_id):
+    supabase = create_service_client()
+    if supabase is None:
+        return None
+
+    started = time.perf_counter()
+    page_size = int(os.environ.get('INDEX_BUILD_PAGE_SIZE', 500))
+    partitioned_index.catch_up()
+    if user_id is not None:
+        user_ids = [str(user_id)]
+    else:
+        user_ids = set(partitioned_index.saved_user_ids()) | set(partitioned_index.partitions)
+
+    # Ids indexed before the database is read: entries added while reading are not
+    # in these sets, so they are never removed by mistake. Users without an index are left out
+    indexed_before = partitioned_index.indexed_entry_ids(user_ids)
+    added = removed = 0
+
+    # 1. New entries since the last run
+    diff_user_ids = {str(user_id)}  # Users whose ids are diffed (None for everyone)
+    if user_id is None:
+        state = _read_high_water_mark(partitioned_index) or {}
+        # State written before full diffs were spaced out has no full_diff_at
+        full_diff_at = state.get('full_diff_at', 0)
+        if time.time() - full_diff_at >= FULL_DIFF_INTERVAL:
+            diff_user_ids, full_diff_at = None, time.time()
+        else:
+            diff_user_ids = set()
+
+        # Taken before the id diff, so entries vectorized during this run are caught next time
+        new_mark = state if 'created_at' in state else _latest_mark(supabase)
+        pages = _iter_vectorized_since(supabase, state, page_size) if 'created_at' in state else []
+        for page in pages:
+            entries_by_user = {}
+            for entry in page:
+                uid = str(entry.get('user_id'))
+                if uid not in indexed_before:
+                    continue
+                if diff_user_ids is not None:
+                    diff_user_ids.add(uid)
+                if entry['user_and_entry_id'] not in indexed_before[uid]:
+                    entries_by_user.setdefault(uid, []).append(entry)
+            records = [record for uid, entries in entries_by_user.items() for record in _add_records(partitioned_index, uid, entries)]
+            added += partitioned_index.log_changes(records)
+            new_mark = {'created_at': page[-1]['created_at'], 'entry_id': page[-1]['user_and_entry_id']}
+
+    # 2. Id diff, removing only entries that were indexed before the database was read
+    diffed = [uid for uid in indexed_before if diff_user_ids is None or uid in diff_user_ids]
+    ids_by_user = _vectorized_ids_by_user(supabase, diff_user_ids, page_size) if diffed else {}
+    indexed_now = partitioned_index.indexed_entry_ids(diffed)
+    for uid in diffed:
+        database_ids = ids_by_user.get(uid, set())
+        records = [WALRecord(OP_DELETE, uid, entry_id, None) for entry_id in indexed_before[uid] - database_ids]
+        missing_ids = sorted(database_ids - indexed_now.get(uid, set()))
+        for start in range(0, len(missing_ids), _FETCH_CHUNK):
+            response = supabase.table('entries').select('user_and_entry_id, user_id, created_at, vectors')\
+                .in_('user_and_entry_id', missing_ids[start:start + _FETCH_CHUNK]).execute()
+            records.extend(_add_records(partitioned_index, uid, response.data or []))
+
+        partitioned_index.log_changes(records)
+        removed += sum(1 for record in records if record.op == OP_DELETE)
+        added += sum(1 for record in records if record.op == OP_ADD)
+
+    if user_id is None and new_mark is not None:
+        _write_high_water_mark(partitioned_index, {
+            'created_at': new_mark['created_at'],
+            'entry_id': new_mark['entry_id'],
+            'full_diff_at': full_diff_at
+        })
+
+    elapsed = time.perf_counter() - started
+    print(f"[reconcile] Checked {len(indexed_before)} users ({len(diffed)} id diffs) in {elapsed:.1f}s: {added} entries added, {removed} removed")
+    return {'added': added, 'removed': removed}
+
+
+def reconcile_in_background(user_id=None):
+    """Start reconcile_index() in a background thread unless one is already running for user_id
+
+    Returns:
+        True if a new run was started
+    """
+    with _background_lock:
+        thread = _background_threads.get(user_id)
+        if thread is not None and thread.is_alive():
+            return False
+        thread = threading.Thread(target=reconcile_index, args=(user_id,))
+        thread.daemon = True
+        _background_threads[user_id] = thread
+        thread.start()
+    return True
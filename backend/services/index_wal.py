@@ -0,0 +1,184 @@
+"""
+Append-only write-ahead log for incremental vector index updates.
+New vectors are appended as compact binary records and replayed on load, so a
+journal write costs one small append instead of re-saving the whole index.
+"""
+
+import fcntl
+import os
+import struct
+import threading
+import zlib
+from collections import namedtuple
+from contextlib import contextmanager
+
+import numpy as np
+
+__all__ = ['IndexWAL', 'WALRecord', 'OP_ADD', 'OP_DELETE', 'OP_UPDATE', 'write_file_atomic']
+
+OP_ADD = 1
+OP_DELETE = 2  # Carries no vector
+OP_UPDATE = 3  # Replaces the vector of an existing entry
+
+# Every record is: payload length, crc32 of payload, then the payload
+_FRAME = struct.Struct('<II')
+# Payload header: op, user_id length, entry_id length, number of float32 values
+_PAYLOAD = struct.Struct('<BHHI')
+# Optional payload trailer: entry creation time in epoch seconds (absent in older logs)
+_CREATED_AT = struct.Struct('<d')
+
+WALRecord = namedtuple('WALRecord', ['op', 'user_id', 'entry_id', 'vector', 'created_at'], defaults=(None,))
+
+
+def write_file_atomic(path, data):
+    """Write bytes to path so readers only ever see the old or the new contents"""
+    tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class IndexWAL:
+    def __init__(self, path):
+        """Initialize write-ahead log
+
+        Args:
+            path: Log file path (a '<path>.lock' file is used to serialize writers across processes)
+        """
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._lock_depth = 0
+        self._lock_file = None
+
+    @contextmanager
+    def lock(self):
+        """Hold the exclusive writer lock shared by every worker process (re-entrant within a process)"""
+        with self._thread_lock:
+            if self._lock_depth == 0:
+                dir_path = os.path.dirname(self.path)
+                if dir_path:
+                    os.makedirs(dir_path, exist_ok=True)
+                self._lock_file = open(f"{self.path}.lock", 'a')
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+                    self._lock_file.close()
+                    self._lock_file = None
+
+    @contextmanager
+    def local_lock(self, blocking=True):
+        """Hold only the in-process part of lock(), for applying records already in the log
+
+        Yields whether the lock was acquired (always True when blocking).
+        """
+        acquired = self._thread_lock.acquire(blocking)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self._thread_lock.release()
+
+    def append(self, op, user_id, entry_id, vector=None, created_at=None):
+        """Durably append one record to the log
+
+        Args:
+            op: Operation code (OP_ADD, OP_DELETE or OP_UPDATE)
+            user_id: Owner of the entry
+            entry_id: Database entry_id
+            vector: Embedding vector, or None for operations that do not carry one
+            created_at: Entry creation time in epoch seconds, or None if unknown
+        """
+        self._write(self._encode(op, user_id, entry_id, vector, created_at))
+
+    def append_many(self, records):
+        """Durably append several WALRecords with a single write and fsync"""
+        if records:
+            self._write(b''.join(self._encode(*record) for record in records))
+
+    def _encode(self, op, user_id, entry_id, vector=None, created_at=None):
+        user_bytes = str(user_id).encode('utf-8')
+        entry_bytes = str(entry_id).encode('utf-8')
+        vector_bytes = b'' if vector is None else np.asarray(vector, dtype='<f4').tobytes()
+        created_at_bytes = b'' if created_at is None else _CREATED_AT.pack(created_at)
+        payload = _PAYLOAD.pack(op, len(user_bytes), len(entry_bytes), len(vector_bytes) // 4) + user_bytes + entry_bytes + vector_bytes + created_at_bytes
+        return _FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+
+    def _write(self, data):
+        with self.lock():
+            with open(self.path, 'ab') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def read(self, offset=0):
+        """Read every complete record starting at offset
+
+        A torn record at the end of the file (crash mid-append) ends the read.
+
+        Returns:
+            Tuple of (list of WALRecord, offset after the last complete record, log identity)
+        """
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return [], 0, None
+
+        with f:
+            identity = self._identity(os.fstat(f.fileno()))
+            f.seek(offset)
+            data = f.read()
+
+        records = []
+        position = 0
+        while position + _FRAME.size <= len(data):
+            length, checksum = _FRAME.unpack_from(data, position)
+            payload = data[position + _FRAME.size:position + _FRAME.size + length]
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                break
+
+            op, user_len, entry_len, num_floats = _PAYLOAD.unpack_from(payload)
+            cursor = _PAYLOAD.size
+            user_id = payload[cursor:cursor + user_len].decode('utf-8')
+            cursor += user_len
+            entry_id = payload[cursor:cursor + entry_len].decode('utf-8')
+            cursor += entry_len
+            vector = np.frombuffer(payload, dtype='<f4', count=num_floats, offset=cursor).astype(np.float32) if num_floats else None
+            cursor += num_floats * 4
+            created_at = _CREATED_AT.unpack_from(payload, cursor)[0] if cursor + _CREATED_AT.size <= len(payload) else None
+
+            records.append(WALRecord(op, user_id, entry_id, vector, created_at))
+            position += _FRAME.size + length
+
+        return records, offset + position, identity
+
+    def size(self):
+        """Current size of the log in bytes"""
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def identity(self):
+        """Identifier that changes whenever the log is reset by a checkpoint"""
+        try:
+            return self._identity(os.stat(self.path))
+        except FileNotFoundError:
+            return None
+
+    def _identity(self, stat_result):
+        return (stat_result.st_dev, stat_result.st_ino)
+
+    def reset(self):
+        """Start a new empty log (call while holding lock() after checkpointing)
+
+        The old file is replaced rather than truncated, so other workers notice the
+        change through identity() instead of reading from a stale offset.
+        """
+        write_file_atomic(self.path, b'')
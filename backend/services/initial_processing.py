@@ -1,8 +1,11 @@
 from openai import OpenAI
 from flask import current_app
+import hashlib
 import json, os
 from dotenv import load_dotenv
 from jinja2 import Environment, FileSystemLoader
+from backend.services.embedding_cache import normalize_text
+from backend.services.processing_cache import processing_cache, processing_key
 
 # Force reload the .env file
 load_dotenv(override=True)
@@ -10,14 +13,9 @@ load_dotenv(override=True)
 # Initialize the client with the API key from .env
 client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
 
-def process_text(content):
-    try:        
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            # response_format = {"type": "json_object"},
-            messages=[
-                {"role": "system", "content": 
-                 """You are an advanced language model designed to process and refine user input for clarity, conciseness, and structured understanding. Your goal is to restate the given text while maintaining its original meaning but making it easier to analyze, categorize, and act upon. Place the text content into a paragraph structure, and include multiple paragraphs if necessary. 
+PROCESSING_MODEL = "gpt-4o-mini"
+
+PROCESSING_PROMPT = """You are an advanced language model designed to process and refine user input for clarity, conciseness, and structured understanding. Your goal is to restate the given text while maintaining its original meaning but making it easier to analyze, categorize, and act upon. Place the text content into a paragraph structure, and include multiple paragraphs if necessary. 
 
                     <Follow these guidelines:>
 
@@ -39,14 +37,49 @@ def process_text(content):
                         Input: Why is my internet so slow all of a sudden? It was fine earlier but now everything's lagging.
                         processed_text: User is experiencing sudden internet slowdowns and seeks troubleshooting assistance.
                     """
-                    },
-                {"role": "user", "content": f"Process and refine the following user input for clarity, conciseness, and structured understanding: {content}."}
+
+PROCESSING_REQUEST = "Process and refine the following user input for clarity, conciseness, and structured understanding: {content}."
+
+# Changes whenever the model or prompt does, so cached results of an older prompt are never served
+PROMPT_VERSION = hashlib.sha256(f"{PROCESSING_MODEL}\n{PROCESSING_PROMPT}\n{PROCESSING_REQUEST}".encode('utf-8')).hexdigest()[:16]
+
+# Entries with at most this many words are stored as written instead of being sent
+# to the model (0 sends everything)
+FAST_PATH_MAX_WORDS = int(os.environ.get('PROCESS_TEXT_FAST_PATH_WORDS', 8))
+
+def process_text(content):
+    """Restate content clearly and concisely with the processing model
+    
+    Text processed before (by any worker on this host, with the same prompt) is
+    served from the processing cache, and very short entries skip the model.
+    
+    Returns:
+        The processed text ('' for empty content), or None if the API call failed
+    """
+    if not content:
+        return ''
+    normalized = normalize_text(content)
+    if len(normalized.split()) <= FAST_PATH_MAX_WORDS:
+        return normalized
+    key = processing_key(PROMPT_VERSION, content)
+    cached = processing_cache.get(key)
+    if cached is not None:
+        return cached
+    try:        
+        response = client.chat.completions.create(
+            model=PROCESSING_MODEL,
+            # response_format = {"type": "json_object"},
+            messages=[
+                {"role": "system", "content": PROCESSING_PROMPT},
+                {"role": "user", "content": PROCESSING_REQUEST.format(content=content)}
             ],
             max_tokens = 4000,
             temperature = 1
 
         )
         processed_text = response.choices[0].message.content
+        if processed_text:
+            processing_cache.put(key, processed_text)
         return processed_text  
 
     except Exception as e:
@@ -0,0 +1,213 @@
+"""
+Durable journal of entry post-processing jobs, in a SQLite file shared by every
+worker on the host. A job is recorded before it is queued and deleted once the
+entry is embedded and indexed, so jobs lost with a worker (a deploy, a crash,
+a recycled process) are still on disk and another worker picks them up. Each
+worker holds a lock file for as long as it lives; jobs owned by a worker whose
+lock is free again are orphaned. Only entry ids are stored, never the text.
+"""
+
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+__all__ = ['JobJournal', 'job_journal']
+
+
+class JobJournal:
+    def __init__(self, path=None, max_attempts=None, retry_delay=None):
+        """Initialize a journal of post-processing jobs
+
+        Args:
+            path: SQLite file of the journal, '' to disable it
+                (defaults to JOB_JOURNAL_PATH or instance/jobs.sqlite3)
+            max_attempts: Runs of a job before it is given up on
+                (defaults to JOB_JOURNAL_MAX_ATTEMPTS or 5)
+            retry_delay: Seconds before a failed job is retried, doubling with
+                every failure (defaults to JOB_JOURNAL_RETRY_DELAY or 60)
+        """
+        if path is None:
+            path = os.environ.get('JOB_JOURNAL_PATH', 'instance/jobs.sqlite3')
+        if max_attempts is None:
+            max_attempts = int(os.environ.get('JOB_JOURNAL_MAX_ATTEMPTS', 5))
+        if retry_delay is None:
+            retry_delay = float(os.environ.get('JOB_JOURNAL_RETRY_DELAY', 60))
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:12]}"  # This process, in the owner column
+        self.owner_lock = None  # Open lock file held for the life of the process
+        self.lock = threading.Lock()
+        self.local = threading.local()  # One SQLite connection per thread
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _owners_dir(self):
+        return f"{self.path}.owners"
+
+    def _hold_owner_lock(self):
+        """Lock this process's owner file; the kernel frees it when the process dies"""
+        with self.lock:
+            if self.owner_lock is not None:
+                return
+            os.makedirs(self._owners_dir(), exist_ok=True)
+            lock_file = open(os.path.join(self._owners_dir(), f"{self.owner}.lock"), 'a')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.owner_lock = lock_file
+
+    def _owner_alive(self, owner):
+        if owner == self.owner:
+            return True
+        lock_path = os.path.join(self._owners_dir(), f"{owner}.lock")
+        try:
+            with open(lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+        return False
+
+    def _connect(self):
+        """This thread's connection to the journal, or None if it is disabled or broken"""
+        if not self.path:
+            return None
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            try:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                # Autocommit, with explicit transactions where rows are claimed
+                connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS jobs ('
+                    'entry_id TEXT PRIMARY KEY, user_id TEXT NOT NULL, created_at TEXT, owner TEXT, '
+                    'attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL, added REAL NOT NULL)')
+                self._hold_owner_lock()
+            except (sqlite3.Error, OSError) as e:
+                print(f"[job_journal] ERROR: Could not open {self.path}, jobs will not survive restarts: {str(e)}")
+                self.path = ''
+                return None
+            self.local.connection = connection
+        return connection
+
+    def add(self, entry_id, user_id, created_at=None):
+        """Record a job for an entry, owned by this process (starts over if it was recorded before)"""
+        connection = self._connect()
+        if connection is None:
+            return
+        try:
+            connection.execute(
+                'INSERT OR REPLACE INTO jobs (entry_id, user_id, created_at, owner, attempts, next_attempt, added) '
+                'VALUES (?, ?, ?, ?, 0, NULL, ?)',
+                (entry_id, str(user_id), created_at, self.owner, time.time()))
+        except sqlite3.Error as e:
+            print(f"[job_journal] ERROR: Could not record job for entry {entry_id}: {str(e)}")
+
+    def done(self, entry_id):
+        """Forget a finished job"""
+        connection = self._connect()
+        if connection is None:
+            return
+        try:
+            connection.execute('DELETE FROM jobs WHERE entry_id = ?', (entry_id,))
+        except sqlite3.Error as e:
+            print(f"[job_journal] ERROR: Could not delete job for entry {entry_id}: {str(e)}")
+
+    def failed(self, entry_id):
+        """Release a failed job to be retried after a backoff, or give up on it after max_attempts
+
+        Given-up jobs stay in the journal, so sweeps for unprocessed entries skip them.
+        """
+        connection = self._connect()
+        if connection is None:
+            return
+        try:
+            row = connection.execute('SELECT attempts FROM jobs WHERE entry_id = ?', (entry_id,)).fetchone()
+            if row is None:
+                return
+            attempts = row[0] + 1
+            next_attempt = time.time() + self.retry_delay * 2 ** (attempts - 1) if attempts < self.max_attempts else None
+            if next_attempt is None:
+                print(f"[job_journal] WARNING: Giving up on entry {entry_id} after {attempts} attempts")
+            connection.execute('UPDATE jobs SET owner = NULL, attempts = ?, next_attempt = ? WHERE entry_id = ?',
+                               (attempts, next_attempt, entry_id))
+        except sqlite3.Error as e:
+            print(f"[job_journal] ERROR: Could not record failed job for entry {entry_id}: {str(e)}")
+
+    def claim(self, limit):
+        """Take over jobs due for a retry or owned by workers that died
+
+        Returns:
+            List of (entry_id, user_id, created_at) now owned by this process
+        """
+        connection = self._connect()
+        if connection is None:
+            return []
+        try:
+            owners = [row[0] for row in connection.execute('SELECT DISTINCT owner FROM jobs WHERE owner IS NOT NULL')]
+            dead = [owner for owner in owners if not self._owner_alive(owner)]
+            # Claimed in one write transaction, so two workers never take the same job
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                rows = connection.execute(
+                    f"SELECT entry_id, user_id, created_at FROM jobs "
+                    f"WHERE (owner IS NULL AND next_attempt <= ?) OR owner IN ({','.join('?' * len(dead))}) "
+                    f"ORDER BY added LIMIT ?",
+                    (time.time(), *dead, limit)).fetchall()
+                connection.executemany('UPDATE jobs SET owner = ? WHERE entry_id = ?', [(self.owner, row[0]) for row in rows])
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            return rows
+        except sqlite3.Error as e:
+            print(f"[job_journal] ERROR: Could not claim jobs: {str(e)}")
+            return []
+
+    def known(self, entry_ids):
+        """The entry_ids among entry_ids that have a job, running, waiting or given up"""
+        connection = self._connect()
+        if connection is None or not entry_ids:
+            return set()
+        entry_ids = list(entry_ids)
+        found = set()
+        try:
+            # Chunked to stay under SQLite's limit on bound parameters
+            for start in range(0, len(entry_ids), 500):
+                chunk = entry_ids[start:start + 500]
+                found.update(row[0] for row in connection.execute(
+                    f"SELECT entry_id FROM jobs WHERE entry_id IN ({','.join('?' * len(chunk))})", chunk))
+        except sqlite3.Error as e:
+            print(f"[job_journal] ERROR: Could not look up jobs: {str(e)}")
+        return found
+
+    def counts(self):
+        """Number of jobs 'running' (owned by a worker), 'waiting' for a retry and 'given_up'"""
+        connection = self._connect()
+        if connection is None:
+            return {}
+        try:
+            running, waiting, given_up = connection.execute(
+                'SELECT COALESCE(SUM(owner IS NOT NULL), 0), '
+                'COALESCE(SUM(owner IS NULL AND next_attempt IS NOT NULL), 0), '
+                'COALESCE(SUM(owner IS NULL AND next_attempt IS NULL), 0) FROM jobs').fetchone()
+            return {'running': running, 'waiting': waiting, 'given_up': given_up}
+        except sqlite3.Error as e:
+            print(f"[job_journal] ERROR: Could not count jobs: {str(e)}")
+            return {}
+
+
+# Global journal used by the entry processor
+job_journal = JobJournal()
@@ -0,0 +1,333 @@
+"""
+Per-user BM25 inverted index over entry text.
+Catches the names, places and dates that embeddings match poorly, and answers
+purely lexical queries without an embedding round trip. Kept in memory for
+the most recently searched users, built from the database on first use and
+updated incrementally as entries change.
+"""
+
+import math
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+
+from backend.services.hnsw_index import create_service_client, index as vector_index
+from backend.services.index_wal import OP_DELETE
+from backend.services.locks import ReadWriteLock
+
+__all__ = ['BM25Index', 'UserLexicalIndex', 'lexical_index', 'tokenize', 'is_lexical_query', 'reciprocal_rank_fusion']
+
+_TOKEN_PATTERN = re.compile(r"[\w']+")
+
+# Words too common in journal entries to say anything about which entry is meant
+STOPWORDS = frozenset("""
+a about after again all also am an and any are as at be because been before being
+but by can could did do does doing for from had has have having he her here hers
+him his how i if in into is it its just me more most my no nor not of off on once
+only or other our out over own same she so some such than that the their them
+then there these they this those through to too under until up very was we were
+what when where which while who whom why will with would you your
+""".split())
+
+_MONTHS_AND_DAYS = frozenset("""
+january february march april may june july august september october november december
+jan feb mar apr jun jul aug sep sept oct nov dec
+monday tuesday wednesday thursday friday saturday sunday
+today yesterday tomorrow
+""".split())
+
+_DATE_PATTERN = re.compile(r"^\d{1,4}([/.-]\d{1,4}){0,2}(st|nd|rd|th)?$")
+
+
+def tokenize(text):
+    """Split text into lowercase terms, dropping stopwords"""
+    if not text:
+        return []
+    return [term for term in _TOKEN_PATTERN.findall(text.lower()) if term not in STOPWORDS]
+
+
+def is_lexical_query(query_text):
+    """Whether a query names something specific enough that keyword search alone answers it
+
+    True for quoted phrases and for short queries made only of names, numbers and
+    dates ("Sarah", "Lisbon March 2024"), where an embedding adds nothing.
+    """
+    query_text = query_text.strip()
+    if len(query_text) > 2 and query_text[0] == query_text[-1] == '"':
+        return True
+
+    words = _TOKEN_PATTERN.findall(query_text)
+    if not words or len(words) > 3:
+        return False
+    return all(
+        word[0].isupper() or word.lower() in _MONTHS_AND_DAYS or _DATE_PATTERN.match(word)
+        for word in words
+    )
+
+
+def reciprocal_rank_fusion(*rankings, k=60):
+    """Merge ranked lists of entry_ids, best first
+
+    Each entry scores sum(1 / (k + rank)) over the lists it appears in, so entries
+    ranked well by both retrievers rise to the top without calibrating their scores.
+
+    Returns:
+        List of (entry_id, fused score) tuples, best first
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, entry_id in enumerate(ranking, 1):
+            scores[entry_id] = scores.get(entry_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class BM25Index:
+    def __init__(self, k1=1.2, b=0.75):
+        """Initialize an inverted index scored with Okapi BM25
+
+        Args:
+            k1: Term frequency saturation (higher = repeated terms count for more)
+            b: Document length normalization (0 = none, 1 = full)
+        """
+        self.k1 = k1
+        self.b = b
+        self.postings = {}  # Maps each term to {entry_id: term frequency}
+        self.doc_lengths = {}  # Maps entry_id to its number of terms
+        self.doc_terms = {}  # Maps entry_id to its distinct terms, so removal skips unrelated postings
+        self.total_length = 0
+        self.lock = ReadWriteLock()
+
+    def add_document(self, entry_id, text):
+        """Index an entry's text, replacing whatever was indexed for it before"""
+        counts = Counter(tokenize(text))
+        with self.lock.write_lock():
+            self._remove_locked(entry_id)
+            for term, count in counts.items():
+                self.postings.setdefault(term, {})[entry_id] = count
+            length = sum(counts.values())
+            self.doc_lengths[entry_id] = length
+            self.doc_terms[entry_id] = tuple(counts)
+            self.total_length += length
+
+    def remove_document(self, entry_id):
+        with self.lock.write_lock():
+            return self._remove_locked(entry_id)
+
+    def _remove_locked(self, entry_id):
+        length = self.doc_lengths.pop(entry_id, None)
+        if length is None:
+            return False
+        self.total_length -= length
+        for term in self.doc_terms.pop(entry_id):
+            del self.postings[term][entry_id]
+            if not self.postings[term]:
+                del self.postings[term]
+        return True
+
+    def search(self, query_text, k=5):
+        """Rank entries by BM25 score for the query terms
+
+        Returns:
+            List of dictionaries with entry_id and score, best first
+        """
+        terms = set(tokenize(query_text))
+        with self.lock.read_lock():
+            num_docs = len(self.doc_lengths)
+            if not terms or num_docs == 0:
+                return []
+            average_length = self.total_length / num_docs or 1.0
+
+            scores = {}
+            for term in terms:
+                docs = self.postings.get(term)
+                if not docs:
+                    continue
+                idf = math.log(1 + (num_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+                for entry_id, frequency in docs.items():
+                    norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[entry_id] / average_length)
+                    scores[entry_id] = scores.get(entry_id, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [{'entry_id': entry_id, 'score': score} for entry_id, score in best]
+
+
+class UserLexicalIndex:
+    def __init__(self, page_size=None, max_users=None):
+        """Initialize a collection of per-user BM25 indexes
+
+        A user's index is built from the database the first time they search.
+        Writes in this process update it directly; writes in other workers arrive
+        through the vector index's log, which marks the affected entries dirty so
+        they are re-read from the database before the next search. Users whose
+        changes may have been missed (another worker checkpointed the log first)
+        are rebuilt in the background while their current index keeps serving.
+
+        Args:
+            page_size: Rows per request when building (defaults to INDEX_BUILD_PAGE_SIZE or 500)
+            max_users: Indexes kept before the least recently searched are dropped
+                (defaults to LEXICAL_INDEX_MAX_USERS or 200)
+        """
+        if page_size is None:
+            page_size = int(os.environ.get('INDEX_BUILD_PAGE_SIZE', 500))
+        if max_users is None:
+            max_users = int(os.environ.get('LEXICAL_INDEX_MAX_USERS', 200))
+        self.page_size = page_size
+        self.max_users = max_users
+        self.indexes = OrderedDict()  # Maps user_id to that user's BM25Index, least recently searched first
+        self.dirty = {}  # Maps user_id to entry_ids to re-read before searching
+        self.stale = set()  # user_ids whose index may have missed changes and is rebuilt on next search
+        self.rebuilding = {}  # Maps user_ids with a background rebuild running to entry_ids changed since it started
+        self.lock = threading.Lock()  # Guards indexes, dirty, stale and rebuilding, never held during I/O
+
+    def _entry_text(self, entry):
+        return ' '.join(part for part in (entry.get('content'), entry.get('processed')) if part)
+
+    def _build(self, user_id):
+        supabase = create_service_client()
+        if supabase is None:
+            return None
+
+        bm25 = BM25Index()
+        last_entry_id = None
+        while True:
+            query = supabase.table('entries').select('user_and_entry_id, content, processed').eq('user_id', user_id)
+            if last_entry_id is not None:
+                query = query.gt('user_and_entry_id', last_entry_id)
+            response = query.order('user_and_entry_id').limit(self.page_size).execute()
+            page = response.data if response.data else []
+            for entry in page:
+                bm25.add_document(entry['user_and_entry_id'], self._entry_text(entry))
+            if len(page) < self.page_size:
+                break
+            last_entry_id = page[-1]['user_and_entry_id']
+
+        print(f"[lexical_index] Built index for user {user_id} with {len(bm25.doc_lengths)} entries")
+        return bm25
+
+    def get(self, user_id):
+        """Get a user's index, building it from the database if needed"""
+        user_id = str(user_id)
+        with self.lock:
+            bm25 = self.indexes.get(user_id)
+            if bm25 is not None:
+                self.indexes.move_to_end(user_id)
+                return bm25
+
+            # Built without the lock so other users are not blocked; changes made
+            # meanwhile are marked dirty and re-read before the first search
+            self.dirty.setdefault(user_id, set())
+        built = self._build(user_id)
+        if built is None:
+            return None
+        with self.lock:
+            bm25 = self.indexes.setdefault(user_id, built)
+            self._evict_locked()
+            return bm25
+
+    def _evict_locked(self):
+        while len(self.indexes) > self.max_users:
+            user_id, _ = self.indexes.popitem(last=False)
+            self.dirty.pop(user_id, None)
+            self.stale.discard(user_id)
+
+    def _rebuild_in_background(self, user_id):
+        """Rebuild a stale index in a background thread (one at a time per user)"""
+        with self.lock:
+            if user_id in self.rebuilding or user_id not in self.stale:
+                return
+            self.rebuilding[user_id] = set()
+            self.stale.discard(user_id)
+        thread = threading.Thread(target=self._rebuild, args=(user_id,))
+        thread.daemon = True
+        thread.start()
+
+    def _rebuild(self, user_id):
+        try:
+            built = self._build(user_id)
+            with self.lock:
+                # Dropped from the cache while building
+                if built is not None and user_id in self.indexes:
+                    self.indexes[user_id] = built
+                    # Entries changed while building may have been read before the change
+                    self.dirty.setdefault(user_id, set()).update(self.rebuilding[user_id])
+        except Exception as e:
+            print(f"[lexical_index] ERROR: Rebuild failed for user {user_id}: {str(e)}")
+            with self.lock:
+                if user_id in self.indexes:
+                    self.stale.add(user_id)
+        finally:
+            with self.lock:
+                self.rebuilding.pop(user_id, None)
+
+    def _refresh_dirty(self, user_id, bm25):
+        with self.lock:
+            entry_ids = self.dirty.pop(user_id, None)
+        if not entry_ids:
+            return
+
+        supabase = create_service_client()
+        if supabase is None:
+            return
+        response = supabase.table('entries').select('user_and_entry_id, content, processed').in_('user_and_entry_id', list(entry_ids)).execute()
+        found = {entry['user_and_entry_id']: entry for entry in (response.data or [])}
+        for entry_id in entry_ids:
+            if entry_id in found:
+                bm25.add_document(entry_id, self._entry_text(found[entry_id]))
+            else:
+                # Deleted since it was indexed
+                bm25.remove_document(entry_id)
+
+    def search(self, user_id, query_text, k=5):
+        """Rank a user's entries by BM25 score
+
+        Returns:
+            List of dictionaries with entry_id and score, best first
+        """
+        bm25 = self.get(user_id)
+        if bm25 is None:
+            return []
+        self._rebuild_in_background(str(user_id))
+        self._refresh_dirty(str(user_id), bm25)
+        return bm25.search(query_text, k=k)
+
+    def upsert_entry(self, user_id, entry_id, content=None, processed=None):
+        """Index an entry's current text (skipped if the user's index is not built yet)"""
+        with self.lock:
+            bm25 = self.indexes.get(str(user_id))
+            if str(user_id) in self.rebuilding:
+                self.rebuilding[str(user_id)].add(entry_id)
+        if bm25 is not None:
+            bm25.add_document(entry_id, self._entry_text({'content': content, 'processed': processed}))
+
+    def remove_entry(self, user_id, entry_id):
+        """Forget a deleted entry"""
+        with self.lock:
+            bm25 = self.indexes.get(str(user_id))
+            if str(user_id) in self.rebuilding:
+                self.rebuilding[str(user_id)].add(entry_id)
+        if bm25 is not None:
+            bm25.remove_document(entry_id)
+
+    def on_vector_change(self, record, user_ids=None):
+        """Follow changes logged by the vector index (see UserPartitionedIndex.add_listener)"""
+        with self.lock:
+            if record is None:
+                # Changes may have been missed: rebuild on next use, serving the current index meanwhile
+                self.stale.update(self.indexes if user_ids is None else set(user_ids) & set(self.indexes))
+                return
+            bm25 = self.indexes.get(record.user_id)
+            if bm25 is None and record.user_id not in self.dirty:
+                return
+            if record.user_id in self.rebuilding:
+                self.rebuilding[record.user_id].add(record.entry_id)
+            if record.op == OP_DELETE and bm25 is not None:
+                bm25.remove_document(record.entry_id)
+            else:
+                # The log carries no text, so read it from the database before the next search
+                self.dirty.setdefault(record.user_id, set()).add(record.entry_id)
+
+
+# Global index instance, kept in step with the vector index's log
+lexical_index = UserLexicalIndex()
+vector_index.add_listener(lexical_index.on_vector_change)
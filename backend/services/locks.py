@@ -0,0 +1,75 @@
+"""
+Synchronization helpers shared by the vector index services.
+"""
+
+import fcntl
+import os
+import threading
+from contextlib import contextmanager
+
+__all__ = ['ReadWriteLock', 'file_lock']
+
+
+class ReadWriteLock:
+    def __init__(self):
+        """Lock that admits many concurrent readers or a single writer
+
+        Waiting writers block new readers, so a steady stream of searches cannot
+        starve an insert. Not re-entrant.
+        """
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read_lock(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write_lock(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+@contextmanager
+def file_lock(path, blocking=True):
+    """Hold an exclusive flock on path, shared by every thread and process on the host
+
+    Each call opens its own file description, so two threads of one process
+    exclude each other as well. Yields whether the lock was acquired (always
+    True when blocking).
+    """
+    dir_path = os.path.dirname(path)
+    if dir_path:
+        os.makedirs(dir_path, exist_ok=True)
+    with open(path, 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
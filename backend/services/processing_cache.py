@@ -0,0 +1,48 @@
+"""
+Two-tier cache of process_text results keyed by the prompt version and a hash
+of the normalized content. Re-saving a conversation, an edit that leaves the
+text unchanged, or reprocessing identical text is answered from an in-process
+LRU or, failing that, a SQLite file shared by every worker on the host, without
+an LLM call. The disk tier holds processed text, as the entries table does.
+"""
+
+import hashlib
+import os
+
+from backend.services.embedding_cache import normalize_text
+from backend.services.two_tier_cache import TwoTierCache
+
+__all__ = ['ProcessingCache', 'processing_cache', 'processing_key']
+
+
+def processing_key(prompt_version, text):
+    """Cache key of text processed with the given prompt version"""
+    digest = hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+    return f"{prompt_version}:{digest}"
+
+
+class ProcessingCache(TwoTierCache):
+    def __init__(self, max_entries=None, path=None, ttl_seconds=None, max_bytes=None):
+        """Initialize an in-process LRU of processed text in front of a SQLite store
+
+        Args:
+            max_entries: Results kept in process memory (defaults to PROCESSING_CACHE_SIZE or 1000)
+            path: SQLite file of the disk tier, '' for memory only
+                (defaults to PROCESSING_CACHE_PATH or instance/processing_cache.sqlite3)
+            ttl_seconds: Seconds a result is kept on disk (defaults to PROCESSING_CACHE_TTL or 30 days)
+            max_bytes: Approximate size bound of the disk tier, least recently used rows
+                are evicted past it (defaults to PROCESSING_CACHE_MAX_BYTES or 256 MB)
+        """
+        if max_entries is None:
+            max_entries = int(os.environ.get('PROCESSING_CACHE_SIZE', 1000))
+        if path is None:
+            path = os.environ.get('PROCESSING_CACHE_PATH', 'instance/processing_cache.sqlite3')
+        if ttl_seconds is None:
+            ttl_seconds = float(os.environ.get('PROCESSING_CACHE_TTL', 30 * 24 * 3600))
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('PROCESSING_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+        super().__init__('processing_cache', 'processed', 'text', 'TEXT', max_entries, path, ttl_seconds, max_bytes)
+
+
+# Global cache instance used by process_text
+processing_cache = ProcessingCache()
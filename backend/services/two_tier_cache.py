@@ -0,0 +1,220 @@
+"""
+Two-tier cache shared by the embedding and processing caches: an in-process
+LRU in front of a SQLite file shared by every worker on the host. Values are
+stored in one column of one table, converted to and from what SQLite stores
+by the cache's codec. Rows expire after a TTL, and the least recently used
+are evicted once the file passes a size bound.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+__all__ = ['TwoTierCache']
+
+# Writes between sweeps for expired rows and the size bound
+_EVICT_EVERY = 200
+
+# Per-row overhead on top of the key and value bytes, for estimating the file size
+_ROW_OVERHEAD_BYTES = 128
+
+
+class TwoTierCache:
+    def __init__(self, name, table, column, column_type, max_entries, path, ttl_seconds, max_bytes,
+                 encode=None, decode=None):
+        """Initialize an in-process LRU in front of a SQLite store
+
+        Args:
+            name: Name used in log messages
+            table: SQLite table of the disk tier
+            column: Column of table holding the values
+            column_type: SQLite type of column ('TEXT' or 'BLOB')
+            max_entries: Values kept in process memory
+            path: SQLite file of the disk tier, '' for memory only
+            ttl_seconds: Seconds a value is kept on disk
+            max_bytes: Approximate size bound of the disk tier, least recently used rows
+                are evicted past it
+            encode: Turns a value into what column stores (values are stored as they are if None)
+            decode: Turns what column stores back into a value (the inverse of encode)
+        """
+        self.name = name
+        self.table = table
+        self.column = column
+        self.column_type = column_type
+        self.max_entries = max_entries
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.encode = encode or (lambda value: value)
+        self.decode = decode or (lambda stored: stored)
+        self.values = OrderedDict()  # Maps cache keys to values, least recently used first
+        self.lock = threading.Lock()  # Guards values and the counters, never held during I/O
+        self.local = threading.local()  # One SQLite connection per thread
+        self.writes_since_eviction = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        """This thread's connection to the disk tier, or None if it is disabled or broken"""
+        if not self.path:
+            return None
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            try:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                connection = sqlite3.connect(self.path, timeout=5)
+                # WAL lets workers read while another one writes
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.execute('PRAGMA synchronous=NORMAL')
+                connection.execute(
+                    f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                    f"key TEXT PRIMARY KEY, {self.column} {self.column_type} NOT NULL, "
+                    f"created REAL NOT NULL, accessed REAL NOT NULL)")
+                connection.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_accessed ON {self.table} (accessed)")
+                connection.commit()
+            except sqlite3.Error as e:
+                print(f"[{self.name}] ERROR: Could not open {self.path}, caching in memory only: {str(e)}")
+                self.path = ''
+                return None
+            self.local.connection = connection
+        return connection
+
+    def _remember(self, found):
+        with self.lock:
+            for key, value in found.items():
+                self.values[key] = value
+                self.values.move_to_end(key)
+            while len(self.values) > self.max_entries:
+                self.values.popitem(last=False)
+
+    def get_many(self, keys):
+        """Look up values, first in memory and then on disk
+
+        Returns:
+            Dictionary mapping each cached key to its value
+        """
+        found = {}
+        with self.lock:
+            for key in keys:
+                value = self.values.get(key)
+                if value is not None:
+                    self.values.move_to_end(key)
+                    found[key] = value
+            self.memory_hits += len(found)
+
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        from_disk = self._disk_get(missing) if missing else {}
+        if from_disk:
+            if self.max_entries > 0:
+                self._remember(from_disk)
+            found.update(from_disk)
+        with self.lock:
+            self.disk_hits += len(from_disk)
+            self.misses += len(missing) - len(from_disk)
+        return found
+
+    def get(self, key):
+        """Look up one value (None if it is not cached)"""
+        return self.get_many([key]).get(key)
+
+    def put_many(self, values):
+        """Cache values (a dictionary mapping cache keys to values)"""
+        if not values:
+            return
+        if self.max_entries > 0:
+            self._remember(values)
+        self._disk_put(values)
+
+    def put(self, key, value):
+        self.put_many({key: value})
+
+    def _disk_get(self, keys):
+        connection = self._connect()
+        if connection is None:
+            return {}
+        now = time.time()
+        found = {}
+        try:
+            # Chunked to stay under SQLite's limit on bound parameters
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = connection.execute(
+                    f"SELECT key, {self.column} FROM {self.table} WHERE key IN ({','.join('?' * len(chunk))}) AND created > ?",
+                    (*chunk, now - self.ttl_seconds)).fetchall()
+                for key, stored in rows:
+                    found[key] = self.decode(stored)
+            if found:
+                connection.executemany(f"UPDATE {self.table} SET accessed = ? WHERE key = ?", [(now, key) for key in found])
+                connection.commit()
+        except sqlite3.Error as e:
+            print(f"[{self.name}] ERROR: Disk lookup failed: {str(e)}")
+        return found
+
+    def _disk_put(self, values):
+        connection = self._connect()
+        if connection is None:
+            return
+        now = time.time()
+        try:
+            connection.executemany(
+                f"INSERT OR REPLACE INTO {self.table} (key, {self.column}, created, accessed) VALUES (?, ?, ?, ?)",
+                [(key, self.encode(value), now, now) for key, value in values.items()])
+            connection.commit()
+        except sqlite3.Error as e:
+            print(f"[{self.name}] ERROR: Disk write failed: {str(e)}")
+            return
+
+        with self.lock:
+            self.writes_since_eviction += len(values)
+            sweep = self.writes_since_eviction >= _EVICT_EVERY
+            if sweep:
+                self.writes_since_eviction = 0
+        if sweep:
+            self.evict()
+
+    def evict(self):
+        """Delete expired values from disk, then the least recently used past max_bytes
+
+        Returns:
+            Number of rows deleted
+        """
+        connection = self._connect()
+        if connection is None:
+            return 0
+        row_size = f"length(key) + length({self.column}) + {_ROW_OVERHEAD_BYTES}"
+        try:
+            deleted = connection.execute(f"DELETE FROM {self.table} WHERE created <= ?", (time.time() - self.ttl_seconds,)).rowcount
+            total = connection.execute(f"SELECT COALESCE(SUM({row_size}), 0) FROM {self.table}").fetchone()[0]
+            if total > self.max_bytes:
+                # Walk rows from least recently used until enough bytes are freed
+                excess = total - self.max_bytes
+                keys = []
+                for key, size in connection.execute(f"SELECT key, {row_size} FROM {self.table} ORDER BY accessed"):
+                    keys.append((key,))
+                    excess -= size
+                    if excess <= 0:
+                        break
+                connection.executemany(f"DELETE FROM {self.table} WHERE key = ?", keys)
+                deleted += len(keys)
+            connection.commit()
+            return deleted
+        except sqlite3.Error as e:
+            print(f"[{self.name}] ERROR: Eviction failed: {str(e)}")
+            return 0
+
+    def clear(self):
+        """Forget every cached value, in memory and on disk"""
+        with self.lock:
+            self.values.clear()
+        connection = self._connect()
+        if connection is not None:
+            try:
+                connection.execute(f"DELETE FROM {self.table}")
+                connection.commit()
+            except sqlite3.Error as e:
+                print(f"[{self.name}] ERROR: Could not clear the disk tier: {str(e)}")
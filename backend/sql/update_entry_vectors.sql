@@ -0,0 +1,24 @@
+-- Writes a batch of embeddings, and optionally their processed text, into
+-- existing entries with a single UPDATE. Called through PostgREST rpc by
+-- update_entry_vectors() in backend/services/embedding.py.
+--
+-- An UPDATE never inserts, so an entry deleted meanwhile stays deleted, and
+-- with only_missing set an entry that got vectors meanwhile keeps them.
+-- Returns the user_and_entry_ids actually written.
+create or replace function update_entry_vectors(
+    ids text[],
+    vecs text[],
+    texts text[] default null,
+    only_missing boolean default false
+)
+returns table (entry_id text)
+language sql
+as $$
+    update entries e
+    set vectors = u.v::vector,
+        processed = coalesce(u.t, e.processed)
+    from unnest(ids, vecs, texts) as u(id, v, t)
+    where e.user_and_entry_id = u.id
+      and (not only_missing or e.vectors is null)
+    returning e.user_and_entry_id;
+$$;
@@ -0,0 +1,81 @@
+import pytest
+
+from backend.services import id_map
+from backend.services.id_map import EntryIdMap
+
+
+def _entries(count):
+    return [f"user_{i}" for i in range(count)], list(range(count))
+
+
+def test_from_pairs_maps_both_ways():
+    entry_ids, internal_ids = _entries(50)
+    mapping = EntryIdMap.from_pairs(entry_ids, internal_ids)
+
+    assert len(mapping) == 50
+    assert all(mapping[entry_id] == internal_id for entry_id, internal_id in zip(entry_ids, internal_ids))
+    assert all(mapping.entry_id(internal_id) == entry_id for entry_id, internal_id in zip(entry_ids, internal_ids))
+    assert sorted(mapping) == sorted(entry_ids)
+    assert 'user_50' not in mapping
+    with pytest.raises(KeyError):
+        mapping['user_50']
+    with pytest.raises(KeyError):
+        mapping.entry_id(50)
+
+
+@pytest.mark.parametrize('mmap', [False, True])
+def test_save_and_load_round_trip(tmp_path, mmap):
+    entry_ids, internal_ids = _entries(20)
+    mapping = EntryIdMap.from_pairs(entry_ids, internal_ids)
+    # Unsaved changes are folded in by save()
+    mapping.add('user_ü', 20)
+    mapping.remove('user_3')
+    path = str(tmp_path / 'index')
+    mapping.save(path)
+
+    loaded = EntryIdMap.load(path, mmap=mmap)
+
+    assert dict(loaded) == dict(mapping)
+    assert loaded['user_ü'] == 20
+    assert 'user_3' not in loaded
+    assert loaded.internal_ids().tolist() == [i for i in range(21) if i != 3]
+
+
+def test_changes_survive_compaction():
+    entry_ids, internal_ids = _entries(10)
+    mapping = EntryIdMap.from_pairs(entry_ids, internal_ids)
+    mapping.add('user_10', 10)
+    assert mapping.remove('user_2') == 2
+    assert mapping.remove('user_10') == 10
+    assert mapping.remove('missing') is None
+    mapping.add('user_11', 11)
+    before = dict(mapping)
+
+    mapping.compact()
+
+    assert dict(mapping) == before
+    assert (mapping.added, mapping.added_ids, mapping.removed) == ({}, {}, set())
+    # Removed ids leave a gap rather than shifting later ids
+    assert mapping.internal_ids().tolist() == [0, 1, 3, 4, 5, 6, 7, 8, 9, 11]
+    with pytest.raises(KeyError):
+        mapping.entry_id(2)
+
+
+def test_add_compacts_once_changes_outnumber_entries(monkeypatch):
+    monkeypatch.setattr(id_map, '_MIN_COMPACT_CHANGES', 4)
+    mapping = EntryIdMap()
+    for i in range(5):
+        mapping.add(f"user_{i}", i)
+
+    assert mapping.added == {}
+    assert len(mapping.arrays[2]) == 5
+    assert dict(mapping) == {f"user_{i}": i for i in range(5)}
+
+
+def test_colliding_hashes_are_told_apart(monkeypatch):
+    # Every entry_id hashes alike, so lookups must compare the stored ids
+    monkeypatch.setattr(id_map, '_hash', lambda entry_id: 7)
+    mapping = EntryIdMap.from_pairs(['a', 'b', 'c'], [0, 1, 2])
+
+    assert [mapping[entry_id] for entry_id in 'abc'] == [0, 1, 2]
+    assert 'd' not in mapping
@@ -0,0 +1,102 @@
+import os
+
+import numpy as np
+
+from backend.services.index_wal import IndexWAL, WALRecord, OP_ADD, OP_DELETE, OP_UPDATE
+
+
+def _wal(tmp_path):
+    return IndexWAL(str(tmp_path / 'wal.log'))
+
+
+def test_read_returns_appended_records(tmp_path):
+    wal = _wal(tmp_path)
+    wal.append(OP_ADD, 'user', 'user_1', np.arange(4, dtype=np.float32), 1700000000.5)
+    wal.append_many([
+        WALRecord(OP_UPDATE, 'user', 'user_1', np.ones(4, dtype=np.float32)),
+        WALRecord(OP_DELETE, 'user', 'user_2', None),
+    ])
+
+    records, offset, identity = wal.read()
+
+    assert [(r.op, r.user_id, r.entry_id) for r in records] == [
+        (OP_ADD, 'user', 'user_1'), (OP_UPDATE, 'user', 'user_1'), (OP_DELETE, 'user', 'user_2')]
+    assert np.array_equal(records[0].vector, np.arange(4, dtype=np.float32))
+    assert records[0].created_at == 1700000000.5
+    assert records[1].created_at is None
+    assert records[2].vector is None
+    assert offset == wal.size()
+    assert identity == wal.identity()
+
+
+def test_read_from_offset_returns_only_later_records(tmp_path):
+    wal = _wal(tmp_path)
+    wal.append(OP_ADD, 'user', 'user_1', np.zeros(4))
+    _, offset, _ = wal.read()
+    wal.append(OP_ADD, 'user', 'user_2', np.zeros(4))
+
+    records, _, _ = wal.read(offset)
+
+    assert [r.entry_id for r in records] == ['user_2']
+
+
+def test_torn_tail_ends_the_read(tmp_path):
+    wal = _wal(tmp_path)
+    wal.append(OP_ADD, 'user', 'user_1', np.zeros(4))
+    complete = wal.size()
+    wal.append(OP_ADD, 'user', 'user_2', np.zeros(4))
+    # A crash mid-append leaves only part of the last record on disk
+    with open(wal.path, 'r+b') as f:
+        f.truncate(wal.size() - 5)
+
+    records, offset, _ = wal.read()
+
+    assert [r.entry_id for r in records] == ['user_1']
+    assert offset == complete
+
+
+def test_torn_frame_header_ends_the_read(tmp_path):
+    wal = _wal(tmp_path)
+    wal.append(OP_ADD, 'user', 'user_1', np.zeros(4))
+    complete = wal.size()
+    with open(wal.path, 'ab') as f:
+        f.write(b'\x10\x00')
+
+    records, offset, _ = wal.read()
+
+    assert [r.entry_id for r in records] == ['user_1']
+    assert offset == complete
+
+
+def test_crc_mismatch_ends_the_read(tmp_path):
+    wal = _wal(tmp_path)
+    wal.append(OP_ADD, 'user', 'user_1', np.zeros(4))
+    complete = wal.size()
+    wal.append(OP_ADD, 'user', 'user_2', np.zeros(4))
+    # Flip a bit in the last byte of the second record's payload
+    with open(wal.path, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 0x01]))
+
+    records, offset, _ = wal.read()
+
+    assert [r.entry_id for r in records] == ['user_1']
+    assert offset == complete
+
+
+def test_reset_changes_identity_and_empties_the_log(tmp_path):
+    wal = _wal(tmp_path)
+    wal.append(OP_ADD, 'user', 'user_1', np.zeros(4))
+    identity = wal.identity()
+
+    with wal.lock():
+        wal.reset()
+
+    assert wal.identity() != identity
+    assert wal.read() == ([], 0, wal.identity())
+
+
+def test_missing_log_reads_empty(tmp_path):
+    assert _wal(tmp_path).read() == ([], 0, None)
@@ -0,0 +1,87 @@
+import threading
+import time
+
+from backend.services.locks import ReadWriteLock, file_lock
+
+# Generous bound on how long a thread takes to reach a lock it is blocked on
+_SETTLE_SECONDS = 0.2
+
+
+def test_readers_share_the_lock():
+    lock = ReadWriteLock()
+    with lock.read_lock():
+        entered = threading.Event()
+
+        def read():
+            with lock.read_lock():
+                entered.set()
+
+        thread = threading.Thread(target=read)
+        thread.start()
+        assert entered.wait(timeout=5)
+        thread.join()
+
+
+def test_waiting_writer_blocks_new_readers():
+    lock = ReadWriteLock()
+    events = []
+    first_reader_holds = threading.Event()
+    release_first_reader = threading.Event()
+
+    def first_reader():
+        with lock.read_lock():
+            first_reader_holds.set()
+            release_first_reader.wait(timeout=5)
+            events.append('first reader done')
+
+    def writer():
+        with lock.write_lock():
+            events.append('writer')
+
+    def second_reader():
+        with lock.read_lock():
+            events.append('second reader')
+
+    threads = [threading.Thread(target=first_reader)]
+    threads[0].start()
+    assert first_reader_holds.wait(timeout=5)
+    threads.append(threading.Thread(target=writer))
+    threads[1].start()
+    time.sleep(_SETTLE_SECONDS)
+    threads.append(threading.Thread(target=second_reader))
+    threads[2].start()
+    time.sleep(_SETTLE_SECONDS)
+
+    # The writer waits for the first reader, and the second reader for the writer
+    assert events == []
+    release_first_reader.set()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert events == ['first reader done', 'writer', 'second reader']
+
+
+def test_writer_excludes_readers():
+    lock = ReadWriteLock()
+    entered = threading.Event()
+
+    def read():
+        with lock.read_lock():
+            entered.set()
+
+    with lock.write_lock():
+        thread = threading.Thread(target=read)
+        thread.start()
+        assert not entered.wait(timeout=_SETTLE_SECONDS)
+    assert entered.wait(timeout=5)
+    thread.join()
+
+
+def test_file_lock_excludes_other_holders(tmp_path):
+    path = str(tmp_path / 'locks' / 'build.lock')
+    with file_lock(path) as acquired:
+        assert acquired
+        with file_lock(path, blocking=False) as acquired_again:
+            assert not acquired_again
+    with file_lock(path, blocking=False) as acquired:
+        assert acquired
@@ -0,0 +1,121 @@
+import time
+
+import numpy as np
+import pytest
+
+from backend.services.exact_index import ExactIndex
+from backend.services.hnsw_index import HNSWIndex, UserPartitionedIndex
+from backend.services.index_wal import WALRecord, OP_ADD, OP_DELETE
+
+DIM = 8
+
+
+def _vector(seed):
+    return np.random.default_rng(seed).standard_normal(DIM).astype(np.float32)
+
+
+def _add(entry_id, seed, user_id='user'):
+    return WALRecord(OP_ADD, user_id, entry_id, _vector(seed), 1700000000.0 + seed)
+
+
+@pytest.fixture
+def workers(tmp_path):
+    """Two indexes over one directory, like two worker processes on a host"""
+    def make():
+        return UserPartitionedIndex(str(tmp_path), dim=DIM, exact_threshold=100, checkpoint_bytes=1 << 30)
+    return make(), make()
+
+
+def _indexed(index, user_id='user'):
+    partition = index.get_partition(user_id, build=False)
+    return set() if partition is None else set(partition.entry_id_to_id)
+
+
+def test_catch_up_applies_records_logged_by_another_worker(workers):
+    writer, reader = workers
+    writer.log_changes([_add('user_1', 1), _add('user_2', 2)])
+    assert _indexed(reader) == {'user_1', 'user_2'}
+
+    writer.log_changes([_add('user_3', 3), WALRecord(OP_DELETE, 'user', 'user_1', None)])
+    reader.catch_up()
+
+    assert _indexed(reader) == {'user_2', 'user_3'}
+    assert reader.search(_vector(3), k=1)[0]['entry_id'] == 'user_3'
+
+
+def test_checkpoint_hands_over_to_snapshots(workers, tmp_path):
+    writer, reader = workers
+    writer.log_changes([_add('user_1', 1), _add('user_2', 2), _add('other_1', 4, user_id='other')])
+    assert _indexed(reader) == {'user_1', 'user_2'}
+
+    writer.checkpoint()
+    assert writer.wal.size() == 0
+    # Logged after the checkpoint, so only the new log has it
+    writer.log_changes([_add('user_3', 3)])
+    reader.catch_up()
+
+    assert _indexed(reader) == {'user_1', 'user_2', 'user_3'}
+    assert _indexed(reader, 'other') == {'other_1'}
+    assert reader.get_partition('user', build=False).get_created_at('user_3') == 1700000003.0
+
+    # A worker started after the checkpoint loads the snapshot plus the new log
+    fresh = UserPartitionedIndex(str(tmp_path), dim=DIM, exact_threshold=100)
+    assert fresh.load()
+    assert _indexed(fresh) == {'user_1', 'user_2', 'user_3'}
+
+
+@pytest.mark.parametrize('exact_threshold', [100, 2])
+def test_indexed_entry_ids_reads_unloaded_indexes_without_loading_them(tmp_path, exact_threshold):
+    writer = UserPartitionedIndex(str(tmp_path), dim=DIM, exact_threshold=exact_threshold, checkpoint_bytes=1 << 30)
+    writer.log_changes([_add(f'user_{seed}', seed) for seed in range(5)] + [_add('other_1', 9, user_id='other')])
+    writer.checkpoint()
+    writer.log_changes([_add('user_5', 5), WALRecord(OP_DELETE, 'user', 'user_0', None), _add('new_1', 6, user_id='new')])
+
+    reader = UserPartitionedIndex(str(tmp_path), dim=DIM, exact_threshold=exact_threshold)
+    reader.catch_up()
+    indexed = reader.indexed_entry_ids(['user', 'other', 'new', 'missing'])
+
+    assert indexed == {
+        'user': {'user_1', 'user_2', 'user_3', 'user_4', 'user_5'},
+        'other': {'other_1'},
+        'new': {'new_1'},
+    }
+    assert reader.partitions == {}
+
+
+def test_checkpoint_tells_listeners_which_users_went_stale(workers):
+    writer, reader = workers
+    notices = []
+    reader.add_listener(lambda record, user_ids=None: notices.append(user_ids) if record is None else None)
+    writer.log_changes([_add('user_1', 1), _add('other_1', 2, user_id='other')])
+    reader.catch_up()
+
+    writer.log_changes([_add('user_2', 3)])
+    writer.checkpoint()
+    reader.catch_up()
+    assert notices == [{'user', 'other'}]
+
+    # Two checkpoints before the reader looked again: which users changed is unknown
+    writer.log_changes([_add('user_3', 4)])
+    writer.checkpoint()
+    writer.log_changes([_add('other_2', 5, user_id='other')])
+    writer.checkpoint()
+    reader.catch_up()
+    assert notices == [{'user', 'other'}, None]
+
+
+def test_promotion_to_hnsw_runs_in_the_background(tmp_path):
+    index = UserPartitionedIndex(str(tmp_path), dim=DIM, exact_threshold=3, checkpoint_bytes=1 << 30)
+    index.log_changes([_add('user_0', 0)])
+    assert isinstance(index.get_partition('user', build=False), ExactIndex)
+
+    index.log_changes([_add(f'user_{seed}', seed) for seed in range(1, 6)])
+    deadline = time.time() + 10
+    while not isinstance(index.partitions['user'], HNSWIndex) and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert isinstance(index.partitions['user'], HNSWIndex)
+    assert set(index.partitions['user'].entry_id_to_id) == {f'user_{seed}' for seed in range(6)}
+    # Other workers load the rebuilt snapshot instead of building the graph themselves
+    other = UserPartitionedIndex(str(tmp_path), dim=DIM, exact_threshold=3)
+    assert isinstance(other.get_partition('user', build=False), HNSWIndex)